@@ -1,15 +1,32 @@
-import os, sys, struct, argparse, io
+import os, sys, io
+
+if not __package__:
+	# Run as a script from a checkout rather than the installed package
+	sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fumentools.binreader import BinReader
+from fumentools import phases
+from fumentools import metrics
+from fumentools import verify
+from fumentools import journal
 
 fumen2osu_version = "v1.4"
 
 branchNames = ("normal", "advanced", "master")
 
+class UnknownNoteError(ValueError):
+	pass
+
+@phases.timed("fumen.decode")
 def readFumen(inputFile, byteOrder=None, debug=False):
-	if type(inputFile) is str:
-		file = open(inputFile, "rb")
-	else:
-		file = inputFile
-	size = os.fstat(file.fileno()).st_size
+	with phases.phase("fumen.io") as phase:
+		file = BinReader.open(inputFile)
+		phase.add(bytes=file.size)
+	with file:
+		return parseFumen(file, byteOrder, debug)
+
+def parseFumen(file, byteOrder=None, debug=False):
+	size = file.size
 	
 	noteTypes = {
 		0x1: "Don", # ドン
@@ -28,40 +45,36 @@ def readFumen(inputFile, byteOrder=None, debug=False):
 		0x62: "Drumroll" # ?
 	}
 	song = {}
-	
-	def readStruct(format, seek=None):
-		if seek:
-			file.seek(seek)
-		return struct.unpack(order + format, file.read(struct.calcsize(order + format)))
+	noteCount = 0
 	
 	if byteOrder:
-		order = ">" if byteOrder == "big" else "<"
-		totalMeasures = readStruct("I", 0x200)[0]
+		file.order = ">" if byteOrder == "big" else "<"
+		totalMeasures = file.unpack("I", 0x200)[0]
 	else:
-		order = ""
-		measuresBig = readStruct(">I", 0x200)[0]
-		measuresLittle = readStruct("<I", 0x200)[0]
+		measuresBig = file.unpack(">I", 0x200)[0]
+		measuresLittle = file.unpack("<I", 0x200)[0]
 		if measuresBig < measuresLittle:
-			order = ">"
+			file.order = ">"
 			totalMeasures = measuresBig
 		else:
-			order = "<"
+			file.order = "<"
 			totalMeasures = measuresLittle
 	
-	hasBranches = getBool(readStruct("B", 0x1b0)[0])
+	song["byteOrder"] = "big" if file.order == ">" else "little"
+	hasBranches = getBool(file.unpack("B", 0x1b0)[0])
 	song["branches"] = hasBranches
 	if debug:
 		debugPrint("Total measures: {0}, {1} branches, {2}-endian".format(
 			totalMeasures,
 			"has" if hasBranches else "no",
-			"Big" if order == ">" else "Little"
+			"Big" if file.order == ">" else "Little"
 		))
 	
 	file.seek(0x208)
 	for measureNumber in range(totalMeasures):
 		measure = {}
 		# measureStruct: bpm 4, offset 4, gogo 1, hidden 1, dummy 2, branchInfo 4 * 6, dummy 4
-		measureStruct = readStruct("ffBBHiiiiiii")
+		measureStruct = file.unpack("ffBBHiiiiiii")
 		measure["bpm"] = measureStruct[0]
 		measure["fumenOffset"] = measureStruct[1]
 		if measureNumber == 0:
@@ -75,7 +88,7 @@ def readFumen(inputFile, byteOrder=None, debug=False):
 		for branchNumber in range(3):
 			branch = {}
 			# branchStruct: totalNotes 2, dummy 2, speed 4
-			branchStruct = readStruct("HHf")
+			branchStruct = file.unpack("HHf")
 			totalNotes = branchStruct[0]
 			branch["speed"] = branchStruct[2]
 			
@@ -105,7 +118,7 @@ def readFumen(inputFile, byteOrder=None, debug=False):
 				
 				note = {}
 				# noteStruct: type 4, pos 4, item 4, dummy 4, init 2, diff 2, duration 4
-				noteStruct = readStruct("ififHHf")
+				noteStruct = file.unpack("ififHHf")
 				noteType = noteStruct[0]
 				
 				if noteType not in noteTypes:
@@ -140,6 +153,7 @@ def readFumen(inputFile, byteOrder=None, debug=False):
 					file.seek(0x8, os.SEEK_CUR)
 			
 			branch["length"] = totalNotes
+			noteCount += totalNotes
 			measure[branchNames[branchNumber]] = branch
 		
 		song[measureNumber] = measure
@@ -147,11 +161,11 @@ def readFumen(inputFile, byteOrder=None, debug=False):
 			break
 	
 	song["length"] = totalMeasures
-	
-	file.close()
+	song["noteCount"] = noteCount
+	phases.count("fumen.decode", size, noteCount)
 	return song
 
-def writeOsu(song, globalOffset=0, title=None, subtitle="", wave=None, selectedBranch=None, outputFile=None, inputFile=None):
+def writeOsu(song, globalOffset=0, title=None, subtitle="", wave=None, selectedBranch=None, outputFile=None, inputFile=None, version=""):
 	if not song or len(song) == 0:
 		return False
 	
@@ -160,16 +174,188 @@ def writeOsu(song, globalOffset=0, title=None, subtitle="", wave=None, selectedB
 			filename = inputFile
 		else:
 			filename = inputFile.name
-		filenameNoExt = os.path.splitext(filename)[0]
-		title = title or filenameNoExt
-		wave = wave or "SONG_{0}.wav".format(
-			filenameNoExt.split("_")[0].upper()
-		)
-		outputFile = outputFile or "{0}.osu".format(filenameNoExt)
+		defaultTitle, defaultWave, defaultOutputFile = osuNames(filename)
+		title = title or defaultTitle
+		wave = wave or defaultWave
+		outputFile = outputFile or defaultOutputFile
 	else:
 		title = title or "Song Title"
 		wave = wave or "song.wav"
 	
+	osuContents = buildOsu(song, globalOffset, title, subtitle, wave, selectedBranch, version)
+	
+	if outputFile:
+		if type(outputFile) is str:
+			file = journal.AtomicFile(outputFile)
+		else:
+			file = outputFile
+		if type(outputFile) is io.TextIOWrapper:
+			osuContents = osuContents.decode("utf-8")
+		with phases.phase("osu.write", len(osuContents)):
+			try:
+				file.write(osuContents)
+			except UnicodeEncodeError as e:
+				print(e)
+			file.close()
+		return True
+	else:
+		return osuContents
+
+def osuNames(filename):
+	# Default title, audio filename and output filename for a fumen file
+	filenameNoExt = os.path.splitext(filename)[0]
+	return (
+		filenameNoExt,
+		"SONG_{0}.wav".format(filenameNoExt.split("_")[0].upper()),
+		"{0}.osu".format(filenameNoExt)
+	)
+
+difficultyNames = {
+	"e": "Easy",
+	"n": "Normal",
+	"h": "Hard",
+	"m": "Oni",
+	"x": "Ura"
+}
+
+def songId(filename):
+	return os.path.splitext(os.path.basename(filename))[0].split("_")[0]
+
+def osuVersions(song, filename, selectedBranch=None):
+	# Difficulty names and branches of a chart in a package, every branch of
+	# a branched song gets its own difficulty unless one was selected
+	filenameNoExt = os.path.splitext(os.path.basename(filename))[0]
+	suffix = filenameNoExt.partition("_")[2]
+	difficulty = difficultyNames.get(suffix.lower(), suffix or filenameNoExt)
+	if song["branches"] != True:
+		return [(difficulty, None)]
+	if selectedBranch in branchNames:
+		return [("{0} ({1})".format(difficulty, selectedBranch.capitalize()), selectedBranch)]
+	return [("{0} ({1})".format(difficulty, branch.capitalize()), branch) for branch in branchNames]
+
+def memberName(title, version):
+	name = "{0} [{1}].osu".format(title, version)
+	for char in "\\/:*?\"<>|":
+		name = name.replace(char, "_")
+	return name
+
+class OszWriter:
+	# Writes .osu files to .osz packages on a thread, so that a chart is
+	# compressed while the next one is parsed. A package is written until a
+	# member of another package is added, adding to it again later appends.
+	def __init__(self, queueSize=8):
+		import queue
+		import threading
+		
+		self.queue = queue.Queue(queueSize)
+		self.error = None
+		self.packages = []
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+	
+	def add(self, packagePath, name, contents=None, sourcePath=None):
+		# Contents are bytes, or a file on disk is copied in from sourcePath
+		if self.error:
+			raise self.error
+		self.queue.put((packagePath, name, contents, sourcePath))
+	
+	def run(self):
+		import zipfile
+		
+		package = None
+		packagePath = None
+		target = None
+		names = set()
+		while True:
+			item = self.queue.get()
+			if item == None:
+				break
+			if self.error:
+				continue
+			path, name, contents, sourcePath = item
+			try:
+				if path != packagePath:
+					if package:
+						package.close()
+						target.close()
+						package = None
+					# Packages are renamed into place once they are complete
+					if path in self.packages:
+						# The complete package stays in place until the
+						# appended copy replaces it
+						import shutil
+						
+						shutil.copyfile(path, path + journal.partExt)
+						target = journal.AtomicFile(path, "r+b")
+						package = zipfile.ZipFile(target, "a", zipfile.ZIP_DEFLATED)
+					else:
+						target = journal.AtomicFile(path)
+						package = zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED)
+					packagePath = path
+					names = set(package.namelist())
+					if path not in self.packages:
+						self.packages.append(path)
+				if name in names:
+					if sourcePath:
+						continue
+					base, ext = os.path.splitext(name)
+					number = 2
+					while "{0} ({1}){2}".format(base, number, ext) in names:
+						number += 1
+					name = "{0} ({1}){2}".format(base, number, ext)
+				names.add(name)
+				if sourcePath:
+					with phases.phase("osz.write", os.path.getsize(sourcePath)):
+						package.write(sourcePath, name)
+				else:
+					with phases.phase("osz.write", len(contents)):
+						with package.open(name, "w") as member:
+							member.write(contents)
+			except Exception as e:
+				self.error = e
+		if package:
+			try:
+				package.close()
+				if self.error:
+					target.discard()
+				else:
+					target.close()
+			except Exception as e:
+				self.error = self.error or e
+	
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+		if self.error:
+			raise self.error
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+		return False
+
+def writeOsz(writer, song, packagePath, inputFile, globalOffset=0, title=None, subtitle="", wave=None, selectedBranch=None):
+	# Adds every difficulty of a chart to a package, with the song's audio
+	# when it is next to the fumen file
+	filename = inputFile if type(inputFile) is str else inputFile.name
+	defaultTitle, defaultWave, defaultOutputFile = osuNames(os.path.basename(filename))
+	title = title or songId(filename)
+	wave = wave or defaultWave
+	versions = osuVersions(song, filename, selectedBranch)
+	outputBytes = 0
+	for version, branch in versions:
+		osuContents = buildOsu(song, globalOffset, title, subtitle, wave, branch, version)
+		writer.add(packagePath, memberName(title, version), osuContents)
+		outputBytes += len(osuContents)
+	wavePath = os.path.join(os.path.dirname(filename), wave)
+	if os.path.isfile(wavePath):
+		writer.add(packagePath, wave, sourcePath=wavePath)
+	return outputBytes
+
+@phases.timed("osu.format")
+def buildOsu(song, globalOffset=0, title="Song Title", subtitle="", wave="song.wav", selectedBranch=None, version=""):
 	if song["branches"] == True:
 		if selectedBranch not in branchNames:
 			selectedBranch = branchNames[-1]
@@ -202,9 +388,9 @@ TimelineZoom: 1
 	osu.append(b"TitleUnicode:" + bytes(title, "utf8"))
 	osu.append(b"Artist:" + bytes(subtitle, "utf8"))
 	osu.append(b"ArtistUnicode:" + bytes(subtitle, "utf8"))
-	osu.append(b"""Creator:
-Version:
-Source:
+	osu.append(b"Creator:")
+	osu.append(b"Version:" + bytes(version, "utf8"))
+	osu.append(b"""Source:
 Tags:
 
 [Difficulty]
@@ -283,22 +469,25 @@ SliderTickRate:4
 				), "ascii"))
 	osu.append(b"")
 	osuContents = b"\n".join(osu)
-	
-	if outputFile:
-		if type(outputFile) is str:
-			file = open(outputFile, "bw+")
-		else:
-			file = outputFile
-		if type(outputFile) is io.TextIOWrapper:
-			osuContents = osuContents.decode("utf-8")
-		try:
-			file.write(osuContents)
-		except UnicodeEncodeError as e:
-			print(e)
-		file.close()
-		return True
-	else:
-		return osuContents
+	phases.count("osu.format", len(osuContents), len(osu) - 1)
+	return osuContents
+
+def readChart(inputFile, order=None, debug=False, throughput=None):
+	# readFumen for batch runs, files that can't be read are counted in the
+	# metrics. An unknown note still only skips the file.
+	try:
+		song = readFumen(inputFile, order, debug)
+	except Exception as e:
+		if throughput:
+			throughput.fail(e)
+		raise
+	if not song and throughput:
+		throughput.fail(UnknownNoteError("Unknown note type in the fumen file"))
+	return song
+
+def measureStarts(song, globalOffset=0):
+	# Times of the measures in the .osu file, in ms
+	return [int(song[i]["offset"] - globalOffset * 1000.0) for i in range(song["length"])]
 
 def shortHex(number):
 	return hex(number)[2:]
@@ -322,21 +511,26 @@ def nameValue(*lists):
 def debugPrint(*args, **kwargs):
 	print(*args, file=sys.stderr, **kwargs)
 
-if __name__=="__main__":
+def main(argv=None, prog=None):
+	import argparse
+	
+	if argv == None:
+		argv = sys.argv[1:]
+	
 	parser = argparse.ArgumentParser(
+		prog=prog,
 		description="fumen2osu {0}".format(fumen2osu_version)
 	)
 	parser.add_argument(
 		"file_m.bin",
-		help="Path to a Taiko no Tatsujin fumen file.",
-		type=argparse.FileType("rb")
+		help="Paths to Taiko no Tatsujin fumen files.",
+		nargs="+"
 	)
 	parser.add_argument(
-		"offset",
-		help="Note offset in seconds, negative values will make the notes appear later. Example: -1.9",
-		nargs="?",
-		type=float,
-		default=0
+		"--offset",
+		metavar="-1.9",
+		help="Note offset in seconds, negative values will make the notes appear later. A number after the files is also taken as the offset.",
+		type=float
 	)
 	group = parser.add_mutually_exclusive_group()
 	group.add_argument(
@@ -356,8 +550,18 @@ if __name__=="__main__":
 	parser.add_argument(
 		"-o",
 		metavar="file.osu",
-		help="Set the filename of the output file.",
-		type=argparse.FileType("bw+")
+		help="Set the filename of the output file."
+	)
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument(
+		"--osz",
+		metavar="file.osz",
+		help="Write every chart to one .osz package."
+	)
+	group.add_argument(
+		"--osz-dir",
+		metavar="dir",
+		help="Write an .osz package for each song to a directory, with every difficulty and branch of the song."
 	)
 	parser.add_argument(
 		"--title",
@@ -386,10 +590,102 @@ if __name__=="__main__":
 		help="Print verbose debug information.",
 		action="store_true"
 	)
-	if len(sys.argv) == 1:
+	phases.addArguments(parser)
+	metrics.addArguments(parser)
+	verify.addArguments(parser)
+	journal.addArguments(parser)
+	if len(argv) == 0:
 		parser.print_help()
 	else:
-		args = parser.parse_args()
-		inputFile = getattr(args, "file_m.bin")
-		song = readFumen(inputFile, args.order, args.debug)
-		writeOsu(song, args.offset, args.title, args.subtitle, args.wave, args.branch, args.o, inputFile)
+		args = parser.parse_args(argv)
+		inputFiles = getattr(args, "file_m.bin")
+		# The offset can still be given as a number after the files
+		offset = args.offset or 0
+		if len(inputFiles) > 1 and not os.path.exists(inputFiles[-1]):
+			try:
+				offset = float(inputFiles[-1])
+				inputFiles = inputFiles[:-1]
+			except ValueError:
+				pass
+			else:
+				if args.offset != None:
+					parser.error("the offset was given both as --offset and after the files")
+		for inputFile in inputFiles:
+			try:
+				open(inputFile, "rb").close()
+			except OSError as e:
+				parser.error("argument file_m.bin: can't open '{0}': {1}".format(inputFile, e))
+		if args.o and (len(inputFiles) > 1 or args.osz or args.osz_dir):
+			parser.error("-o can only be used to convert one file to .osu")
+		if args.journal and (args.osz or args.osz_dir or args.verify or args.record):
+			parser.error("--journal records .osu files, it can't be used with --osz, --osz-dir, --verify or --record")
+		if args.resume and not args.journal:
+			parser.error("--resume needs a --journal")
+		manifest = verify.start(args)
+		phases.start(args)
+		reporter = metrics.start(args, len(inputFiles))
+		throughput = reporter and reporter.metrics
+		journalFile, records = journal.start(args)
+		try:
+			if args.osz or args.osz_dir:
+				if args.osz_dir:
+					if not manifest:
+						os.makedirs(args.osz_dir, exist_ok=True)
+					# Charts of the same song go to the package one after another
+					inputFiles = sorted(inputFiles, key=songId)
+				with verify.ManifestWriter(manifest) if manifest else OszWriter() as writer:
+					for number, inputFile in enumerate(inputFiles):
+						if throughput:
+							throughput.queue(len(inputFiles) - number - 1, 1)
+						with phases.profileFile(inputFile):
+							song = readChart(inputFile, args.order, args.debug, throughput)
+							if not song:
+								continue
+							if args.osz_dir:
+								packagePath = os.path.join(args.osz_dir, "{0}.osz".format(songId(inputFile)))
+							else:
+								packagePath = args.osz
+							outputBytes = writeOsz(writer, song, packagePath, inputFile, offset, args.title, args.subtitle, args.wave, args.branch)
+						if throughput:
+							throughput.done(1, os.path.getsize(inputFile), outputBytes, song["noteCount"])
+			else:
+				for number, inputFile in enumerate(inputFiles):
+					if throughput:
+						throughput.queue(len(inputFiles) - number - 1, 1)
+					title, wave, outputFile = osuNames(inputFile)
+					key = "osu " + os.path.abspath(inputFile)
+					if journal.finished(records.get(key), [os.path.abspath(inputFile)], [os.path.abspath(args.o or outputFile)]):
+						journal.removePart(args.o or outputFile)
+						if throughput:
+							throughput.skip()
+						continue
+					hashes = journalFile and journal.inputHashes([inputFile])
+					with phases.profileFile(inputFile):
+						song = readChart(inputFile, args.order, args.debug, throughput)
+						if not song:
+							continue
+						if manifest:
+							# Converted in memory, only the digests are kept
+							osuContents = writeOsu(song, offset, args.title or title, args.subtitle, args.wave or wave, args.branch)
+							manifest.add(args.o or outputFile, osuContents, measureStarts(song, offset))
+							outputBytes = len(osuContents)
+						else:
+							writeOsu(song, offset, args.title, args.subtitle, args.wave, args.branch, args.o, inputFile)
+							outputBytes = os.path.getsize(args.o or outputFile)
+					if journalFile:
+						journalFile.record(key, hashes, [os.path.abspath(args.o or outputFile)])
+					if throughput:
+						throughput.done(1, os.path.getsize(inputFile), outputBytes, song["noteCount"])
+			if throughput:
+				throughput.queue(0, 0)
+		finally:
+			if journalFile:
+				journalFile.close()
+			if reporter:
+				reporter.stop()
+			phases.finish(args)
+		if manifest and not manifest.finish():
+			return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,5 @@
+import sys
+
+from fumentools.cli import main
+
+sys.exit(main())
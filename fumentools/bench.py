@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import struct
+
+if not __package__:
+	# Run as a script from a checkout rather than the installed package
+	sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# End to end benchmark of the converters. A corpus like a game dump is
+# generated from a seed, so no game data is needed and two runs with the
+# same seed convert the same files. Every measurement runs in its own
+# interpreter, which keeps its peak RSS apart from the others.
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Kinds of input each converter is timed on, "dump" converts all of them
+converters = {
+	"fumen2osu": ("fumen",),
+	"konga2tja": ("konga",),
+	"lyrics2vtt": ("lyrics", "drp"),
+	"dump": None
+}
+difficulties = ("e", "n", "h", "m")
+noteTypes = (0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0x8, 0x9, 0xa, 0xb, 0xd)
+kongaNotes = (0x0, 0x0, 0x0, 0x0, 0x1, 0x3, 0x4, 0x6, 0xd, 0x10, 0x12, 0x13, 0x19)
+words = ("la", "na", "taiko", "don", "ka", "sora", "hoshi", "yume", "kaze", "hikari", "oto", "matsuri")
+
+def fumenChart(rng, measures, branches=False, order="<"):
+	# Measures have a BPM, offset and gogo flag, then the notes of the
+	# normal, advanced and master branches
+	out = bytearray(0x200)
+	out[0x1b0] = 1 if branches else 0
+	out += struct.pack(order + "II", measures, 0)
+	bpm = float(rng.choice((100, 120, 150, 180, 200)))
+	fumenOffset = 0.0
+	for measureNumber in range(measures):
+		if rng.random() < 0.05:
+			bpm = float(rng.choice((100, 120, 150, 180, 200, 240)))
+		gogo = 1 if measureNumber % 32 >= 24 else 0
+		out += struct.pack(order + "ffBBHiiiiiii", bpm, fumenOffset, gogo, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+		fumenOffset += 240000 / bpm
+		measureLength = 240000 / bpm
+		for branchNumber in range(3):
+			notes = rng.randint(0, 16) if branches or branchNumber == 0 else 0
+			out += struct.pack(order + "HHf", notes, 0, 1.0 if branchNumber == 0 else rng.choice((1.0, 1.2, 1.5)))
+			for noteNumber in range(notes):
+				noteType = rng.choice(noteTypes)
+				pos = measureLength * noteNumber / max(notes, 1)
+				out += struct.pack(order + "ififHHf", noteType, pos, 0, 0, 5 if noteType == 0xa else 1000, 400, measureLength / 4)
+				if noteType == 0x6 or noteType == 0x9:
+					out += bytes(8)
+	return bytes(out)
+
+def kongaChart(rng, measures):
+	out = bytearray(struct.pack(">I", 0x20030730))
+	framesPerMeasure = rng.choice((80, 96, 120, 144))
+	for measureNumber in range(measures):
+		if rng.random() < 0.05:
+			framesPerMeasure = rng.choice((80, 96, 120, 144))
+		out += struct.pack(">HBB", 100 + measureNumber * framesPerMeasure, measureNumber % 16 != 15, framesPerMeasure)
+		out += bytes(rng.choice(kongaNotes) for i in range(48))
+	out += struct.pack(">HBB", 0xffff, 0, 0)
+	return bytes(out)
+
+def lyricLines(rng, lines):
+	time = rng.uniform(1, 5)
+	for i in range(lines):
+		text = " ".join(rng.choice(words) for j in range(rng.randint(1, 4)))
+		yield time, text if rng.random() > 0.1 else ""
+		time += rng.uniform(1.5, 6)
+
+def lyricsBin(rng, lines, order="<"):
+	# 0x10 byte header with the line count, then 0x90 byte records: time,
+	# 0xc unused bytes and 0x80 bytes of text
+	out = bytearray(struct.pack(order + "I", lines) + bytes(0xc))
+	for time, text in lyricLines(rng, lines):
+		text = text.encode("utf-8")[:0x7f]
+		out += struct.pack(order + "f", time) + bytes(0xc) + text + bytes(0x80 - len(text))
+	return bytes(out)
+
+def lyricsXml(rng, lines):
+	from xml.sax.saxutils import escape
+	
+	sets = ["<DATA_SET><words>{}</words><wordsTime>{:.3f}</wordsTime></DATA_SET>".format(escape(text), time) for time, text in lyricLines(rng, lines)]
+	return "<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<DB_DATA>\n{}\n</DB_DATA>\n".format("\n".join(sets)).encode("utf-8")
+
+def lzss10(data):
+	# Greedy LZSS10 compression that matches against the last position of
+	# every 3 bytes, quick enough for fixtures and decompressed by lzss3
+	out = bytearray((0x10,)) + len(data).to_bytes(3, "little")
+	positions = {}
+	i = 0
+	size = len(data)
+	while i < size:
+		flagsPos = len(out)
+		out.append(0)
+		flags = 0
+		for bit in range(8):
+			if i >= size:
+				break
+			key = data[i:i + 3]
+			match = positions.get(key)
+			length = 0
+			if match != None and len(key) == 3 and i - match <= 0x1000:
+				while length < 18 and i + length < size and data[match + length] == data[i + length]:
+					length += 1
+			for j in range(i, i + max(length, 1)):
+				positions[data[j:j + 3]] = j
+			if length >= 3:
+				flags |= 0x80 >> bit
+				out += (((length - 3) << 12) | (i - match - 1)).to_bytes(2, "big")
+				i += length
+			else:
+				out.append(data[i])
+				i += 1
+		out[flagsPos] = flags
+	return bytes(out)
+
+def makeCorpus(path, songs=50, seed=0):
+	# Every song has four fumen charts, the oni one branched for a third of
+	# the songs and some of them compressed, three Donkey Konga courses, and
+	# lyrics as a raw .bin, a compressed .cbin or a DRP archive. Returns the
+	# number of files and their total size.
+	import random
+	from lyrics2vtt import drppack
+	
+	rng = random.Random(seed)
+	files = []
+	def write(name, data):
+		filePath = os.path.join(path, name)
+		os.makedirs(os.path.dirname(filePath), exist_ok=True)
+		with open(filePath, "wb") as file:
+			file.write(data)
+		files.append(len(data))
+	
+	for songNumber in range(songs):
+		song = "song{:04d}".format(songNumber)
+		order = "<" if songNumber % 2 else ">"
+		for level, difficulty in enumerate(difficulties):
+			branches = difficulty == "m" and songNumber % 3 == 0
+			chart = fumenChart(rng, rng.randint(60, 120) + level * 20, branches, order)
+			if songNumber % 5 == 4:
+				chart = lzss10(chart)
+			write(os.path.join("fumen", song, "{}_{}.bin".format(song, difficulty)), chart)
+		measures = rng.randint(60, 120)
+		for difficulty in ("e", "n", "h"):
+			write(os.path.join("konga", "k{:04d}_{}.bin".format(songNumber, difficulty)), kongaChart(rng, measures))
+		lines = rng.randint(20, 60)
+		if songNumber % 3 == 0:
+			write(os.path.join("lyrics", song + ".bin"), lyricsBin(rng, lines, order))
+		elif songNumber % 3 == 1:
+			write(os.path.join("lyrics", song + ".cbin"), lzss10(lyricsBin(rng, lines, order)))
+		else:
+			drpPath = os.path.join(path, "lyrics", song + ".drp")
+			os.makedirs(os.path.dirname(drpPath), exist_ok=True)
+			image = bytes(rng.randrange(256) for i in range(0x400))
+			drppack.packFiles(drpPath, [(song + ".xml", lyricsXml(rng, lines)), ("jacket", image)])
+			files.append(os.path.getsize(drpPath))
+	return len(files), sum(files)
+
+def outputPath(path, kind):
+	# Where a converter writes the output of a file when none is given
+	from fumen2osu import fumen2osu
+	from konga2tja import konga2tja
+	
+	if kind == "fumen":
+		return fumen2osu.osuNames(path)[2]
+	if kind == "konga":
+		return konga2tja.tjaFileName(path)
+	return os.path.splitext(path)[0] + ".vtt"
+
+def measure(converter, corpus, outDir, jobs=1, processes=False):
+	# Runs in its own interpreter, returns the wall and CPU time of the
+	# conversion and the peak RSS of the process and of its workers. Each
+	# converter runs through its main() on a copy of the corpus, and writes
+	# its outputs next to the inputs. Every row is timed from finding the
+	# files, which dump does itself, and a file counts as converted when
+	# its output is there.
+	import shutil
+	import time
+	from contextlib import redirect_stdout
+	from fumentools import dump
+	from fumentools.files import classify, scan
+	from fumen2osu import fumen2osu
+	from konga2tja import konga2tja
+	from lyrics2vtt import lyrics2vtt
+	
+	kinds = converters[converter]
+	copy = os.path.join(outDir, "corpus")
+	shutil.copytree(corpus, copy)
+	inputs = []
+	for path in scan(copy):
+		kind = classify(path)
+		if kind and (not kinds or kind in kinds):
+			inputs.append((path, kind))
+	with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+		start = time.perf_counter()
+		cpuStart = cpuTime()
+		if converter == "dump":
+			dump.main([copy, "-j", str(jobs)] + (["--processes"] if processes else []))
+		else:
+			paths = [path for path in scan(copy) if classify(path) in kinds]
+			if converter == "fumen2osu":
+				# It doesn't decompress LZSS charts, those count as failed
+				fumen2osu.main(paths)
+			elif converter == "konga2tja":
+				konga2tja.main(paths + ["--force"])
+			else:
+				# lyrics2vtt converts one file at a time
+				for path in paths:
+					try:
+						lyrics2vtt.main([path])
+					except Exception as e:
+						print("Error: '{}': {}".format(path, e), file=sys.stderr)
+		wall = time.perf_counter() - start
+		cpu = cpuTime() - cpuStart
+	rss, childRss = peakRss()
+	files = sum(1 for path, kind in inputs if os.path.exists(outputPath(path, kind)))
+	return {
+		"converter": converter,
+		"jobs": jobs,
+		"processes": processes,
+		"files": files,
+		"failed": len(inputs) - files,
+		"wall": wall,
+		"cpu": cpu,
+		"peakRss": rss,
+		"peakChildRss": childRss,
+		"filesPerSecond": files / wall if wall else None
+	}
+
+def cpuTime():
+	# User and system time of the process and of the workers it waited for
+	try:
+		import resource
+	except ImportError:
+		import time
+		
+		return time.process_time()
+	total = 0
+	for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+		usage = resource.getrusage(who)
+		total += usage.ru_utime + usage.ru_stime
+	return total
+
+def peakRss():
+	# In bytes, None where the resource module is missing
+	try:
+		import resource
+	except ImportError:
+		return None, None
+	scale = 1 if sys.platform == "darwin" else 1024
+	return (
+		resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+		resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+	)
+
+def runMeasure(converter, corpus, jobs, processes):
+	import json
+	import shutil
+	import subprocess
+	import tempfile
+	
+	outDir = tempfile.mkdtemp(prefix="fumen-tools-bench-")
+	try:
+		env = dict(os.environ)
+		env["PYTHONPATH"] = os.pathsep.join(filter(None, (rootDir, env.get("PYTHONPATH"))))
+		command = [sys.executable, "-m", "fumentools.bench", "measure", converter, corpus, outDir, "-j", str(jobs)]
+		if processes:
+			command.append("--processes")
+		process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+		if process.returncode != 0:
+			sys.stderr.write(process.stderr.decode("utf-8", "replace"))
+			process.check_returncode()
+		return json.loads(process.stdout)
+	finally:
+		shutil.rmtree(outDir, ignore_errors=True)
+
+def benchmark(corpus, jobList=(1, 2, 4), repeat=1, selected=tuple(converters)):
+	# The standalone converters run serially, dump runs serially and then
+	# in worker processes for every job count above 1. The fastest of the
+	# repeats is kept.
+	for converter in selected:
+		for jobs in (jobList if converter == "dump" else (1,)):
+			best = None
+			for i in range(repeat):
+				result = runMeasure(converter, corpus, jobs, jobs > 1)
+				if best == None or result["wall"] < best["wall"]:
+					best = result
+			yield best
+
+def compare(old, new, threshold=0.1):
+	# Pairs up the results of two runs, returns (key, old, new, regressions)
+	# where regressions names what got worse by more than the threshold
+	previous = {(result["converter"], result["jobs"]): result for result in old["results"]}
+	rows = []
+	for result in new["results"]:
+		key = (result["converter"], result["jobs"])
+		before = previous.get(key)
+		if not before:
+			continue
+		regressions = []
+		# None when a run took no measurable time
+		if before["filesPerSecond"] and result["filesPerSecond"] != None and result["filesPerSecond"] < before["filesPerSecond"] * (1 - threshold):
+			regressions.append("files/s")
+		if before["cpu"] and result["cpu"] > before["cpu"] * (1 + threshold):
+			regressions.append("cpu")
+		for name in ("peakRss", "peakChildRss"):
+			if before.get(name) and result.get(name) and result[name] > before[name] * (1 + threshold):
+				regressions.append(name)
+		if result["failed"] > before["failed"] or result["files"] < before["files"]:
+			regressions.append("files")
+		rows.append((key, before, result, regressions))
+	return rows
+
+def change(before, after):
+	if not before or after == None:
+		return ""
+	return "{:+.1f}%".format((after / before - 1) * 100)
+
+def main(argv=None, prog=None):
+	import argparse
+	import json
+	
+	if argv == None:
+		argv = sys.argv[1:]
+	
+	parser = argparse.ArgumentParser(
+		prog=prog,
+		description="Benchmarks the converters on a generated corpus"
+	)
+	subparsers = parser.add_subparsers(dest="command", metavar="command")
+	
+	corpus = subparsers.add_parser("corpus", help="Generate a corpus")
+	corpus.add_argument(
+		"path",
+		help="Directory to write the corpus to"
+	)
+	run = subparsers.add_parser("run", help="Time every converter on a corpus")
+	run.add_argument(
+		"--corpus",
+		metavar="path",
+		help="Corpus to convert, by default one is generated in a temporary directory."
+	)
+	run.add_argument(
+		"-o",
+		metavar="results.json",
+		help="Write the results as JSON to a file, or '-' for stdout."
+	)
+	run.add_argument(
+		"-j", "--jobs",
+		metavar="1,2,4",
+		help="Comma separated worker counts, 1 runs serially. Default is 1, 2, 4 and the number of cores.",
+		type=lambda arg: sorted(set(int(jobs) for jobs in arg.split(",") if jobs.strip()))
+	)
+	run.add_argument(
+		"--converter",
+		metavar="dump",
+		help="Only time these converters, comma separated from {}.".format(", ".join(converters)),
+		type=lambda arg: [name.strip() for name in arg.split(",") if name.strip()],
+		default=list(converters)
+	)
+	run.add_argument(
+		"--repeat",
+		metavar="1",
+		help="Time each converter this many times and keep the fastest.",
+		type=int,
+		default=1
+	)
+	for subparser in (corpus, run):
+		subparser.add_argument(
+			"--songs",
+			metavar="50",
+			help="Songs in a generated corpus, each has 4 fumen charts, 3 Donkey Konga courses and lyrics.",
+			type=int,
+			default=50
+		)
+		subparser.add_argument(
+			"--seed",
+			metavar="0",
+			type=int,
+			default=0
+		)
+	
+	compareParser = subparsers.add_parser("compare", help="Flag regressions between two result files")
+	compareParser.add_argument("old", help="Results of the baseline run")
+	compareParser.add_argument("new", help="Results to check")
+	compareParser.add_argument(
+		"--threshold",
+		metavar="0.1",
+		help="Fraction that files/s, CPU time or peak RSS can get worse by, default is 0.1.",
+		type=float,
+		default=0.1
+	)
+	
+	measureParser = subparsers.add_parser("measure", help="Time one converter, run in its own interpreter by 'run'")
+	measureParser.add_argument("converter", choices=tuple(converters))
+	measureParser.add_argument("corpus")
+	measureParser.add_argument("outDir")
+	measureParser.add_argument("-j", "--jobs", type=int, default=1)
+	measureParser.add_argument("--processes", action="store_true")
+	
+	if len(argv) == 0:
+		parser.print_help()
+		return
+	args = parser.parse_args(argv)
+	if not args.command:
+		parser.error("a command is required")
+	
+	if args.command == "corpus":
+		files, size = makeCorpus(args.path, args.songs, args.seed)
+		print("Generated {} files, {:.1f} MB".format(files, size / 1e6), file=sys.stderr)
+		return
+	
+	if args.command == "measure":
+		json.dump(measure(args.converter, args.corpus, args.outDir, args.jobs, args.processes), sys.stdout)
+		return
+	
+	if args.command == "compare":
+		with open(args.old, "r") as file:
+			old = json.load(file)
+		with open(args.new, "r") as file:
+			new = json.load(file)
+		if old.get("corpus") != new.get("corpus"):
+			print("Warning: the runs used different corpora", file=sys.stderr)
+		print("{:<12}{:>6}{:>12}{:>12}{:>10}{:>10}{:>10}  {}".format("converter", "jobs", "old files/s", "new files/s", "files/s", "cpu", "rss", "regressions"))
+		regressed = False
+		for (converter, jobs), before, after, regressions in compare(old, new, args.threshold):
+			print("{:<12}{:>6}{:>12.1f}{:>12.1f}{:>10}{:>10}{:>10}  {}".format(
+				converter,
+				jobs,
+				before["filesPerSecond"] or 0,
+				after["filesPerSecond"] or 0,
+				change(before["filesPerSecond"], after["filesPerSecond"]),
+				change(before["cpu"], after["cpu"]),
+				change(before.get("peakRss"), after.get("peakRss")),
+				", ".join(regressions)
+			))
+			regressed = regressed or bool(regressions)
+		return 1 if regressed else 0
+	
+	import platform
+	import shutil
+	import tempfile
+	import time
+	
+	for converter in args.converter:
+		if converter not in converters:
+			parser.error("Unknown converter: '{}', choose from {}".format(converter, ", ".join(converters)))
+	jobList = args.jobs or sorted(set((1, 2, 4, os.cpu_count() or 1)))
+	tempDir = None
+	if args.corpus:
+		corpusPath = args.corpus
+		corpusInfo = {"path": os.path.abspath(corpusPath)}
+	else:
+		tempDir = tempfile.mkdtemp(prefix="fumen-tools-corpus-")
+		corpusPath = tempDir
+		corpusInfo = {"songs": args.songs, "seed": args.seed}
+	try:
+		if tempDir:
+			makeCorpus(corpusPath, args.songs, args.seed)
+		paths = [os.path.join(dirPath, fileName) for dirPath, dirNames, fileNames in os.walk(corpusPath) for fileName in fileNames]
+		corpusInfo["files"] = len(paths)
+		corpusInfo["bytes"] = sum(os.path.getsize(path) for path in paths)
+		results = []
+		print("{:<12}{:>6}{:>8}{:>10}{:>10}{:>12}{:>10}".format("converter", "jobs", "files", "wall", "cpu", "files/s", "rss MB"), file=sys.stderr)
+		for result in benchmark(corpusPath, jobList, args.repeat, args.converter):
+			results.append(result)
+			print("{:<12}{:>6}{:>8}{:>10.3f}{:>10.3f}{:>12.1f}{:>10}".format(
+				result["converter"],
+				result["jobs"],
+				result["files"],
+				result["wall"],
+				result["cpu"],
+				result["filesPerSecond"] or 0,
+				"{:.1f}".format(max(result["peakRss"], result["peakChildRss"]) / 1e6) if result["peakRss"] else ""
+			), file=sys.stderr)
+	finally:
+		if tempDir:
+			shutil.rmtree(tempDir, ignore_errors=True)
+	
+	report = {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"implementation": platform.python_implementation(),
+		"machine": platform.machine(),
+		"cpus": os.cpu_count(),
+		"corpus": corpusInfo,
+		"repeat": args.repeat,
+		"results": results
+	}
+	if args.o == "-":
+		json.dump(report, sys.stdout, indent=2)
+		print()
+	elif args.o:
+		with open(args.o, "w") as file:
+			json.dump(report, file, indent=2)
+			file.write("\n")
+
+if __name__ == "__main__":
+	sys.exit(main())
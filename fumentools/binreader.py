@@ -0,0 +1,160 @@
+import os
+import struct
+
+# struct.Struct instances shared by every reader, one dict per byte order
+structCache = {}
+
+def getStruct(format, order=">"):
+	if format[:1] in ("<", ">", "!", "=", "@"):
+		order = ""
+	structs = structCache.setdefault(order, {})
+	try:
+		return structs[format]
+	except KeyError:
+		structs[format] = struct.Struct(order + format)
+		return structs[format]
+
+class BinReader:
+	# File-like reader over a bytes-like object or a mapped file. Values are
+	# unpacked in place and read() returns memoryview slices, so nothing is
+	# copied out of the buffer.
+	def __init__(self, data, order=">"):
+		self.data = data
+		self.view = memoryview(data).cast("B")
+		self.size = len(self.view)
+		self.pos = 0
+		self.order = order
+		self.mmap = None
+		self.file = None
+		self.name = ""
+	
+	@classmethod
+	def open(cls, inputFile, order=">"):
+		# Accepts a path, a file object, a bytes-like object or a reader
+		if isinstance(inputFile, BinReader):
+			return inputFile
+		if type(inputFile) is str:
+			reader = cls.fromFile(open(inputFile, "rb"), order)
+			reader.file.close()
+			reader.file = None
+			return reader
+		if hasattr(inputFile, "read"):
+			return cls.fromFile(inputFile, order)
+		return cls(inputFile, order)
+	
+	@classmethod
+	def fromFile(cls, file, order=">", mapOnly=False):
+		# Regular files are mapped, anything that can't be mapped is read,
+		# or with mapOnly left to the caller by returning None
+		import mmap
+		import io
+		
+		try:
+			buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+			buffer = None
+		if buffer == None:
+			if mapOnly:
+				return None
+			if file.seekable():
+				file.seek(0)
+			reader = cls(file.read(), order)
+		else:
+			reader = cls(buffer, order)
+			reader.mmap = buffer
+		reader.file = file
+		reader.name = getattr(file, "name", "")
+		return reader
+	
+	@property
+	def order(self):
+		return self._order
+	
+	@order.setter
+	def order(self, order):
+		self._order = order
+		self.structs = structCache.setdefault(order, {})
+	
+	def struct(self, format):
+		try:
+			return self.structs[format]
+		except KeyError:
+			return getStruct(format, self.order)
+	
+	def unpack(self, format, seek=None):
+		if seek != None:
+			self.pos = seek
+		structFormat = self.struct(format)
+		values = structFormat.unpack_from(self.view, self.pos)
+		self.pos += structFormat.size
+		return values
+	
+	def unpackFrom(self, format, offset):
+		return self.struct(format).unpack_from(self.view, offset)
+	
+	def iterUnpack(self, format, count, seek=None):
+		# Unpacks count fixed size records in bulk, stopping early at the
+		# last whole record in the buffer
+		if seek != None:
+			self.pos = seek
+		structFormat = self.struct(format)
+		count = max(0, min(count, (self.size - self.pos) // structFormat.size))
+		end = self.pos + count * structFormat.size
+		records = structFormat.iter_unpack(self.view[self.pos:end])
+		self.pos = end
+		return records
+	
+	def find(self, sub, start=0, end=None):
+		# bytes, bytearray and mmap search in place, other buffers are
+		# searched through a copy of the range
+		if end == None or end > self.size:
+			end = self.size
+		if hasattr(self.data, "find"):
+			return self.data.find(sub, start, end)
+		index = bytes(self.view[start:end]).find(sub)
+		return index if index == -1 else start + index
+	
+	def read(self, size=-1):
+		start = min(self.pos, self.size)
+		if size < 0:
+			self.pos = self.size
+		else:
+			self.pos = min(start + size, self.size)
+		return self.view[start:self.pos]
+	
+	def seek(self, target, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			target += self.pos
+		elif whence == os.SEEK_END:
+			target += self.size
+		self.pos = max(0, target)
+		return self.pos
+	
+	def tell(self):
+		return self.pos
+	
+	def close(self):
+		self.data = None
+		if self.view != None:
+			self.view.release()
+			self.view = None
+		if self.mmap:
+			try:
+				self.mmap.close()
+			except BufferError:
+				# Slices handed out by read() are still in use, the map is
+				# freed along with them
+				pass
+			self.mmap = None
+		if self.file:
+			self.file.close()
+			self.file = None
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+	
+	def __len__(self):
+		return self.size
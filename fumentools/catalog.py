@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+if not __package__:
+	# Run as a script from a checkout rather than the installed package
+	sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fumentools import files
+from fumentools.journal import fileHash
+
+# Every file in a dump gets a row, files the tools can't read have the kind
+# "other" so they aren't hashed again on the next update
+columns = (
+	("path", "TEXT PRIMARY KEY"),
+	("kind", "TEXT"),
+	("size", "INTEGER"),
+	("mtime", "INTEGER"),
+	("hash", "TEXT"),
+	("byteOrder", "TEXT"),
+	("measures", "INTEGER"),
+	("branches", "INTEGER"),
+	("bpmMin", "REAL"),
+	("bpmMax", "REAL"),
+	("notesNormal", "INTEGER"),
+	("notesAdvanced", "INTEGER"),
+	("notesMaster", "INTEGER"),
+	("scoreInit", "INTEGER"),
+	("scoreDiff", "REAL"),
+	("lines", "INTEGER"),
+	("timeStart", "REAL"),
+	("timeEnd", "REAL"),
+	("error", "TEXT")
+)
+columnNames = tuple(name for name, type in columns)
+indexes = (
+	("filesKind", "kind"),
+	("filesBranchesBpm", "branches, bpmMax"),
+	("filesBpm", "bpmMax"),
+	("filesLines", "lines"),
+	("filesHash", "hash")
+)
+batchSize = 500
+
+def fumenStats(song):
+	bpms = [song[i]["bpm"] for i in range(song["length"])]
+	row = {
+		"byteOrder": song["byteOrder"],
+		"measures": song["length"],
+		"branches": 1 if song["branches"] == True else 0,
+		"bpmMin": min(bpms, default=None),
+		"bpmMax": max(bpms, default=None),
+		"scoreInit": song.get("scoreInit"),
+		"scoreDiff": song.get("scoreDiff")
+	}
+	for branchName in ("normal", "advanced", "master"):
+		row["notes" + branchName.capitalize()] = sum(song[i][branchName]["length"] for i in range(song["length"]))
+	return row
+
+def kongaStats(tja):
+	lines = tja["chart"].split("\n")
+	bpms = [float(line.split(" ")[1]) for line in lines if line.startswith("#BPMCHANGE ")]
+	if tja["bpm"]:
+		bpms.append(tja["bpm"])
+	return {
+		"measures": sum(1 for line in lines if line.endswith(",")),
+		"bpmMin": min(bpms, default=None),
+		"bpmMax": max(bpms, default=None)
+	}
+
+def lyricsStats(lyrics):
+	times = [lyric["time"] for lyric in lyrics]
+	return {
+		"lines": len(times),
+		"timeStart": min(times, default=None),
+		"timeEnd": max(times, default=None)
+	}
+
+def catalogFile(item):
+	# Runs in a worker, returns the row of a file or only its path and hash
+	# when the contents match the hash that is already in the catalog
+	path, size, mtime, knownHash = item
+	row = {name: None for name in columnNames}
+	row.update(path=path, size=size, mtime=mtime)
+	try:
+		row["hash"] = fileHash(path)
+		if row["hash"] == knownHash:
+			return path, row["hash"], None
+		row["kind"] = files.classify(path) or "other"
+		if row["kind"] == "fumen":
+			from fumen2osu import fumen2osu
+			
+			song = fumen2osu.readFumen(files.readData(path))
+			if not song:
+				raise fumen2osu.UnknownNoteError("Unknown note type in the fumen file")
+			row.update(fumenStats(song))
+		elif row["kind"] == "konga":
+			from contextlib import redirect_stdout
+			from konga2tja import konga2tja
+			
+			# Unknown notes are printed as they are found
+			with redirect_stdout(None):
+				row.update(kongaStats(konga2tja.parseBin(path, True)))
+		elif row["kind"] == "lyrics" or row["kind"] == "drp":
+			from lyrics2vtt import lyrics2vtt
+			
+			with open(path, "rb") as file:
+				row.update(lyricsStats(lyrics2vtt.readLyrics(file)))
+	except Exception as e:
+		errorType = type(e).__name__
+		if type(e).__module__ != "builtins":
+			errorType = type(e).__module__ + "." + errorType
+		row["error"] = "{}: {}".format(errorType, e)
+	return path, row["hash"], row
+
+class Catalog:
+	def __init__(self, path):
+		import sqlite3
+		
+		self.db = sqlite3.connect(path)
+		self.db.execute("CREATE TABLE IF NOT EXISTS files ({})".format(
+			", ".join("{} {}".format(name, type) for name, type in columns)
+		))
+		for name, indexColumns in indexes:
+			self.db.execute("CREATE INDEX IF NOT EXISTS {} ON files ({})".format(name, indexColumns))
+		self.db.commit()
+	
+	def known(self):
+		return {path: (size, mtime, hash) for path, size, mtime, hash in self.db.execute("SELECT path, size, mtime, hash FROM files")}
+	
+	def update(self, root, jobs=1, prune=True, progress=None):
+		# Files are only hashed when their size or mtime changed, and only
+		# parsed again when their hash changed. Returns the number of files
+		# that were parsed, touched and removed.
+		known = self.known()
+		root = os.path.abspath(root)
+		seen = set()
+		items = []
+		for path in files.scan(root):
+			stat = os.stat(path)
+			seen.add(path)
+			previous = known.get(path)
+			if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+				continue
+			items.append((path, stat.st_size, stat.st_mtime_ns, previous[2] if previous else None))
+		
+		if jobs > 1 and len(items) > 1:
+			from concurrent.futures import ProcessPoolExecutor
+			
+			executor = ProcessPoolExecutor(jobs)
+			results = executor.map(catalogFile, items, chunksize=max(1, min(64, len(items) // (jobs * 4))))
+		else:
+			executor = None
+			results = map(catalogFile, items)
+		
+		parsed = 0
+		touched = 0
+		rows = []
+		stats = {}
+		insert = "INSERT OR REPLACE INTO files VALUES ({})".format(", ".join("?" * len(columnNames)))
+		try:
+			for item, (path, hash, row) in zip(items, results):
+				if row:
+					rows.append(tuple(row[name] for name in columnNames))
+					parsed += 1
+				else:
+					stats[path] = (item[1], item[2])
+					touched += 1
+				if progress:
+					progress(path, row)
+				if len(rows) + len(stats) >= batchSize:
+					self.write(insert, rows, stats)
+					rows = []
+					stats = {}
+			self.write(insert, rows, stats)
+		finally:
+			if executor:
+				executor.shutdown()
+		
+		removed = 0
+		if prune:
+			prefix = os.path.join(root, "")
+			gone = [(path,) for path in known if (path == root or path.startswith(prefix)) and path not in seen]
+			with self.db:
+				self.db.executemany("DELETE FROM files WHERE path = ?", gone)
+			removed = len(gone)
+		return parsed, touched, removed
+	
+	def write(self, insert, rows, stats):
+		# One transaction for each batch
+		with self.db:
+			self.db.executemany(insert, rows)
+			self.db.executemany("UPDATE files SET size = ?, mtime = ? WHERE path = ?", [
+				(size, mtime, path) for path, (size, mtime) in stats.items()
+			])
+	
+	def query(self, where=(), parameters=(), select=columnNames, order=None, limit=None):
+		sql = "SELECT {} FROM files".format(", ".join(select))
+		if where:
+			sql += " WHERE " + " AND ".join("({})".format(condition) for condition in where)
+		if order:
+			sql += " ORDER BY " + order
+		if limit:
+			sql += " LIMIT {:d}".format(limit)
+		return self.db.execute(sql, parameters)
+	
+	def close(self):
+		self.db.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+		return False
+
+def columnList(arg):
+	import argparse
+	
+	names = [name.strip() for name in arg.split(",") if name.strip()]
+	for name in names:
+		if name not in columnNames:
+			raise argparse.ArgumentTypeError("Unknown column: '{}', choose from {}".format(name, ", ".join(columnNames)))
+	return names
+
+def orderColumn(arg):
+	import argparse
+	
+	name, sep, direction = arg.partition(" ")
+	if name not in columnNames or direction.lower() not in ("", "asc", "desc"):
+		raise argparse.ArgumentTypeError("Expected a column, optionally followed by asc or desc")
+	return arg
+
+def condition(arg):
+	# "column op value", the column and operator are checked here and the
+	# value is bound as a parameter, "null" matches empty columns
+	import argparse
+	import re
+	
+	match = re.fullmatch(r"\s*(\w+)\s*(<=|>=|!=|=|<|>)\s*(.*?)\s*", arg)
+	if not match or match.group(1) not in columnNames:
+		raise argparse.ArgumentTypeError("Expected a column, an operator (= != < <= > >=) and a value, like 'measures>=100'")
+	name, operator, value = match.groups()
+	if value.lower() == "null":
+		if operator not in ("=", "!="):
+			raise argparse.ArgumentTypeError("null can only be compared with = or !=")
+		return name, "IS" if operator == "=" else "IS NOT", None
+	type = dict(columns)[name]
+	try:
+		if type == "INTEGER":
+			value = int(value)
+		elif type == "REAL":
+			value = float(value)
+	except ValueError:
+		raise argparse.ArgumentTypeError("Expected a number for {}: '{}'".format(name, value))
+	return name, operator, value
+
+def main(argv=None, prog=None):
+	import argparse
+	
+	if argv == None:
+		argv = sys.argv[1:]
+	
+	parser = argparse.ArgumentParser(
+		prog=prog,
+		description="Keeps a catalog of the charts and lyrics in a dump, and queries it"
+	)
+	parser.add_argument(
+		"--db",
+		metavar="catalog.db",
+		help="Path to the catalog, default is 'catalog.db'.",
+		default="catalog.db"
+	)
+	subparsers = parser.add_subparsers(dest="command", metavar="command")
+	
+	update = subparsers.add_parser("update", help="Add new and changed files in a dump to the catalog")
+	update.add_argument(
+		"path",
+		help="Path to the dump, searched recursively"
+	)
+	update.add_argument(
+		"-j", "--jobs",
+		metavar="0",
+		help="Parse files in this many processes, default is 0, which uses every core.",
+		type=int,
+		default=0
+	)
+	update.add_argument(
+		"--keep",
+		help="Keep the rows of files that are no longer in the dump.",
+		action="store_true"
+	)
+	update.add_argument(
+		"-v", "--verbose",
+		help="Print every file that gets parsed.",
+		action="store_true"
+	)
+	
+	query = subparsers.add_parser("query", help="Print the files matching all of the filters")
+	query.add_argument(
+		"--kind",
+		help="Only files of a kind: fumen, konga, lyrics, drp or other.",
+		choices=("fumen", "konga", "lyrics", "drp", "other")
+	)
+	query.add_argument(
+		"--branched",
+		help="Only charts with branches.",
+		action="store_true"
+	)
+	query.add_argument(
+		"--min-bpm",
+		metavar="BPM",
+		help="Only charts that reach this BPM.",
+		type=float
+	)
+	query.add_argument(
+		"--max-bpm",
+		metavar="BPM",
+		help="Only charts that never go above this BPM.",
+		type=float
+	)
+	query.add_argument(
+		"--min-lines",
+		metavar="N",
+		help="Only lyrics with at least this many lines.",
+		type=int
+	)
+	query.add_argument(
+		"--errors",
+		help="Only files that could not be parsed.",
+		action="store_true"
+	)
+	query.add_argument(
+		"--where",
+		metavar="CONDITION",
+		help="Any other condition on a column, like 'measures>=100' or 'error!=null'. Can be given more than once.",
+		type=condition,
+		action="append",
+		default=[]
+	)
+	query.add_argument(
+		"--columns",
+		metavar="path,kind",
+		help="Comma separated columns to print, default is all of them.",
+		type=columnList,
+		default=list(columnNames)
+	)
+	query.add_argument(
+		"--order",
+		metavar="column",
+		help="Sort by a column, add ' desc' for descending.",
+		type=orderColumn
+	)
+	query.add_argument(
+		"--limit",
+		metavar="N",
+		type=int
+	)
+	query.add_argument(
+		"--count",
+		help="Only print the number of matching files.",
+		action="store_true"
+	)
+	if len(argv) == 0:
+		parser.print_help()
+		return
+	args = parser.parse_args(argv)
+	if not args.command:
+		parser.error("a command is required")
+	
+	with Catalog(args.db) as catalog:
+		if args.command == "update":
+			if not os.path.exists(args.path):
+				parser.error("Path not found: '{}'".format(args.path))
+			jobs = max(args.jobs, 0) or os.cpu_count() or 1
+			def progress(path, row):
+				if args.verbose and row:
+					print("{}\t{}".format(row["kind"], path), file=sys.stderr)
+			parsed, touched, removed = catalog.update(args.path, jobs, not args.keep, progress)
+			print("{} parsed, {} unchanged, {} removed".format(parsed, touched, removed), file=sys.stderr)
+			return
+		
+		where = []
+		parameters = []
+		for name, operator, value in args.where:
+			if value == None:
+				where.append("{} {} NULL".format(name, operator))
+			else:
+				where.append("{} {} ?".format(name, operator))
+				parameters.append(value)
+		if args.kind:
+			where.append("kind = ?")
+			parameters.append(args.kind)
+		if args.branched:
+			where.append("branches = 1")
+		if args.min_bpm != None:
+			where.append("bpmMax >= ?")
+			parameters.append(args.min_bpm)
+		if args.max_bpm != None:
+			where.append("bpmMax <= ?")
+			parameters.append(args.max_bpm)
+		if args.min_lines != None:
+			where.append("lines >= ?")
+			parameters.append(args.min_lines)
+		if args.errors:
+			where.append("error IS NOT NULL")
+		if args.count:
+			print(catalog.query(where, parameters, ["COUNT(*)"]).fetchone()[0])
+			return
+		print("\t".join(args.columns))
+		for row in catalog.query(where, parameters, args.columns, args.order, args.limit):
+			print("\t".join("" if value == None else str(value) for value in row))
+
+if __name__ == "__main__":
+	main()
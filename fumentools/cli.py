@@ -0,0 +1,45 @@
+import sys
+
+# Tools are only imported once their subcommand is picked, so starting the
+# CLI costs no more than the one tool that runs
+commands = {
+	"fumen2osu": ("fumen2osu.fumen2osu", "Converts .bin fumen files to .osu"),
+	"konga2tja": ("konga2tja.konga2tja", "Converts Donkey Konga 1 .bin files to .tja"),
+	"lyrics2vtt": ("lyrics2vtt.lyrics2vtt", "Converts .bin, .cbin, and .drp lyrics files to .vtt"),
+	"drpextract": ("lyrics2vtt.drpextract", "Extracts the files in a .drp archive"),
+	"lzss": ("lyrics2vtt.lzss3", "Decompresses LZSS10 and LZSS11 files to stdout"),
+	"dump": ("fumentools.dump", "Converts every file in a game dump in one pass"),
+	"fingerprint": ("fumentools.fingerprint", "Finds duplicate fumen and Donkey Konga charts"),
+	"catalog": ("fumentools.catalog", "Keeps a searchable catalog of the files in a dump"),
+	"bench": ("fumentools.bench", "Benchmarks the converters on a generated corpus")
+}
+
+def printUsage(file=sys.stdout):
+	print("usage: fumen-tools <command> [args...]", file=file)
+	print("", file=file)
+	print("Tools for Taiko no Tatsujin files", file=file)
+	print("", file=file)
+	print("commands:", file=file)
+	for name, (module, description) in commands.items():
+		print("  {:<13}{}".format(name, description), file=file)
+	print("", file=file)
+	print("Run 'fumen-tools <command> --help' for the options of a command.", file=file)
+
+def main(argv=None):
+	if argv == None:
+		argv = sys.argv[1:]
+	if len(argv) == 0 or argv[0] in ("-h", "--help"):
+		printUsage()
+		return 0
+	command = argv[0]
+	if command not in commands:
+		print("fumen-tools: unknown command '{}'".format(command), file=sys.stderr)
+		printUsage(sys.stderr)
+		return 2
+	
+	# __import__ rather than importlib, which would import warnings and
+	# hide the tool from -X importtime
+	name = commands[command][0]
+	__import__(name)
+	module = sys.modules[name]
+	return module.main(argv[1:], "fumen-tools " + command)
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+
+if not __package__:
+	# Run as a script from a checkout rather than the installed package
+	sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fumentools import phases
+from fumentools import metrics
+from fumentools import verify
+from fumentools import journal
+from fumentools.files import classify, readData, scan
+
+# Stages in the order they run for a file, DRP archives feed the lyrics stage
+stages = ("drp", "lyrics", "osu", "tja")
+# Every task returns its result with the number of records it converted,
+# notes for charts and lines for lyrics, which are counted in the metrics
+
+def extractDrp(path, extractDir=None, ext="bin"):
+	# Returns the first entry, which is where lyrics are kept, and writes
+	# every entry out when extracting
+	from lyrics2vtt import drpextract
+	
+	with drpextract.DrpArchive(path) as archive:
+		if not len(archive):
+			return None, 0
+		if extractDir:
+			os.makedirs(extractDir, exist_ok=True)
+			names = drpextract.outputPaths(archive.toc, "", ext)
+			for index, outFileName in enumerate(names):
+				drpextract.writeEntry(archive.open(index), os.path.join(extractDir, outFileName))
+		return archive.read(0), 0
+
+def countLines(lyrics, counter):
+	for line in lyrics:
+		counter[0] += 1
+		yield line
+
+def digests(outputs, starts=None):
+	# In memory runs return the digests of their outputs instead of writing
+	# them, the manifest is checked where the results are collected
+	from fumentools import verify
+	
+	return {outputFile: verify.digest(outputFile, output, starts) for outputFile, output in outputs.items() if output}
+
+def convertDrpLyrics(outputFiles, formats, inMemory, data):
+	from lyrics2vtt import lyrics2vtt
+	
+	if data == None:
+		return False, 0
+	lines = [0]
+	lyrics = countLines(lyrics2vtt.parseXml((data,)), lines)
+	if inMemory:
+		results = lyrics2vtt.writeFormats(lyrics, formats)
+		return digests({outputFiles[format]: results[format] for format in formats}), lines[0]
+	return any(lyrics2vtt.writeFormats(lyrics, formats, outputFiles).values()), lines[0]
+
+def convertLyrics(path, outputFiles, formats, inMemory=False):
+	from lyrics2vtt import lyrics2vtt
+	
+	lines = [0]
+	with open(path, "rb") as file:
+		lyrics = countLines(lyrics2vtt.readLyrics(file), lines)
+		if inMemory:
+			results = lyrics2vtt.writeFormats(lyrics, formats)
+			return digests({outputFiles[format]: results[format] for format in formats}), lines[0]
+		return any(lyrics2vtt.writeFormats(lyrics, formats, outputFiles).values()), lines[0]
+
+def convertFumen(path, outputFile, offset=0, index=None, duplicates="link", inMemory=False):
+	from fumen2osu import fumen2osu
+	
+	song = fumen2osu.readFumen(readData(path))
+	if not song:
+		raise fumen2osu.UnknownNoteError("Unknown note type in the fumen file")
+	if inMemory:
+		title, wave, defaultOutputFile = fumen2osu.osuNames(os.path.split(path)[1])
+		return digests({outputFile: fumen2osu.buildOsu(song, offset, title, "", wave)}, fumen2osu.measureStarts(song, offset)), song["noteCount"]
+	entry = index and indexEntry(path, "fumen", song)
+	if entry and linkDuplicate(index, duplicates, entry, outputFile):
+		return True, song["noteCount"]
+	title, wave, defaultOutputFile = fumen2osu.osuNames(os.path.split(path)[1])
+	with journal.AtomicFile(outputFile) as file:
+		file.write(fumen2osu.buildOsu(song, offset, title, "", wave))
+	if entry:
+		addToIndex(index, entry, outputFile)
+	return True, song["noteCount"]
+
+def convertKonga(paths, outputFile, force=False, index=None, duplicates="link", inMemory=False):
+	from konga2tja import konga2tja
+	
+	name = os.path.splitext(os.path.split(outputFile)[1])[0]
+	courses = []
+	output = konga2tja.buildTja(name, paths, force, courses=courses)
+	notes = sum(course["notes"] for course in courses)
+	if inMemory:
+		return digests({outputFile: output}), notes
+	# Songs are in the index under their TJA file, like fingerprint has them
+	entry = index and indexEntry(konga2tja.tjaFileName(paths[0]), "konga", output)
+	if entry and linkDuplicate(index, duplicates, entry, outputFile):
+		return True, notes
+	with journal.AtomicFile(outputFile, "w") as file:
+		file.write(output)
+	if entry:
+		addToIndex(index, entry, outputFile)
+	return True, notes
+
+def indexEntry(path, kind, chart):
+	from fumentools import fingerprint
+	
+	if kind == "fumen":
+		return (path, kind) + fingerprint.fumenFingerprint(chart)
+	return (path, kind) + fingerprint.kongaFingerprint(chart)
+
+def linkDuplicate(index, duplicates, entry, outputFile):
+	# Returns True when the chart is already in the fingerprint index with
+	# an output, which is then linked or skipped. The first copy is only
+	# added to the index once its output has been written.
+	from fumentools import fingerprint
+	
+	path, kind, chartFingerprint, hashes = entry
+	with fingerprint.FingerprintIndex(index) as db:
+		original = db.original(chartFingerprint, path)
+		if not original or duplicates == "convert":
+			return False
+		if duplicates == "link":
+			fingerprint.linkOutput(original, outputFile)
+		db.add(path, kind, chartFingerprint, hashes, outputFile if duplicates == "link" else None)
+	return True
+
+def addToIndex(index, entry, outputFile):
+	from fumentools import fingerprint
+	
+	with fingerprint.FingerprintIndex(index) as db:
+		db.add(*entry, outputFile)
+
+class Task:
+	def __init__(self, stage, name, function, args=(), deps=(), inputs=(), outputs=()):
+		self.stage = stage
+		self.name = name
+		self.function = function
+		self.args = args
+		self.inputs = inputs
+		self.outputs = outputs
+		self.deps = list(deps)
+		self.dependents = []
+		self.waiting = len(self.deps)
+		self.status = "pending"
+		self.result = None
+		self.records = 0
+		self.error = None
+		self.seconds = 0
+		for dep in self.deps:
+			dep.dependents.append(self)
+
+def buildGraph(classified, root, outDir=None, formats=("vtt",), extract=False, force=False, index=None, duplicates="link", inMemory=False):
+	# classified maps paths to kinds. Returns the tasks, dependencies
+	# always come before the tasks that use them. In memory, the tasks
+	# return the digests of their outputs and write nothing.
+	from konga2tja import konga2tja
+	
+	def outputPath(path, ext):
+		outPath = os.path.splitext(path)[0] + ext
+		if outDir:
+			outPath = os.path.join(outDir, os.path.relpath(outPath, root))
+			if not inMemory:
+				os.makedirs(os.path.dirname(outPath), exist_ok=True)
+		return outPath
+	
+	def lyricsFiles(path):
+		return {format: outputPath(path, "." + format) for format in formats}
+	
+	tasks = []
+	kongaFiles = []
+	for path in sorted(classified):
+		kind = classified[path]
+		if kind == "drp":
+			extractDir = outputPath(path, "") if extract else None
+			drp = Task("drp", path, extractDrp, (path, extractDir), (), (path,), (extractDir,) if extractDir else ())
+			tasks.append(drp)
+			outputFiles = lyricsFiles(path)
+			tasks.append(Task("lyrics", path, convertDrpLyrics, (outputFiles, formats, inMemory), (drp,), (), outputFiles.values()))
+		elif kind == "lyrics":
+			outputFiles = lyricsFiles(path)
+			tasks.append(Task("lyrics", path, convertLyrics, (path, outputFiles, formats, inMemory), (), (path,), outputFiles.values()))
+		elif kind == "fumen":
+			outputFile = outputPath(path, ".osu")
+			tasks.append(Task("osu", path, convertFumen, (path, outputFile, 0, index, duplicates, inMemory), (), (path,), (outputFile,)))
+		elif kind == "konga":
+			kongaFiles.append(path)
+	for tjaFile, paths in konga2tja.songCourses(kongaFiles):
+		outputFile = outputPath(tjaFile, ".tja")
+		tasks.append(Task("tja", tjaFile, convertKonga, (paths, outputFile, force, index, duplicates, inMemory), (), paths, (outputFile,)))
+	return tasks
+
+def fileBytes(paths):
+	# Total size of files, and of the files in directories
+	total = 0
+	for path in paths:
+		if os.path.isdir(path):
+			total += fileBytes(os.path.join(dirPath, fileName) for dirPath, dirNames, fileNames in os.walk(path) for fileName in fileNames)
+		elif os.path.isfile(path):
+			total += os.path.getsize(path)
+	return total
+
+def taskKey(task):
+	return "{} {}".format(task.stage, os.path.abspath(task.name))
+
+def taskInputs(task):
+	# Lyrics in a DRP archive are read through the task extracting them
+	inputs = list(task.inputs)
+	for dep in task.deps:
+		inputs += dep.inputs
+	return [os.path.abspath(path) for path in inputs]
+
+def runTask(function, args, name=None, profiling=False, inputs=None):
+	# With profiling on, the phases of a task are collected in the worker
+	# and sent back with its result. Phases are enabled before the pool
+	# starts, workers only record. Inputs are hashed before they are read
+	# for the journal.
+	hashes = None if inputs == None else {path: journal.fileHash(path) for path in inputs}
+	if not profiling:
+		start = time.perf_counter()
+		result, records = function(*args)
+		return result, records, time.perf_counter() - start, None, hashes
+	with phases.collect() as collected:
+		with phases.profileFile(name):
+			start = time.perf_counter()
+			result, records = function(*args)
+			seconds = time.perf_counter() - start
+	return result, records, seconds, collected, hashes
+
+def resumeTasks(tasks, records, jobs=1):
+	# Marks the tasks that an earlier run finished as resumed. A DRP archive
+	# is only skipped when every task using its lyrics is. Partial outputs
+	# left by the earlier run are removed.
+	from concurrent.futures import ThreadPoolExecutor
+	
+	def check(task):
+		return journal.finished(records.get(taskKey(task)), taskInputs(task), [os.path.abspath(path) for path in task.outputs])
+	with ThreadPoolExecutor(jobs) as executor:
+		done = list(executor.map(check, tasks))
+	for task, taskDone in reversed(list(zip(tasks, done))):
+		if taskDone and all(dependent.status == "resumed" for dependent in task.dependents):
+			task.status = "resumed"
+		for path in task.outputs:
+			journal.removePart(path)
+	return sum(1 for task in tasks if task.status == "resumed")
+
+def runGraph(tasks, jobs=1, limits={}, processes=False, progress=None, throughput=None, hashInputs=False):
+	# Tasks run on one pool as soon as their dependencies are done, with at
+	# most limits[stage] of a stage running at once. Results are handed to
+	# the tasks that depend on them as extra arguments. Resumed tasks count
+	# as done without running, none of their dependents run either.
+	from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+	from collections import deque
+	
+	ready = {stage: deque() for stage in stages}
+	running = {stage: 0 for stage in stages}
+	for task in tasks:
+		task.uses = len(task.dependents)
+		task.hashes = None
+		if task.status == "resumed":
+			if throughput:
+				throughput.skip()
+			for dependent in task.dependents:
+				dependent.waiting -= 1
+	for task in tasks:
+		if task.waiting == 0 and task.status == "pending":
+			ready[task.stage].append(task)
+	
+	def finish(task, status):
+		task.status = status
+		if progress:
+			progress(task)
+		if throughput and status == "done":
+			throughput.done(1, fileBytes(task.inputs), fileBytes(task.outputs), task.records)
+		elif throughput and status == "skipped":
+			throughput.skip()
+		for dependent in task.dependents:
+			if status != "done":
+				if dependent.status == "pending":
+					dependent.error = "{} failed".format(task.stage)
+					finish(dependent, "skipped")
+				continue
+			dependent.waiting -= 1
+			if dependent.waiting == 0 and dependent.status == "pending":
+				ready[dependent.stage].append(dependent)
+	
+	Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+	profiling = phases.enabled
+	if processes and profiling:
+		# Worker processes don't share the enabled phases of this one
+		executor = Executor(jobs, initializer=phases.enable, initargs=(phases.captureTop,))
+	else:
+		executor = Executor(jobs)
+	futures = {}
+	with executor:
+		while True:
+			for stage in stages:
+				limit = limits.get(stage) or jobs
+				while ready[stage] and running[stage] < limit and len(futures) < jobs * 2:
+					task = ready[stage].popleft()
+					args = task.args + tuple(dep.result for dep in task.deps)
+					for dep in task.deps:
+						# Results are only kept until every dependent has them
+						dep.uses -= 1
+						if dep.uses == 0:
+							dep.result = None
+					inputs = taskInputs(task) if hashInputs else None
+					futures[executor.submit(runTask, task.function, args, "{} {}".format(task.stage, task.name), profiling, inputs)] = task
+					task.status = "running"
+					running[stage] += 1
+			if throughput:
+				throughput.queue(sum(len(queue) for queue in ready.values()) + max(len(futures) - jobs, 0), min(len(futures), jobs))
+			if not futures:
+				break
+			done, notDone = wait(futures, return_when=FIRST_COMPLETED)
+			for future in done:
+				task = futures.pop(future)
+				running[task.stage] -= 1
+				try:
+					task.result, task.records, task.seconds, collected, task.hashes = future.result()
+				except Exception as e:
+					errorType = type(e).__name__
+					if type(e).__module__ != "builtins":
+						errorType = type(e).__module__ + "." + errorType
+					task.error = "{}: {}".format(errorType, e)
+					if throughput:
+						throughput.fail(e)
+					finish(task, "failed")
+					continue
+				if collected:
+					phases.merge(collected)
+				finish(task, "done")
+	return tasks
+
+def report(tasks, seconds, file=sys.stderr):
+	print("{:<8}{:>8}{:>8}{:>9}{:>9}{:>10}".format("stage", "done", "failed", "skipped", "resumed", "seconds"), file=file)
+	for stage in stages:
+		stageTasks = [task for task in tasks if task.stage == stage]
+		if not stageTasks:
+			continue
+		print("{:<8}{:>8}{:>8}{:>9}{:>9}{:>10.2f}".format(
+			stage,
+			sum(1 for task in stageTasks if task.status == "done"),
+			sum(1 for task in stageTasks if task.status == "failed"),
+			sum(1 for task in stageTasks if task.status == "skipped"),
+			sum(1 for task in stageTasks if task.status == "resumed"),
+			sum(task.seconds for task in stageTasks)
+		), file=file)
+	failed = [task for task in tasks if task.status == "failed"]
+	for task in failed:
+		print("Error: {} '{}': {}".format(task.stage, task.name, task.error), file=file)
+	print("Finished {} tasks in {:.2f}s".format(len(tasks), seconds), file=file)
+	return not failed
+
+def stageLimit(arg):
+	import argparse
+	
+	stage, sep, limit = arg.partition("=")
+	if stage not in stages or not limit.isdigit() or int(limit) < 1:
+		raise argparse.ArgumentTypeError("Expected stage=N with a stage from {}".format(", ".join(stages)))
+	return stage, int(limit)
+
+def main(argv=None, prog=None):
+	import argparse
+	from lyrics2vtt import lyrics2vtt
+	
+	if argv == None:
+		argv = sys.argv[1:]
+	
+	parser = argparse.ArgumentParser(
+		prog=prog,
+		description="Converts every file in a game dump that the tools can read"
+	)
+	parser.add_argument(
+		"path",
+		help="Path to the dump, searched recursively"
+	)
+	parser.add_argument(
+		"-o",
+		metavar="path",
+		help="Write the output files to this directory, keeping the layout of the dump. By default they are written next to the input files."
+	)
+	parser.add_argument(
+		"--format",
+		metavar="vtt",
+		help="Comma separated list of subtitle formats to write for lyrics, default is 'vtt'.",
+		type=lyrics2vtt.formatList,
+		default=["vtt"]
+	)
+	parser.add_argument(
+		"--extract",
+		help="Also write out the files in every DRP archive.",
+		action="store_true"
+	)
+	parser.add_argument(
+		"-f", "--force",
+		help="Ignore unknown notes in Donkey Konga files.",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--index",
+		metavar="file.db",
+		help="Fingerprint every chart into an index, charts already in it are handled by --duplicates."
+	)
+	parser.add_argument(
+		"--duplicates",
+		metavar="link",
+		help="What to do with the output of a duplicate chart: 'link' hardlinks it to the first copy's output, which keeps that copy's title and audio file name, 'skip' writes nothing, 'convert' converts it anyway. Default is 'link'.",
+		choices=("link", "skip", "convert"),
+		default="link"
+	)
+	parser.add_argument(
+		"-j", "--jobs",
+		metavar="0",
+		help="Run this many tasks in parallel, default is 0, which uses every core.",
+		type=int,
+		default=0
+	)
+	parser.add_argument(
+		"--limit",
+		metavar="stage=N",
+		help="Run at most N tasks of a stage ({}) at once, can be repeated.".format(", ".join(stages)),
+		type=stageLimit,
+		action="append",
+		default=[]
+	)
+	parser.add_argument(
+		"--processes",
+		help="Run tasks in worker processes instead of threads.",
+		action="store_true"
+	)
+	parser.add_argument(
+		"-v", "--verbose",
+		help="Print every task as it finishes.",
+		action="store_true"
+	)
+	phases.addArguments(parser)
+	metrics.addArguments(parser)
+	verify.addArguments(parser)
+	journal.addArguments(parser)
+	if len(argv) == 0:
+		parser.print_help()
+		return
+	args = parser.parse_args(argv)
+	if (args.verify or args.record) and (args.index or args.extract or args.journal):
+		parser.error("--index, --extract and --journal write files, they can't be used with --verify or --record")
+	if args.resume and not args.journal:
+		parser.error("--resume needs a --journal")
+	jobs = max(args.jobs, 0) or os.cpu_count() or 1
+	root = args.path if os.path.isdir(args.path) else os.path.dirname(args.path) or "."
+	
+	start = time.perf_counter()
+	from concurrent.futures import ThreadPoolExecutor
+	
+	paths = list(scan(args.path))
+	with ThreadPoolExecutor(jobs) as executor:
+		classified = {path: kind for path, kind in zip(paths, executor.map(classify, paths)) if kind}
+	# Manifest keys are relative to where the outputs would be written
+	manifest = verify.start(args, args.o or root)
+	if args.o and not manifest:
+		os.makedirs(args.o, exist_ok=True)
+	tasks = buildGraph(classified, root, args.o, args.format, args.extract, args.force, args.index and os.path.abspath(args.index), args.duplicates, bool(manifest))
+	
+	if args.journal:
+		if args.resume:
+			resumed = resumeTasks(tasks, journal.load(args.journal), jobs)
+			print("Resuming, {} of {} tasks are finished".format(resumed, len(tasks)), file=sys.stderr)
+		journalFile = journal.Journal(args.journal, args.resume)
+	else:
+		journalFile = None
+	
+	def progress(task):
+		if args.verbose:
+			print("{}\t{}\t{}".format(task.status, task.stage, task.name), file=sys.stderr)
+		if journalFile and task.status == "done":
+			journalFile.record(taskKey(task), task.hashes, [os.path.abspath(path) for path in task.outputs if os.path.exists(path)])
+		if manifest and task.status == "done" and type(task.result) is dict:
+			for outputFile, (entry, labels) in task.result.items():
+				message = manifest.check(outputFile, entry, labels)
+				if message and args.verbose:
+					print("mismatch\t{}\t{}".format(manifest.key(outputFile), message), file=sys.stderr)
+	phases.start(args)
+	reporter = metrics.start(args, len(tasks))
+	try:
+		runGraph(tasks, jobs, dict(args.limit), args.processes, progress, reporter and reporter.metrics, bool(journalFile))
+	finally:
+		if journalFile:
+			journalFile.close()
+		if reporter:
+			reporter.stop()
+		phases.finish(args)
+	ok = report(tasks, time.perf_counter() - start)
+	if manifest and not manifest.finish():
+		ok = False
+	if not ok:
+		return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import os
+
+from fumentools.binreader import BinReader
+
+# Finding the converter for a file in a dump, shared by dump, fingerprint and
+# catalog
+
+kongaMagic = b"\x20\x03\x07\x30"
+headerSize = 0x220
+
+def classify(path):
+	# Returns "drp", "lyrics", "fumen", "konga" or None, going only by the
+	# first bytes of the file. LZSS files are classified by what they
+	# decompress to.
+	from lyrics2vtt import lyrics2vtt
+	
+	try:
+		with open(path, "rb") as file:
+			size = os.fstat(file.fileno()).st_size
+			header = file.read(headerSize)
+	except OSError:
+		return None
+	if header[:4] == kongaMagic:
+		return "konga"
+	format = lyrics2vtt.sniffFormat(header[:lyrics2vtt.headerSize], size)
+	if format == "drp":
+		return "drp"
+	if format == "lzss10" or format == "lzss11":
+		# Only the header is decompressed, from the bytes already read. The
+		# file is only read again when those don't decompress to a whole
+		# header, and it is decompressed in full once, when it is converted.
+		from lyrics2vtt import lzss3
+		
+		decompressor = lzss3.decompressobj()
+		try:
+			decompressed = bytearray(decompressor.decompress(header))
+			if len(decompressed) < headerSize and not decompressor.eof:
+				with open(path, "rb") as file:
+					file.seek(len(header))
+					while len(decompressed) < headerSize and not decompressor.eof:
+						chunk = file.read(headerSize)
+						if not chunk:
+							break
+						decompressed += decompressor.decompress(chunk)
+			size = decompressor.decompressed_size
+		except (OSError, lzss3.DecompressionError):
+			return None
+		header = bytes(decompressed[:headerSize])
+		if isFumen(header, size):
+			return "fumen"
+		format = lyrics2vtt.sniffFormat(header[:lyrics2vtt.headerSize], size)
+		return "lyrics" if format == "bin-big" or format == "bin-little" else None
+	if isFumen(header, size):
+		return "fumen"
+	if format == "bin-big" or format == "bin-little":
+		return "lyrics"
+	return None
+
+def isFumen(header, size):
+	# Fumen files have a branch flag at 0x1b0, the measure count at 0x200
+	# and the first measure's BPM at 0x208. Truncated files still count, so
+	# that converting them is reported as an error.
+	if len(header) < 0x210 or size < 0x248 or header[0x1b0] > 1:
+		return False
+	reader = BinReader(header)
+	measuresBig = reader.unpackFrom(">I", 0x200)[0]
+	measuresLittle = reader.unpackFrom("<I", 0x200)[0]
+	reader.order = ">" if measuresBig < measuresLittle else "<"
+	measures = min(measuresBig, measuresLittle)
+	bpm = reader.unpackFrom("f", 0x208)[0]
+	return 0 < measures < 0x10000 and 0 < bpm < 10000
+
+def readData(path):
+	# Reads a file, decompressing it if it is LZSS-compressed
+	with open(path, "rb") as file:
+		data = file.read()
+	if data[:1] in (b"\x10", b"\x11") and any(data[4:0x10]):
+		from lyrics2vtt import lzss3
+		
+		data = lzss3.decompress_bytes(data)
+	return data
+
+def scan(root):
+	if os.path.isfile(root):
+		yield root
+		return
+	for dirPath, dirNames, fileNames in os.walk(root):
+		dirNames.sort()
+		for fileName in sorted(fileNames):
+			yield os.path.join(dirPath, fileName)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import hashlib
+
+if not __package__:
+	# Run as a script from a checkout rather than the installed package
+	sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fumentools import files
+from fumentools import journal
+
+# Charts are fingerprinted from what the parsers return, so the byte order,
+# padding and unused fields of a file make no difference. Every measure gets
+# a hash of its content without its position in the song, the fingerprint of
+# a chart hashes those in order with the time each measure starts at.
+
+def hashValue(value):
+	digest = hashlib.blake2b(repr(value).encode("utf-8"), digest_size=8).digest()
+	# Signed to fit in an SQLite integer
+	return int.from_bytes(digest, "big", signed=True)
+
+def fumenFingerprint(song):
+	# Returns the fingerprint and the hash of every measure
+	hashes = []
+	timing = []
+	firstOffset = None
+	for measureNumber in range(song["length"]):
+		measure = song[measureNumber]
+		if firstOffset == None:
+			firstOffset = measure["offset"]
+		branches = []
+		for branchName in ("normal", "advanced", "master"):
+			branch = measure[branchName]
+			branches.append(tuple((
+				branch[noteNumber]["type"],
+				round(branch[noteNumber]["pos"], 2),
+				branch[noteNumber].get("duration"),
+				branch[noteNumber].get("hits")
+			) for noteNumber in range(branch["length"])))
+		hashes.append(hashValue((
+			round(measure["bpm"], 3),
+			measure["gogo"],
+			measure["hidden"],
+			tuple(branches)
+		)))
+		timing.append(round(measure["offset"] - firstOffset, 1))
+	return "{:016x}".format(hashValue((song["branches"], tuple(zip(hashes, timing)))) & 0xffffffffffffffff), hashes
+
+def kongaFingerprint(tja):
+	# Takes a chart from parseBin or a whole TJA file from buildTja, header
+	# fields like the title and comments are left out
+	hashes = []
+	measure = []
+	for line in tja.split("\n"):
+		if not line or line.startswith("//") or line in ("#START", "#END") or line.startswith("#GAMETYPE"):
+			continue
+		if ":" in line and not line.startswith("#"):
+			continue
+		measure.append(line)
+		if line.endswith(","):
+			hashes.append(hashValue(tuple(measure)))
+			measure = []
+	return "{:016x}".format(hashValue(tuple(hashes)) & 0xffffffffffffffff), hashes
+
+def fingerprintFile(path, kind=None, courses=None):
+	# Returns the kind, fingerprint and measure hashes of a fumen file or a
+	# Donkey Konga song, or None for other files. A song is fingerprinted
+	# from the TJA file of all of its courses, like dump converts it, and
+	# path is the name of that TJA file.
+	kind = kind or files.classify(path)
+	if kind == "fumen":
+		from fumen2osu import fumen2osu
+		
+		song = fumen2osu.readFumen(files.readData(path))
+		if not song:
+			raise fumen2osu.UnknownNoteError("Unknown note type in the fumen file")
+		return (kind,) + fumenFingerprint(song)
+	elif kind == "konga":
+		from contextlib import redirect_stdout
+		from konga2tja import konga2tja
+		
+		name = os.path.splitext(os.path.split(path)[1])[0]
+		# Unknown notes are printed as they are found
+		with redirect_stdout(None):
+			tja = konga2tja.buildTja(name, courses or [path], True)
+		return (kind,) + kongaFingerprint(tja)
+	return None
+
+class FingerprintIndex:
+	# SQLite database of fingerprinted charts. Exact duplicates are looked
+	# up by fingerprint, near duplicates by how many of their measure hashes
+	# they share.
+	def __init__(self, path):
+		import sqlite3
+		
+		self.path = path
+		self.db = sqlite3.connect(path, timeout=60)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.executescript("""
+			CREATE TABLE IF NOT EXISTS charts (
+				path TEXT PRIMARY KEY,
+				kind TEXT,
+				fingerprint TEXT,
+				measures INTEGER,
+				output TEXT
+			);
+			CREATE INDEX IF NOT EXISTS chartsFingerprint ON charts (fingerprint);
+			CREATE TABLE IF NOT EXISTS measures (
+				hash INTEGER,
+				path TEXT
+			);
+			CREATE INDEX IF NOT EXISTS measuresHash ON measures (hash);
+			CREATE INDEX IF NOT EXISTS measuresPath ON measures (path);
+		""")
+	
+	def add(self, path, kind, fingerprint, hashes, output=None):
+		path = os.path.abspath(path)
+		output = output and os.path.abspath(output)
+		hashes = set(hashes)
+		with self.db:
+			self.db.execute("DELETE FROM measures WHERE path = ?", (path,))
+			self.db.execute("INSERT OR REPLACE INTO charts VALUES (?, ?, ?, ?, ?)", (path, kind, fingerprint, len(hashes), output))
+			self.db.executemany("INSERT INTO measures VALUES (?, ?)", [(hash, path) for hash in hashes])
+	
+	def exact(self, fingerprint, exclude=None):
+		# Paths and outputs of the charts with this fingerprint, oldest first
+		return self.db.execute(
+			"SELECT path, output FROM charts WHERE fingerprint = ? AND path != ? ORDER BY rowid",
+			(fingerprint, os.path.abspath(exclude) if exclude else "")
+		).fetchall()
+	
+	def original(self, fingerprint, exclude=None):
+		# The first output of a chart with this fingerprint that still exists
+		for path, output in self.exact(fingerprint, exclude):
+			if output and os.path.isfile(output):
+				return output
+		return None
+	
+	def similar(self, hashes, threshold=0.8, limit=10, exclude=None):
+		# Charts sharing at least threshold of their distinct measures with
+		# the given ones, by Jaccard index, as (score, path) best first
+		hashes = set(hashes)
+		if not hashes:
+			return []
+		self.db.execute("CREATE TEMP TABLE IF NOT EXISTS query (hash INTEGER PRIMARY KEY)")
+		with self.db:
+			self.db.execute("DELETE FROM query")
+			self.db.executemany("INSERT INTO query VALUES (?)", [(hash,) for hash in hashes])
+		rows = self.db.execute("""
+			SELECT measures.path, COUNT(DISTINCT measures.hash), charts.measures
+			FROM measures JOIN query ON measures.hash = query.hash JOIN charts ON charts.path = measures.path
+			WHERE measures.path != ?
+			GROUP BY measures.path
+		""", (os.path.abspath(exclude) if exclude else "",)).fetchall()
+		scores = []
+		for path, shared, measures in rows:
+			score = shared / (len(hashes) + measures - shared)
+			if score >= threshold:
+				scores.append((score, path))
+		scores.sort(key=lambda score: (-score[0], score[1]))
+		return scores[:limit]
+	
+	def close(self):
+		self.db.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+		return False
+
+def linkOutput(original, outputFile):
+	# Hardlinks a duplicate's output to the first one, copying it when the
+	# two are on different file systems. The link is made next to the output
+	# and renamed over it, so an existing output is replaced in one step.
+	if os.path.abspath(original) == os.path.abspath(outputFile):
+		return
+	partPath = outputFile + journal.partExt
+	if os.path.lexists(partPath):
+		os.remove(partPath)
+	try:
+		os.link(original, partPath)
+	except OSError:
+		import shutil
+		
+		shutil.copyfile(original, partPath)
+	os.replace(partPath, outputFile)
+
+def main(argv=None, prog=None):
+	import argparse
+	
+	if argv == None:
+		argv = sys.argv[1:]
+	
+	parser = argparse.ArgumentParser(
+		prog=prog,
+		description="Fingerprints fumen and Donkey Konga charts and finds their duplicates"
+	)
+	parser.add_argument(
+		"path",
+		nargs="+",
+		help="Chart files or directories, searched recursively"
+	)
+	parser.add_argument(
+		"--index",
+		metavar="file.db",
+		help="Look up every chart in a fingerprint index."
+	)
+	parser.add_argument(
+		"--add",
+		help="Also add the charts to the index.",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--threshold",
+		metavar="0.8",
+		help="Fraction of measures that near duplicates share, default is 0.8.",
+		type=float,
+		default=0.8
+	)
+	if len(argv) == 0:
+		parser.print_help()
+		return
+	args = parser.parse_args(argv)
+	if args.add and not args.index:
+		parser.error("--add needs an --index")
+	
+	index = FingerprintIndex(args.index) if args.index else None
+	try:
+		for root in args.path:
+			charts = []
+			kongaFiles = []
+			for path in files.scan(root):
+				kind = files.classify(path)
+				if kind == "fumen":
+					charts.append((path, kind, None))
+				elif kind == "konga":
+					kongaFiles.append(path)
+			if kongaFiles:
+				from konga2tja import konga2tja
+				
+				charts += [(tjaFile, "konga", courses) for tjaFile, courses in konga2tja.songCourses(kongaFiles)]
+			for path, kind, courses in charts:
+				try:
+					kind, fingerprint, hashes = fingerprintFile(path, kind, courses)
+				except Exception as e:
+					print("Error: '{}': {}".format(path, e), file=sys.stderr)
+					continue
+				print("{}\t{}\t{}".format(fingerprint, len(hashes), path))
+				if not index:
+					continue
+				duplicates = [duplicate for duplicate, output in index.exact(fingerprint, path)]
+				for duplicate in duplicates:
+					print("\tduplicate\t{}".format(duplicate))
+				for score, similar in index.similar(hashes, args.threshold, exclude=path):
+					if similar not in duplicates:
+						print("\t{:.3f}\t{}".format(score, similar))
+				if args.add:
+					index.add(path, kind, fingerprint, hashes)
+	finally:
+		if index:
+			index.close()
+
+if __name__ == "__main__":
+	main()
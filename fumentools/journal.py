@@ -0,0 +1,171 @@
+import os
+from time import perf_counter
+
+# Batch runs record every finished task to a journal, one line of JSON
+# each, with the hashes of its inputs and the outputs it wrote. A resumed
+# run skips the tasks whose inputs are unchanged and whose outputs are all
+# still there. Outputs are written to a temporary file that is renamed
+# over the output once complete, so a run that is killed leaves either
+# the old file or the new one, never a truncated one.
+
+partExt = ".part"
+
+def fileHash(path):
+	import hashlib
+	
+	digest = hashlib.blake2b(digest_size=16)
+	with open(path, "rb") as file:
+		for chunk in iter(lambda: file.read(0x100000), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+class AtomicFile:
+	# Writes to path.part and renames it to path when closed. Leaving a
+	# with block on an exception removes the partial file instead. The file
+	# is synced before the rename, otherwise a crash could leave an empty
+	# output that the journal already has as finished.
+	def __init__(self, path, mode="wb", encoding=None, sync=True):
+		self.path = path
+		self.partPath = path + partExt
+		self.sync = sync
+		self.file = open(self.partPath, mode, encoding=encoding)
+	
+	def __getattr__(self, name):
+		return getattr(self.file, name)
+	
+	def write(self, data):
+		return self.file.write(data)
+	
+	def close(self):
+		if self.file.closed:
+			return
+		if self.sync:
+			self.file.flush()
+			os.fsync(self.file.fileno())
+		self.file.close()
+		os.replace(self.partPath, self.path)
+	
+	def discard(self):
+		if not self.file.closed:
+			self.file.close()
+		if os.path.exists(self.partPath):
+			os.remove(self.partPath)
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, type, value, traceback):
+		if type == None:
+			self.close()
+		else:
+			self.discard()
+		return False
+
+def removePart(path):
+	# Removes what a killed run left of an output
+	try:
+		os.remove(path + partExt)
+	except OSError:
+		pass
+
+class Journal:
+	# Lines are appended with a single write to a file opened for
+	# appending, and synced to disk every syncEvery records or syncInterval
+	# seconds, whichever comes first. A line cut short by a crash is ignored
+	# when the journal is loaded.
+	def __init__(self, path, resume=False, syncEvery=64, syncInterval=1.0):
+		flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+		if not resume:
+			flags |= os.O_TRUNC
+		self.path = path
+		self.fd = os.open(path, flags, 0o666)
+		self.syncEvery = syncEvery
+		self.syncInterval = syncInterval
+		self.pending = 0
+		self.lastSync = perf_counter()
+	
+	def record(self, key, inputs, outputs):
+		# inputs maps paths to their hashes
+		import json
+		
+		line = json.dumps({"key": key, "inputs": inputs, "outputs": list(outputs)}, ensure_ascii=False) + "\n"
+		os.write(self.fd, line.encode("utf-8"))
+		self.pending += 1
+		if self.pending >= self.syncEvery or perf_counter() - self.lastSync >= self.syncInterval:
+			self.sync()
+	
+	def sync(self):
+		if self.pending:
+			os.fsync(self.fd)
+			self.pending = 0
+		self.lastSync = perf_counter()
+	
+	def close(self):
+		if self.fd != None:
+			self.sync()
+			os.close(self.fd)
+			self.fd = None
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+		return False
+
+def load(path):
+	# Returns the last record of every key
+	import json
+	
+	records = {}
+	try:
+		file = open(path, "r", encoding="utf-8")
+	except FileNotFoundError:
+		return records
+	with file:
+		for line in file:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+			records[record["key"]] = record
+	return records
+
+def finished(record, inputs, outputs):
+	# A task is finished if it ran on the same inputs and the outputs it
+	# wrote are still there, and are ones it would write now
+	if not record or sorted(record["inputs"]) != sorted(inputs):
+		return False
+	for path in record["outputs"]:
+		if path not in outputs or not os.path.exists(path):
+			return False
+	for path, hash in record["inputs"].items():
+		try:
+			if fileHash(path) != hash:
+				return False
+		except OSError:
+			return False
+	return True
+
+def inputHashes(paths):
+	return {os.path.abspath(path): fileHash(path) for path in paths}
+
+def start(args):
+	# Opens the journal of a batch run, returns it with the records of the
+	# earlier run when resuming
+	if not args.journal:
+		return None, {}
+	records = load(args.journal) if args.resume else {}
+	return Journal(args.journal, args.resume), records
+
+def addArguments(parser):
+	parser.add_argument(
+		"--journal",
+		metavar="file",
+		help="Record every finished task to a journal, with the hashes of its inputs and its outputs."
+	)
+	parser.add_argument(
+		"--resume",
+		help="Skip the tasks that the journal has as finished, if their inputs didn't change and their outputs are still there.",
+		action="store_true"
+	)
@@ -0,0 +1,295 @@
+import sys
+from time import perf_counter, time
+
+# Throughput of a batch run, counted by the runner as files finish and
+# reported every few seconds as a line of JSON, and on request in the
+# Prometheus text format.
+
+errorKinds = (
+	"unknown note",
+	"magic mismatch",
+	"zlib error",
+	"lzss size mismatch",
+	"lzss error",
+	"truncated",
+	"other"
+)
+
+def errorKind(error):
+	name = type(error).__name__
+	module = type(error).__module__
+	message = str(error)
+	if name == "UnknownNoteError":
+		# Raised by fumen2osu and konga2tja, for notes they don't know
+		return "unknown note"
+	if message == "Magic does not match":
+		return "magic mismatch"
+	if module == "zlib":
+		return "zlib error"
+	if name == "DecompressionError":
+		if "size" in message or "ended before" in message:
+			return "lzss size mismatch"
+		return "lzss error"
+	if module == "struct" or name == "EOFError":
+		return "truncated"
+	return "other"
+
+class Metrics:
+	def __init__(self, total=0):
+		import threading
+		
+		self.total = total
+		self.start = perf_counter()
+		self.lock = threading.Lock()
+		self.files = 0
+		self.failed = 0
+		self.skipped = 0
+		self.inputBytes = 0
+		self.outputBytes = 0
+		self.records = 0
+		self.errors = {}
+		self.queued = 0
+		self.running = 0
+		self.previous = None
+	
+	def done(self, files=1, inputBytes=0, outputBytes=0, records=0):
+		with self.lock:
+			self.files += files
+			self.inputBytes += inputBytes
+			self.outputBytes += outputBytes
+			self.records += records
+	
+	def fail(self, error):
+		kind = errorKind(error)
+		with self.lock:
+			self.failed += 1
+			self.errors[kind] = self.errors.get(kind, 0) + 1
+	
+	def skip(self, files=1):
+		with self.lock:
+			self.skipped += files
+	
+	def queue(self, queued, running):
+		self.queued = queued
+		self.running = running
+	
+	def counters(self):
+		return (self.files, self.inputBytes, self.outputBytes, self.records)
+	
+	def snapshot(self):
+		# Rates are given over the whole run and over the time since the
+		# last snapshot, a stalled run shows up as the latter dropping to 0
+		with self.lock:
+			now = perf_counter()
+			counters = self.counters()
+			previous = self.previous or (self.start, (0, 0, 0, 0))
+			self.previous = (now, counters)
+			errors = dict(self.errors)
+			finished = self.files + self.failed + self.skipped
+		elapsed = now - self.start
+		interval = now - previous[0]
+		
+		def rates(values, seconds):
+			if seconds <= 0:
+				return 0, 0, 0, 0
+			return (
+				values[0] / seconds,
+				values[1] / seconds / 1e6,
+				values[2] / seconds / 1e6,
+				values[3] / seconds
+			)
+		total = rates(counters, elapsed)
+		recent = rates([counters[i] - previous[1][i] for i in range(4)], interval)
+		
+		eta = None
+		if self.total and finished and elapsed > 0:
+			eta = max(self.total - finished, 0) / (finished / elapsed)
+		return {
+			"time": time(),
+			"elapsed": elapsed,
+			"total": self.total,
+			"files": self.files,
+			"failed": self.failed,
+			"skipped": self.skipped,
+			"inputBytes": self.inputBytes,
+			"outputBytes": self.outputBytes,
+			"records": self.records,
+			"filesPerSecond": total[0],
+			"inputMBPerSecond": total[1],
+			"outputMBPerSecond": total[2],
+			"recordsPerSecond": total[3],
+			"recent": {
+				"seconds": interval,
+				"filesPerSecond": recent[0],
+				"inputMBPerSecond": recent[1],
+				"outputMBPerSecond": recent[2],
+				"recordsPerSecond": recent[3]
+			},
+			"errors": errors,
+			"queued": self.queued,
+			"running": self.running,
+			"eta": eta
+		}
+	
+	def prometheus(self):
+		with self.lock:
+			errors = dict(self.errors)
+			lines = [
+				"# HELP fumen_tools_files_total Input files finished, by status.",
+				"# TYPE fumen_tools_files_total counter",
+				'fumen_tools_files_total{{status="done"}} {}'.format(self.files),
+				'fumen_tools_files_total{{status="failed"}} {}'.format(self.failed),
+				'fumen_tools_files_total{{status="skipped"}} {}'.format(self.skipped),
+				"# HELP fumen_tools_input_bytes_total Bytes read from finished input files.",
+				"# TYPE fumen_tools_input_bytes_total counter",
+				"fumen_tools_input_bytes_total {}".format(self.inputBytes),
+				"# HELP fumen_tools_output_bytes_total Bytes written to output files.",
+				"# TYPE fumen_tools_output_bytes_total counter",
+				"fumen_tools_output_bytes_total {}".format(self.outputBytes),
+				"# HELP fumen_tools_records_total Notes, measures or lyrics lines converted.",
+				"# TYPE fumen_tools_records_total counter",
+				"fumen_tools_records_total {}".format(self.records),
+				"# HELP fumen_tools_errors_total Failed files, by kind of error.",
+				"# TYPE fumen_tools_errors_total counter"
+			]
+		for kind in errorKinds:
+			lines.append('fumen_tools_errors_total{{kind="{}"}} {}'.format(kind, errors.get(kind, 0)))
+		lines += [
+			"# HELP fumen_tools_files Input files in the run.",
+			"# TYPE fumen_tools_files gauge",
+			"fumen_tools_files {}".format(self.total),
+			"# HELP fumen_tools_queued Files waiting for a worker.",
+			"# TYPE fumen_tools_queued gauge",
+			"fumen_tools_queued {}".format(self.queued),
+			"# HELP fumen_tools_running Files being converted.",
+			"# TYPE fumen_tools_running gauge",
+			"fumen_tools_running {}".format(self.running),
+			"# HELP fumen_tools_elapsed_seconds Time since the run started.",
+			"# TYPE fumen_tools_elapsed_seconds gauge",
+			"fumen_tools_elapsed_seconds {:.3f}".format(perf_counter() - self.start),
+			""
+		]
+		return "\n".join(lines)
+
+def openTarget(target):
+	# "-" is stderr, "tcp:host:port" a socket, anything else a file that
+	# lines are appended to
+	if target == "-":
+		return sys.stderr, None
+	if target.startswith("tcp:"):
+		import socket
+		
+		host, sep, port = target[4:].rpartition(":")
+		connection = socket.create_connection((host or "localhost", int(port)))
+		return connection.makefile("w", encoding="utf-8"), connection
+	return open(target, "a", encoding="utf-8"), None
+
+class Reporter:
+	def __init__(self, metrics, target=None, interval=5, port=None):
+		self.metrics = metrics
+		self.target = target
+		self.interval = interval
+		self.port = port
+		self.file = None
+		self.connection = None
+		self.server = None
+		self.stopped = None
+		self.thread = None
+	
+	def start(self):
+		import threading
+		
+		self.stopped = threading.Event()
+		if self.target:
+			self.file, self.connection = openTarget(self.target)
+			self.thread = threading.Thread(target=self.run, daemon=True)
+			self.thread.start()
+		if self.port != None:
+			self.server = serve(self.metrics, self.port)
+		return self
+	
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.emit()
+	
+	def emit(self):
+		import json
+		
+		try:
+			self.file.write(json.dumps(self.metrics.snapshot()) + "\n")
+			self.file.flush()
+		except OSError:
+			# A closed socket stops the stream, not the conversion
+			self.stopped.set()
+	
+	def stop(self):
+		# The last line has the totals of the run
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+			self.emit()
+			if self.file is not sys.stderr:
+				self.file.close()
+			if self.connection:
+				self.connection.close()
+		if self.server:
+			self.server.shutdown()
+			self.server.server_close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.stop()
+		return False
+
+def serve(metrics, port):
+	# Prometheus endpoint on localhost, served from a thread for the
+	# length of the run
+	import threading
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+	
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path.split("?")[0] not in ("/", "/metrics"):
+				self.send_error(404)
+				return
+			body = metrics.prometheus().encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		
+		def log_message(self, *args):
+			pass
+	
+	server = HTTPServer(("127.0.0.1", port), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def addArguments(parser):
+	parser.add_argument(
+		"--metrics",
+		metavar="file",
+		help="Write throughput metrics as a line of JSON every few seconds, to a file, to a socket as 'tcp:host:port', or to stderr as '-'."
+	)
+	parser.add_argument(
+		"--metrics-interval",
+		metavar="5",
+		help="Seconds between metrics lines.",
+		type=float,
+		default=5
+	)
+	parser.add_argument(
+		"--metrics-port",
+		metavar="port",
+		help="Serve the metrics in the Prometheus text format on localhost at this port.",
+		type=int
+	)
+
+def start(args, total=0):
+	# Returns a started reporter, or None if no metrics were asked for
+	if not args.metrics and args.metrics_port == None:
+		return None
+	return Reporter(Metrics(total), args.metrics, args.metrics_interval, args.metrics_port).start()
@@ -0,0 +1,307 @@
+import sys
+from time import perf_counter
+
+# Timing is off until enable() is called. Until then phase() hands out a
+# shared object that does nothing, so instrumented code only pays for a
+# function call and a global lookup.
+enabled = False
+captureTop = 0
+local = None
+lock = None
+profileLock = None
+
+class NullPhase:
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		return False
+	
+	def add(self, bytes=0, records=0):
+		pass
+
+nullPhase = NullPhase()
+
+class Phase:
+	# Phases can nest, the time spent in nested phases is subtracted from the
+	# outer phase's self time. A phase must not span a yield.
+	__slots__ = ("name", "bytes", "records", "start", "nested")
+	
+	def __init__(self, name, bytes=0, records=0):
+		self.name = name
+		self.bytes = bytes
+		self.records = records
+		self.nested = 0
+	
+	def __enter__(self):
+		stack(self)
+		self.start = perf_counter()
+		return self
+	
+	def __exit__(self, *args):
+		seconds = perf_counter() - self.start
+		phases = local.stack
+		phases.pop()
+		if phases:
+			phases[-1].nested += seconds
+		record(self.name, 1, seconds, seconds - self.nested, self.bytes, self.records)
+		return False
+	
+	def add(self, bytes=0, records=0):
+		self.bytes += bytes
+		self.records += records
+
+class FileProfile:
+	# Times one input file, and runs it under cProfile when the slowest
+	# files are being captured. Only one file can be profiled at a time, a
+	# file opened while another one is being timed counts as part of it.
+	def __init__(self, name):
+		self.name = name
+		self.profile = None
+		self.outer = False
+	
+	def __enter__(self):
+		if getattr(local, "file", None) != None:
+			return self
+		self.outer = True
+		local.file = self
+		if captureTop:
+			import cProfile
+			
+			profileLock.acquire()
+			self.profile = cProfile.Profile()
+			self.profile.enable()
+		self.start = perf_counter()
+		return self
+	
+	def __exit__(self, *args):
+		if not self.outer:
+			return False
+		local.file = None
+		seconds = perf_counter() - self.start
+		text = None
+		if self.profile:
+			self.profile.disable()
+			profileLock.release()
+			text = formatProfile(self.profile)
+		addFile(collected(), self.name, seconds, text)
+		return False
+	
+	def add(self, bytes=0, records=0):
+		pass
+
+class Collected:
+	def __init__(self):
+		self.stats = {}
+		self.files = []
+		self.profiles = []
+
+globalCollected = Collected()
+stats = globalCollected.stats
+files = globalCollected.files
+profiles = globalCollected.profiles
+
+def phase(name, bytes=0, records=0):
+	if not enabled:
+		return nullPhase
+	return Phase(name, bytes, records)
+
+def timed(name):
+	# Decorator timing every call of a function as a phase, not for
+	# generators since a phase can't span a yield
+	def decorator(function):
+		import functools
+		
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return function(*args, **kwargs)
+			with Phase(name):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def count(name, bytes=0, records=0):
+	# Adds bytes and records to a phase without timing anything
+	if enabled:
+		record(name, 0, 0, 0, bytes, records)
+
+def profileFile(name):
+	if not enabled:
+		return nullPhase
+	return FileProfile(name)
+
+def enable(top=0):
+	# Not thread-safe, call it before starting any threads that record
+	global enabled, captureTop, local, lock, profileLock
+	import threading
+	
+	if not enabled:
+		local = threading.local()
+		lock = threading.Lock()
+		profileLock = threading.Lock()
+	captureTop = top
+	enabled = True
+
+def disable():
+	global enabled
+	enabled = False
+
+def reset():
+	stats.clear()
+	del files[:]
+	del profiles[:]
+
+def stack(phase):
+	try:
+		local.stack.append(phase)
+	except AttributeError:
+		local.stack = [phase]
+
+def collected():
+	# Phases are recorded to the current thread's collector if there is
+	# one, otherwise to the module totals
+	return getattr(local, "collected", None)
+
+def record(name, calls, seconds, selfSeconds, bytes, records):
+	target = collected()
+	if target == None:
+		with lock:
+			addStats(stats, name, (calls, seconds, selfSeconds, bytes, records))
+	else:
+		addStats(target.stats, name, (calls, seconds, selfSeconds, bytes, records))
+
+def addStats(target, name, values):
+	entry = target.get(name)
+	if entry == None:
+		target[name] = list(values)
+	else:
+		for i in range(len(values)):
+			entry[i] += values[i]
+
+def addFile(target, name, seconds, text=None):
+	if target == None:
+		with lock:
+			addFile(globalCollected, name, seconds, text)
+		return
+	target.files.append((seconds, name))
+	if text != None:
+		target.profiles.append((seconds, name, text))
+		target.profiles.sort(key=lambda profile: profile[0], reverse=True)
+		del target.profiles[captureTop:]
+
+class Collect:
+	# Records everything in the current thread to a Collected object, which
+	# can be sent back from a worker process and merged
+	def __enter__(self):
+		self.previous = collected()
+		self.collected = Collected()
+		local.collected = self.collected
+		return self.collected
+	
+	def __exit__(self, *args):
+		local.collected = self.previous
+		return False
+
+def collect():
+	return Collect()
+
+def merge(other):
+	with lock:
+		for name, values in other.stats.items():
+			addStats(stats, name, values)
+	for seconds, name in other.files:
+		profile = [text for profileSeconds, profileName, text in other.profiles if profileName == name]
+		addFile(None, name, seconds, profile[0] if profile else None)
+
+def formatProfile(profile, limit=20):
+	import io
+	import pstats
+	
+	stream = io.StringIO()
+	pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(limit)
+	return stream.getvalue()
+
+def results(slowest=10):
+	with lock:
+		phases = [{
+			"name": name,
+			"calls": values[0],
+			"seconds": values[1],
+			"selfSeconds": values[2],
+			"bytes": values[3],
+			"records": values[4]
+		} for name, values in stats.items()]
+		slowestFiles = sorted(files, key=lambda file: file[0], reverse=True)[:max(slowest, captureTop)]
+		return {
+			"phases": sorted(phases, key=lambda phase: phase["selfSeconds"], reverse=True),
+			"files": len(files),
+			"seconds": sum(seconds for seconds, name in files),
+			"slowest": [{"name": name, "seconds": seconds} for seconds, name in slowestFiles],
+			"profiles": [{"name": name, "seconds": seconds, "stats": text} for seconds, name, text in profiles]
+		}
+
+def report(format="table", file=sys.stderr):
+	output = results()
+	if format == "json":
+		import json
+		
+		json.dump(output, file, indent=2)
+		print(file=file)
+		return
+	
+	print("{:<18}{:>8}{:>11}{:>11}{:>12}{:>10}{:>9}".format(
+		"phase", "calls", "seconds", "self", "bytes", "records", "MB/s"
+	), file=file)
+	for phase in output["phases"]:
+		print("{:<18}{:>8}{:>11.4f}{:>11.4f}{:>12}{:>10}{:>9}".format(
+			phase["name"],
+			phase["calls"],
+			phase["seconds"],
+			phase["selfSeconds"],
+			phase["bytes"],
+			phase["records"],
+			"{:.1f}".format(phase["bytes"] / phase["seconds"] / 1e6) if phase["bytes"] and phase["seconds"] else ""
+		), file=file)
+	if output["files"]:
+		print("", file=file)
+		print("{} files in {:.4f}s, slowest:".format(output["files"], output["seconds"]), file=file)
+		for slow in output["slowest"]:
+			print("{:>11.4f}  {}".format(slow["seconds"], slow["name"]), file=file)
+	for profile in output["profiles"]:
+		print("", file=file)
+		print("cProfile for '{}' ({:.4f}s)".format(profile["name"], profile["seconds"]), file=file)
+		print(profile["stats"].rstrip("\n"), file=file)
+
+def addArguments(parser):
+	parser.add_argument(
+		"--profile",
+		metavar="table",
+		help="Time each phase of the conversion and print the totals to stderr, as a 'table' or as 'json'.",
+		choices=("table", "json")
+	)
+	parser.add_argument(
+		"--profile-output",
+		metavar="file",
+		help="Write the profile to a file instead of stderr."
+	)
+	parser.add_argument(
+		"--profile-top",
+		metavar="N",
+		help="Also run every file under cProfile, one at a time, and keep the output for the N slowest.",
+		type=int,
+		default=0
+	)
+
+def start(args):
+	if args.profile or args.profile_top > 0:
+		enable(max(args.profile_top, 0))
+
+def finish(args):
+	if not args.profile and args.profile_top <= 0:
+		return
+	if args.profile_output:
+		with open(args.profile_output, "w") as file:
+			report(args.profile or "table", file)
+	else:
+		report(args.profile or "table")
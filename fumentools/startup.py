@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+# Modules that only some inputs need, any of them being imported while a
+# tool module loads means a lazy import was lost
+lazyModules = (
+	"xml.etree.ElementTree",
+	"zlib",
+	"lyrics2vtt.lzss3",
+	"json",
+	"glob",
+	"mmap",
+	"concurrent.futures"
+)
+packages = ("fumentools", "fumen2osu", "konga2tja", "lyrics2vtt")
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def importTimes(args):
+	# Runs the interpreter with -X importtime, returns the self time in
+	# microseconds of every module it imported, the top level import that
+	# pulled each one in and the exit status
+	import subprocess
+	
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join(filter(None, (rootDir, env.get("PYTHONPATH"))))
+	process = subprocess.run(
+		[sys.executable, "-X", "importtime"] + args,
+		stdout=subprocess.DEVNULL,
+		stderr=subprocess.PIPE,
+		env=env,
+		cwd=rootDir
+	)
+	imports = []
+	for line in process.stderr.decode(errors="ignore").splitlines():
+		if not line.startswith("import time:"):
+			continue
+		fields = line[len("import time:"):].split("|")
+		if len(fields) != 3 or not fields[0].strip().isdigit():
+			continue
+		name = fields[2].rstrip()
+		level = (len(name) - len(name.lstrip())) // 2
+		imports.append((name.strip(), level, int(fields[0])))
+	
+	# Nested imports are listed before the module that imported them
+	times = {}
+	parents = {}
+	parent = None
+	for name, level, time in reversed(imports):
+		if level == 0:
+			parent = name
+		times[name] = time
+		parents[name] = parent
+	return times, parents, process.returncode
+
+def measureCommand(command, repeat=5):
+	# The entry point script imports fumentools.cli and calls main, the
+	# same is done here so runpy is not counted
+	code = "import sys; from fumentools.cli import main; sys.exit(main())"
+	baseline = set(importTimes(["-c", "pass"])[0])
+	best = None
+	for i in range(repeat):
+		times, parents, status = importTimes(["-c", code] + command)
+		times = {name: time for name, time in times.items() if name not in baseline}
+		if best == None or sum(times.values()) < sum(best[0].values()):
+			best = times, parents, status
+	return best
+
+def checkStartup(commands, budget=30, repeat=5):
+	try:
+		from .cli import commands as cliCommands
+	except ImportError:
+		from cli import commands as cliCommands
+	
+	failed = False
+	for command in commands:
+		times, parents, exitStatus = measureCommand(command, repeat)
+		total = sum(times.values()) / 1000
+		own = sum(time for name, time in times.items() if name.split(".")[0] in packages) / 1000
+		target = cliCommands[command[0]][0] if command else None
+		lazy = [name for name in lazyModules if name in times and name != target
+			and parents[name].split(".")[0] in packages]
+		status = "ok"
+		if total > budget:
+			status = "over budget"
+			failed = True
+		if lazy:
+			status = "imports {}".format(", ".join(lazy))
+			failed = True
+		if exitStatus != 0:
+			# Every command has to at least print its help
+			status = "exit status {}".format(exitStatus)
+			failed = True
+		print("{:<24}{:>8.2f} ms {:>8.2f} ms  {}".format(
+			" ".join(command) or "(none)",
+			total,
+			own,
+			status
+		))
+	return not failed
+
+def main(argv=None):
+	import argparse
+	
+	parser = argparse.ArgumentParser(
+		description="Checks the import time of every fumen-tools command against a budget"
+	)
+	parser.add_argument(
+		"--budget",
+		metavar="30",
+		help="Import time budget for a command in milliseconds, not counting the interpreter's own startup.",
+		type=float,
+		default=30
+	)
+	parser.add_argument(
+		"--repeat",
+		metavar="5",
+		help="Run each command this many times and keep the fastest.",
+		type=int,
+		default=5
+	)
+	args = parser.parse_args(argv)
+	
+	try:
+		from .cli import commands as cliCommands
+	except ImportError:
+		from cli import commands as cliCommands
+	
+	print("{:<24}{:>11}{:>12}".format("command", "total", "fumen-tools"))
+	commands = [[]] + [[name, "--help"] for name in cliCommands]
+	return 0 if checkStartup(commands, args.budget, args.repeat) else 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,209 @@
+import os
+import sys
+
+# Golden manifests of converted outputs. Every output is stored as a digest
+# of the whole file and of each of its units, the measures of a chart or
+# the cues of a subtitle file, so that a changed output can be traced to
+# the first unit that differs without keeping the expected files around.
+
+def hexDigest(data, size=16):
+	import hashlib
+	
+	return hashlib.blake2b(data, digest_size=size).hexdigest()
+
+def units(name, contents, starts=None):
+	# Splits an output into (label, bytes) by its extension
+	ext = os.path.splitext(name)[1].lower()
+	if ext == ".osu":
+		return osuUnits(contents, starts)
+	if ext == ".tja":
+		return tjaUnits(contents)
+	if ext == ".vtt" or ext == ".srt":
+		blocks = contents.split(b"\n\n")
+		if ext == ".vtt":
+			return [("header", blocks[0])] + [("cue {}".format(i + 1), block) for i, block in enumerate(blocks[1:])]
+		return [("cue {}".format(i + 1), block) for i, block in enumerate(blocks)]
+	if ext == ".lrc" or ext == ".json":
+		return [("line {}".format(i + 1), line) for i, line in enumerate(contents.split(b"\n"))]
+	return [("bytes {}".format(i), contents[i:i + 0x10000]) for i in range(0, len(contents), 0x10000)]
+
+def osuUnits(contents, starts=None):
+	# Timing points and hit objects are grouped by the measure they start
+	# in, or are units of their own when the measure times are not known
+	from bisect import bisect_right
+	
+	header = []
+	measures = {}
+	section = None
+	for line in contents.split(b"\n"):
+		if line.startswith(b"["):
+			section = line
+		if section not in (b"[TimingPoints]", b"[HitObjects]") or not line or line == section:
+			header.append(line)
+			continue
+		fields = line.split(b",")
+		time = fields[0] if section == b"[TimingPoints]" else fields[2]
+		if starts:
+			label = "measure {}".format(max(bisect_right(starts, int(float(time))) - 1, 0) + 1)
+		elif section == b"[TimingPoints]":
+			label = "timing point at {}".format(time.decode())
+		else:
+			label = "hit object at {}".format(time.decode())
+		measures.setdefault(label, []).append(line)
+	if starts:
+		order = sorted(measures, key=lambda label: int(label.split(" ")[1]))
+	else:
+		order = list(measures)
+	return [("header", b"\n".join(header))] + [(label, b"\n".join(measures[label])) for label in order]
+
+def tjaUnits(contents):
+	result = []
+	unit = []
+	course = 0
+	measure = 0
+	for line in contents.split(b"\n"):
+		unit.append(line)
+		if line == b"#START":
+			result.append(("header" if course == 0 else "course {} header".format(course + 1), b"\n".join(unit)))
+			course += 1
+			measure = 0
+			unit = []
+		elif line.endswith(b","):
+			measure += 1
+			result.append(("course {} measure {}".format(course, measure), b"\n".join(unit)))
+			unit = []
+	if unit:
+		result.append(("end", b"\n".join(unit)))
+	return result
+
+def digest(name, contents, starts=None):
+	# Returns the manifest entry of an output and the labels of its units,
+	# cheap to send back from a worker process
+	if type(contents) is str:
+		contents = contents.encode("utf-8")
+	outputUnits = units(name, contents, starts)
+	return {
+		"digest": hexDigest(contents),
+		"size": len(contents),
+		"units": [hexDigest(data, 8) for label, data in outputUnits]
+	}, [label for label, data in outputUnits]
+
+def compare(expected, actual, labels):
+	# Describes the first unit that differs, or returns None if none do
+	if expected["digest"] == actual["digest"]:
+		return None
+	expectedUnits = expected.get("units", [])
+	actualUnits = actual["units"]
+	for i in range(min(len(expectedUnits), len(actualUnits))):
+		if expectedUnits[i] != actualUnits[i]:
+			return "first difference in {}".format(labels[i])
+	if len(actualUnits) > len(expectedUnits):
+		return "{} units instead of {}, first extra one is {}".format(len(actualUnits), len(expectedUnits), labels[len(expectedUnits)])
+	if len(actualUnits) < len(expectedUnits):
+		return "{} units instead of {}, missing after {}".format(len(actualUnits), len(expectedUnits), labels[-1] if labels else "the start")
+	return "contents differ, {} bytes instead of {}".format(actual["size"], expected.get("size"))
+
+class Manifest:
+	# Outputs are keyed by their path relative to root. Recording adds to an
+	# existing manifest, so that several runs can fill one.
+	def __init__(self, path, record=False, root="."):
+		import json
+		
+		self.path = path
+		self.record = record
+		self.root = root
+		self.outputs = {}
+		if os.path.exists(path) or not record:
+			with open(path, "r", encoding="utf-8") as file:
+				self.outputs = json.load(file).get("outputs", {})
+		self.checked = 0
+		self.mismatches = []
+		self.seen = set()
+	
+	def key(self, outputFile):
+		return os.path.relpath(outputFile, self.root).replace(os.sep, "/")
+	
+	def check(self, outputFile, entry, labels):
+		key = self.key(outputFile)
+		self.checked += 1
+		self.seen.add(key)
+		if self.record:
+			self.outputs[key] = entry
+			return None
+		expected = self.outputs.get(key)
+		if expected == None:
+			message = "not in the manifest"
+		else:
+			message = compare(expected, entry, labels)
+		if message:
+			self.mismatches.append((key, message))
+		return message
+	
+	def add(self, outputFile, contents, starts=None):
+		return self.check(outputFile, *digest(outputFile, contents, starts))
+	
+	def save(self):
+		import json
+		
+		temp = self.path + ".tmp"
+		with open(temp, "w", encoding="utf-8") as file:
+			json.dump({"version": 1, "outputs": dict(sorted(self.outputs.items()))}, file, indent="\t")
+			file.write("\n")
+		os.replace(temp, self.path)
+	
+	def finish(self, file=sys.stderr):
+		# Saves a recorded manifest or prints the mismatches, returns False
+		# if there were any
+		if self.record:
+			self.save()
+			print("Recorded {} outputs to '{}'".format(self.checked, self.path), file=file)
+			return True
+		for key, message in self.mismatches:
+			print("Mismatch: '{}': {}".format(key, message), file=file)
+		missing = sum(1 for key in self.outputs if key not in self.seen)
+		print("Verified {} outputs, {} mismatched{}".format(
+			self.checked,
+			len(self.mismatches),
+			", {} in the manifest were not converted".format(missing) if missing else ""
+		), file=file)
+		return not self.mismatches
+
+class ManifestWriter:
+	# Stands in for an OszWriter, checking package members instead of
+	# writing them. Files copied into a package are not checked.
+	def __init__(self, manifest):
+		self.manifest = manifest
+	
+	def add(self, packagePath, name, contents=None, sourcePath=None):
+		if contents != None:
+			self.manifest.add(os.path.join(packagePath, name), contents)
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		return False
+
+def addArguments(parser):
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument(
+		"--verify",
+		metavar="manifest.json",
+		help="Convert in memory and compare the outputs with a manifest of their digests, without writing anything."
+	)
+	group.add_argument(
+		"--record",
+		metavar="manifest.json",
+		help="Convert in memory and record the digests of the outputs to a manifest for --verify."
+	)
+
+def start(args, root="."):
+	# Returns a manifest, or None if neither option was given
+	if not args.verify and not args.record:
+		return None
+	path = args.verify or args.record
+	try:
+		return Manifest(path, bool(args.record), root)
+	except (OSError, ValueError) as e:
+		print("Error: can't read the manifest '{}': {}".format(path, e), file=sys.stderr)
+		sys.exit(1)
@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
 
-import os, sys, struct, argparse
-import glob
+import os, sys
 import math
 from functools import cmp_to_key
+from itertools import groupby
+
+if not __package__:
+	# Run as a script from a checkout rather than the installed package
+	sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fumentools.binreader import BinReader
+from fumentools import phases, metrics, verify, journal
 
 konga2tja_version = "v1.1"
 
+class UnknownNoteError(ValueError):
+	pass
+
 noteTypes = {
 	0x00: "0",
 	0x01: "2", # Pa, パ
@@ -41,22 +51,24 @@ noteTypes = {
 }
 drumrolls = ["I", "5", "H", "6"]
 
+@phases.timed("konga.decode")
 def parseBin(filename, force=False, verbose=False, addBpm=False, addDelay=False, rounding=5, bpm=None):
-	file = open(filename, "rb")
-	size = os.fstat(file.fileno()).st_size
-	
-	def readStruct(format, seek=None):
-		if seek:
-			file.seek(seek)
-		return struct.unpack(order + format, file.read(struct.calcsize(order + format)))
+	with phases.phase("konga.io") as phase:
+		file = BinReader.open(filename, ">")
+		phase.add(bytes=file.size)
+	with file:
+		return parseCourse(file, force, verbose, addBpm, addDelay, rounding, bpm)
+
+def parseCourse(file, force=False, verbose=False, addBpm=False, addDelay=False, rounding=5, bpm=None):
+	size = file.size
 	
-	order = ">"
 	output = {
 		"bpm": None,
-		"offset": 0
+		"offset": 0,
+		"notes": 0
 	}
 	chart = []
-	magic = readStruct("I")[0]
+	magic = file.unpack("I")[0]
 	
 	frame = 1 / 60
 	spawnToOffset = 0.6095
@@ -69,7 +81,7 @@ def parseBin(filename, force=False, verbose=False, addBpm=False, addDelay=False,
 	
 	if magic == 0x20030730:
 		while True:
-			spawn, showLine, framesPerMeasure = readStruct("HBB")
+			spawn, showLine, framesPerMeasure = file.unpack("HBB")
 			if spawn == 0xffff:
 				break
 			
@@ -109,7 +121,7 @@ def parseBin(filename, force=False, verbose=False, addBpm=False, addDelay=False,
 					framesPerMeasure
 				))
 			
-			notes = readStruct("48B")
+			notes = file.unpack("48B")
 			for i in range(len(notes)):
 				try:
 					noteTja = noteTypes[notes[i]]
@@ -119,7 +131,7 @@ def parseBin(filename, force=False, verbose=False, addBpm=False, addDelay=False,
 					command.append(info)
 					noteTja = "?"
 					if not force:
-						raise
+						raise UnknownNoteError("Unknown note {:x} at offset {:x}".format(notes[i], file.tell() - 48 + i)) from None
 				if noteTja in drumrolls:
 					if isDrumroll == noteTja:
 						tja.append("0")
@@ -146,20 +158,107 @@ def parseBin(filename, force=False, verbose=False, addBpm=False, addDelay=False,
 		if isDrumroll:
 			tja[-1] = "8"
 		
+		# Drumroll ends and the beats inside them are not notes
+		output["notes"] = sum(1 for note in tja if note != "0" and note != "8")
 		tja = [tja[i : i + 48] for i in range(0, len(tja), 48)]
-		for i in range(len(tja)):
-			for line in commands[i]:
-				chart.append(line)
-			chart.append(compress(tja[i]) + ",")
+		phases.count("konga.decode", size, len(commands))
+		with phases.phase("tja.compress", records=len(tja)):
+			for i in range(len(tja)):
+				for line in commands[i]:
+					chart.append(line)
+				chart.append(compress(tja[i]) + ",")
 	else:
 		chart.append("//magic {:x}".format(magic))
 		if not force:
 			raise Exception("Magic does not match")
-	file.close()
 	
 	output["chart"] = "\n".join(chart)
 	return output
 
+@phases.timed("tja.format")
+def buildTja(name, filenames, force=False, verbose=False, addBpm=True, addDelay=True, rounding=5, log=None, throughput=None, courses=None):
+	# Courses of a song are parsed in order, each one continues from the
+	# BPM of the first. Parsed courses are appended to courses if given.
+	output = [
+		"TITLE:{}".format(name),
+		"SUBTITLE:--",
+		"BPM:",
+		"WAVE:{}.ogg".format(name),
+		"OFFSET:-0",
+		"DEMOSTART:0",
+		"GAME:Bongo",
+		""
+	]
+	bpm = None
+	offset = None
+	for filename in filenames:
+		if log:
+			log(filename)
+		try:
+			with phases.profileFile(filename):
+				tja = parseBin(filename, force, verbose, addBpm, addDelay, rounding, bpm)
+		except Exception as e:
+			if throughput:
+				throughput.fail(e)
+			raise
+		if throughput:
+			throughput.done(1, os.path.getsize(filename), 0, tja["notes"])
+		if courses != None:
+			courses.append(tja)
+		
+		if bpm == None and tja["bpm"]:
+			bpm = tja["bpm"]
+			output[2] += str(bpm)
+		if offset == None and tja["offset"]:
+			offset = tja["offset"]
+			output[4] = output[4][:-2] + str(offset)
+		
+		output += [
+			"COURSE:{}".format(courseName(filename)),
+			"LEVEL:",
+			"BALLOON:",
+			"SCOREINIT:",
+			"SCOREDIFF:",
+			""
+		]
+		if verbose:
+			output.append("//" + filename)
+		output += [
+			"#START",
+			"#GAMETYPE Konga",
+			tja["chart"],
+			"#END",
+			""
+		]
+	return "\n".join(output)
+
+def tjaFileName(filename):
+	# Courses of a song are named song_e.bin, song_n.bin and song_h.bin
+	outFile, ext = os.path.splitext(filename)
+	if outFile.endswith("_h") or outFile.endswith("_n") or outFile.endswith("_e"):
+		outFile = outFile[:-2]
+	if ext == ".bin":
+		ext = ""
+	return outFile + ext + ".tja"
+
+def songCourses(filenames):
+	# Returns the TJA file of every song with its courses, in the order
+	# they are converted
+	songs = {}
+	for filename in filenames:
+		songs.setdefault(tjaFileName(filename), []).append(filename)
+	return [(outFile, sorted(courses, key=cmp_to_key(sortFiles))) for outFile, courses in sorted(songs.items())]
+
+def courseName(filename):
+	chartName = os.path.splitext(os.path.split(filename)[1])[0]
+	if chartName.endswith("_h"):
+		return "Hard"
+	elif chartName.endswith("_n"):
+		return "Normal"
+	elif chartName.endswith("_e"):
+		return "Easy"
+	return ""
+
 def compress(notes):
 	notes = reduceNotes(notes, 2)
 	notes = reduceNotes(notes, 3)
@@ -178,6 +277,9 @@ def reduceNotes(notes, amount):
 	return notes
 
 def existingFile(arg):
+	import argparse
+	import glob
+	
 	if "*" in arg or "?" in arg:
 		argGlob = glob.glob(arg)
 		if argGlob:
@@ -199,8 +301,14 @@ def fileReplace(filename):
 def sortFiles(a, b):
 	return (1 if fileReplace(a) > fileReplace(b) else -1)
 
-if __name__ == "__main__":
+def main(argv=None, prog=None):
+	import argparse
+	
+	if argv == None:
+		argv = sys.argv[1:]
+	
 	parser = argparse.ArgumentParser(
+		prog=prog,
 		description="konga2tja {0}".format(konga2tja_version)
 	)
 	parser.add_argument(
@@ -257,16 +365,18 @@ if __name__ == "__main__":
 		default=5,
 		help="Round numbers to a given precision"
 	)
-	if len(sys.argv) == 1:
+	phases.addArguments(parser)
+	metrics.addArguments(parser)
+	verify.addArguments(parser)
+	journal.addArguments(parser)
+	if len(argv) == 0:
 		parser.print_help()
 	else:
-		args = parser.parse_args()
-		outFile = None
-		output = None
-		name = None
-		bpm = None
-		offset = None
-		
+		args = parser.parse_args(argv)
+		if args.journal and (args.dryrun or args.verify or args.record):
+			parser.error("--journal records the .tja files written, it can't be used with --dryrun, --verify or --record")
+		if args.resume and not args.journal:
+			parser.error("--resume needs a --journal")
 		input = getattr(args, "file.bin")
 		inputFiles = []
 		for file in input:
@@ -276,71 +386,47 @@ if __name__ == "__main__":
 				inputFiles.append(file)
 		inputFiles = sorted(inputFiles, key=cmp_to_key(sortFiles))
 		
-		for filename in inputFiles:
-			print(filename)
-			prevOutFile = outFile
-			prevName = name
-			
-			outFile,ext = os.path.splitext(filename)
-			if outFile.endswith("_h") or outFile.endswith("_n") or outFile.endswith("_e"):
-				outFile = outFile[:-2]
-			if ext == ".bin":
-				ext = ""
-			outFile = outFile + ext + ".tja"
-			name = os.path.splitext(os.path.split(outFile)[1])[0]
-			
-			if prevOutFile != outFile:
-				if output and not args.dryrun:
-					with open(prevOutFile, "w+") as file:
-						file.write("\n".join(output))
-				output = [
-					"TITLE:{}".format(name),
-					"SUBTITLE:--",
-					"BPM:",
-					"WAVE:{}.ogg".format(name),
-					"OFFSET:-0",
-					"DEMOSTART:0",
-					"GAME:Bongo",
-					""
-				]
-				bpm = None
-				offset = None
-			
-			course = ""
-			chartName = os.path.splitext(os.path.split(filename)[1])[0]
-			if chartName.endswith("_h"):
-				course = "Hard"
-			elif chartName.endswith("_n"):
-				course = "Normal"
-			elif chartName.endswith("_e"):
-				course = "Easy"
-			tja = parseBin(filename, args.force, args.verbose, args.bpm, args.delay, args.rounding, bpm)
-			
-			if bpm == None and tja["bpm"]:
-				bpm = tja["bpm"]
-				output[2] += str(bpm)
-			if offset == None and tja["offset"]:
-				offset = tja["offset"]
-				output[4] = output[4][:-2] + str(offset)
-			
-			output += [
-				"COURSE:{}".format(course),
-				"LEVEL:",
-				"BALLOON:",
-				"SCOREINIT:",
-				"SCOREDIFF:",
-				""
-			]
-			if args.verbose:
-				output.append("//" + filename)
-			output += [
-				"#START",
-				"#GAMETYPE Konga",
-				tja["chart"],
-				"#END",
-				""
-			]
-		output = "\n".join(output)
-		if output and not args.dryrun:
-			with open(outFile, "w+") as file:
-				file.write(output)
+		manifest = verify.start(args)
+		phases.start(args)
+		reporter = metrics.start(args, len(inputFiles))
+		throughput = reporter and reporter.metrics
+		journalFile, records = journal.start(args)
+		try:
+			remaining = len(inputFiles)
+			for outFile, filenames in groupby(inputFiles, key=tjaFileName):
+				name = os.path.splitext(os.path.split(outFile)[1])[0]
+				filenames = list(filenames)
+				remaining -= len(filenames)
+				if throughput:
+					throughput.queue(remaining, len(filenames))
+				key = "tja " + os.path.abspath(outFile)
+				if journal.finished(records.get(key), [os.path.abspath(filename) for filename in filenames], [os.path.abspath(outFile)]):
+					journal.removePart(outFile)
+					if throughput:
+						throughput.skip(len(filenames))
+					continue
+				hashes = journalFile and journal.inputHashes(filenames)
+				output = buildTja(name, filenames, args.force, args.verbose, args.bpm, args.delay, args.rounding, print, throughput)
+				if output and manifest:
+					manifest.add(outFile, output)
+				elif output and not args.dryrun:
+					with phases.phase("tja.write", len(output)):
+						with journal.AtomicFile(outFile, "w") as file:
+							file.write(output)
+					if journalFile:
+						journalFile.record(key, hashes, [os.path.abspath(outFile)])
+					if throughput:
+						throughput.done(0, 0, len(output))
+			if throughput:
+				throughput.queue(0, 0)
+		finally:
+			if journalFile:
+				journalFile.close()
+			if reporter:
+				reporter.stop()
+			phases.finish(args)
+		if manifest and not manifest.finish():
+			return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
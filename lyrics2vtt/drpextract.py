@@ -1,47 +1,374 @@
 #!/usr/bin/env python3
 
 import os
-import zlib
-import struct
+import sys
 
-def extractFile(inputFile):
+if not __package__:
+	# Run as a script from a checkout rather than the installed package
+	sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fumentools.binreader import BinReader, getStruct
+from fumentools import phases
+from fumentools import journal
+
+chunkSize = 0x10000
+entryHeaderSize = 0x64
+
+def openArchive(inputFile):
+	# Archives already in memory are read through a reader, their entry
+	# chunks are then slices of the buffer
 	if type(inputFile) is str:
-		file = open(inputFile, "rb")
+		return open(inputFile, "rb")
+	elif hasattr(inputFile, "read"):
+		return inputFile
 	else:
-		file = inputFile
-	inputFileName = os.path.split(file.name)[1]
-	size = os.fstat(file.fileno()).st_size
-	
-	order = ">"
-	def readStruct(format, seek=None):
-		if seek != None:
-			file.seek(seek)
-		return struct.unpack(order + format, file.read(struct.calcsize(order + format)))
-	
-	fileCount = readStruct("H", 0x16)[0]
-	file.seek(0x60)
-	for i in range(0, fileCount):
-		name = file.read(0x40)
-		index = name.find(0x0)
-		if index != -1:
-			name = name[:index]
-		file.seek(0x10, os.SEEK_CUR)
-		fsize = readStruct("5I")
-		data = file.read(fsize[1] - 4)
-		if fsize[0] > 0x50:
-			try:
-				data = zlib.decompress(data)
-			except zlib.error:
-				debugPrint("Error while extracting '{}' on file '{}': zlib decompress error".format(inputFileName, name.decode(errors="ignore")))
-				raise
+		return BinReader(inputFile)
+
+def iterEntries(inputFile):
+	file = openArchive(inputFile)
+	inputFileName = os.path.split(getattr(file, "name", ""))[1]
+	
+	# Entry headers are parsed from a mapping of the file, payloads are
+	# still read from the file itself. A file that can't be mapped has its
+	# headers read one at a time, so no more than a header is held.
+	if isinstance(file, BinReader):
+		headers = file
+	else:
+		headers = BinReader.fromFile(file, mapOnly=True)
+		if headers:
+			headers.file = None
+	if headers:
+		size = headers.size
+		unpackHeader = headers.unpack
+	else:
+		size = file.seek(0, os.SEEK_END)
+		unpackHeader = lambda format, offset: readHeader(file, format, offset)
+	
+	try:
+		fileCount = unpackHeader("H", 0x16)[0]
+		offset = 0x60
+		for i in range(0, fileCount):
+			# name 0x40, dummy 0x10, sizes 4 * 5
+			name, *fsize = unpackHeader("64s16x5I", offset)
+			index = name.find(0x0)
+			if index != -1:
+				name = name[:index]
+			offset += entryHeaderSize
+			entry = {
+				"name": name,
+				"offset": offset,
+				"size": fsize[1] - 4,
+				"compressed": fsize[0] > 0x50
+			}
+			entry["chunks"] = readChunks(file, entry, inputFileName)
+			yield entry
+			offset = min(offset + entry["size"], size)
+			if offset >= size:
+				break
+	finally:
+		if headers and headers is not file:
+			headers.close()
+
+def readHeader(file, format, offset):
+	import struct
+	
+	structFormat = getStruct(format)
+	file.seek(offset)
+	data = file.read(structFormat.size)
+	if len(data) < structFormat.size:
+		raise struct.error("unpack requires a buffer of {} bytes".format(structFormat.size))
+	return structFormat.unpack(data)
+
+def readChunks(file, entry, inputFileName=""):
+	return inflateChunks(readRawChunks(file, entry), entry, inputFileName)
+
+def readRawChunks(file, entry):
+	# Entries are read in bounded chunks from their own offset, so a chunk
+	# iterator keeps working after the archive has moved on to the next entry
+	offset = entry["offset"]
+	remaining = entry["size"]
+	while remaining > 0:
+		with phases.phase("drp.io") as phase:
+			file.seek(offset)
+			data = file.read(min(chunkSize, remaining))
+			phase.add(bytes=len(data))
+		if not data:
+			break
+		offset += len(data)
+		remaining -= len(data)
+		yield data
+
+def inflateChunks(rawChunks, entry, inputFileName=""):
+	import zlib
+	
+	if not entry["compressed"]:
+		for data in rawChunks:
+			yield data
+		return
+	decompressor = zlib.decompressobj()
+	try:
+		for data in rawChunks:
+			with phases.phase("zlib.inflate", len(data)):
+				data = decompressor.decompress(data, chunkSize)
+			while data:
+				yield data
+				with phases.phase("zlib.inflate"):
+					data = decompressor.decompress(decompressor.unconsumed_tail, chunkSize)
+		data = decompressor.flush()
+		if data:
+			yield data
+		if not decompressor.eof:
+			raise zlib.error("Error -5 while decompressing data: incomplete or truncated stream")
+	except zlib.error:
+		debugPrint("Error while extracting '{}' on file '{}': zlib decompress error".format(inputFileName, entry["name"].decode(errors="ignore")))
+		raise
+
+def extractFile(inputFile):
+	for entry in iterEntries(inputFile):
+		data = b"".join(entry["chunks"])
+		phases.count("drp.extract", len(data), 1)
 		yield {
-			"name": name,
+			"name": entry["name"],
 			"data": data
 		}
-		if file.tell() >= size:
-			break
+
+def readToc(inputFile):
+	# Walks the entry headers only, seeking past every payload
+	return [{
+		"name": entry["name"],
+		"offset": entry["offset"],
+		"size": entry["size"],
+		"compressed": entry["compressed"]
+	} for entry in iterEntries(inputFile)]
+
+def saveToc(toc, tocFile, inputFile):
+	import json
+	
+	stat = os.fstat(inputFile.fileno())
+	with open(tocFile, "w") as file:
+		json.dump({
+			"size": stat.st_size,
+			"mtime": stat.st_mtime_ns,
+			"entries": [{
+				"name": entry["name"].decode("latin-1"),
+				"offset": entry["offset"],
+				"size": entry["size"],
+				"compressed": entry["compressed"]
+			} for entry in toc]
+		}, file)
+
+def loadToc(tocFile, inputFile):
+	import json
+	
+	try:
+		with open(tocFile, "r") as file:
+			saved = json.load(file)
+	except (OSError, ValueError):
+		return None
+	stat = os.fstat(inputFile.fileno())
+	if saved.get("size") != stat.st_size or saved.get("mtime") != stat.st_mtime_ns:
+		return None
+	toc = []
+	for entry in saved["entries"]:
+		entry["name"] = entry["name"].encode("latin-1")
+		toc.append(entry)
+	return toc
+
+class DrpArchive:
+	def __init__(self, inputFile, tocFile=None):
+		self.file = openArchive(inputFile)
+		self.fileName = os.path.split(getattr(self.file, "name", ""))[1]
+		self.toc = None
+		if tocFile:
+			self.toc = loadToc(tocFile, self.file)
+		if self.toc is None:
+			self.toc = readToc(self.file)
+			if tocFile:
+				saveToc(self.toc, tocFile, self.file)
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+	
+	def __len__(self):
+		return len(self.toc)
+	
+	def list(self):
+		return [entry["name"] for entry in self.toc]
+	
+	def getEntry(self, name):
+		# Entries can be looked up by index, since names can be blank or repeat
+		if type(name) is int:
+			return self.toc[name]
+		if type(name) is str:
+			name = name.encode("utf-8")
+		for entry in self.toc:
+			if entry["name"] == name:
+				return entry
+		raise KeyError(name)
+	
+	def open(self, name):
+		return readChunks(self.file, self.getEntry(name), self.fileName)
+	
+	def read(self, name):
+		return b"".join(self.open(name))
+	
+	def close(self):
+		self.file.close()
+
+def outputPaths(toc, path, ext="bin"):
+	unk = 0
+	for entry in toc:
+		if path == "-":
+			yield None
+			continue
+		name = entry["name"].decode(errors="ignore")
+		outFileName = strFileName(name).strip("/")
+		if not outFileName:
+			unk += 1
+			outFileName = "unknown{}".format(unk)
+		outFilePath = os.path.join(path, "{}{}".format(outFileName, "." + ext if ext else ""))
+		outFilePath = "/".join([x for x in outFilePath.split("/") if x != ".." and x != ""])
+		yield outFilePath
+
+@phases.timed("drp.write")
+def writeEntry(chunks, outFilePath, out=None):
+	# Without a path the chunks are streamed to out, or returned whole when
+	# they have to wait for the entries before them to be written
+	if outFilePath is None:
+		if out is None:
+			return b"".join(chunks)
+		for chunk in chunks:
+			out.write(chunk)
+		return
+	with journal.AtomicFile(outFilePath) as out:
+		for chunk in chunks:
+			out.write(chunk)
+
+def copyRange(inFile, offset, size, outFile):
+	# Stored entries are copied between the file descriptors by the kernel,
+	# falling back to positioned reads when that isn't supported. None of
+	# these move the archive's file position, so copies can run in parallel.
+	try:
+		inFd = inFile.fileno()
+		outFd = outFile.fileno()
+	except (AttributeError, OSError):
+		inFd = None
+	if inFd is not None:
+		outFile.flush()
+		for method in ("copy_file_range", "sendfile"):
+			if not hasattr(os, method):
+				continue
+			try:
+				while size > 0:
+					if method == "copy_file_range":
+						copied = os.copy_file_range(inFd, outFd, size, offset)
+					else:
+						copied = os.sendfile(outFd, inFd, offset, size)
+					if copied == 0:
+						break
+					offset += copied
+					size -= copied
+			except OSError:
+				continue
+			if size == 0:
+				return
+		if hasattr(os, "pread"):
+			while size > 0:
+				data = os.pread(inFd, min(chunkSize, size), offset)
+				if not data:
+					break
+				outFile.write(data)
+				offset += len(data)
+				size -= len(data)
+			return
+	for data in readRawChunks(inFile, {"offset": offset, "size": size}):
+		outFile.write(data)
+
+@phases.timed("drp.copy")
+def copyEntry(inFile, entry, outFilePath):
+	with journal.AtomicFile(outFilePath) as out:
+		copyRange(inFile, entry["offset"], entry["size"], out)
+
+def canCopyInParallel(file):
+	try:
+		file.fileno()
+	except (AttributeError, OSError):
+		return False
+	return hasattr(os, "pread")
+
+def extractAll(archive, path, ext="bin", jobs=1, debug=False, maxInFlightBytes=0x4000000):
+	paths = outputPaths(archive.toc, path, ext)
+	if jobs <= 1:
+		for index, outFilePath in enumerate(paths):
+			if debug and outFilePath:
+				debugPrint("Unpacking '{}' to '{}'".format(archive.toc[index]["name"].decode(errors="ignore"), outFilePath))
+			if outFilePath and not archive.toc[index]["compressed"]:
+				copyEntry(archive.file, archive.toc[index], outFilePath)
+				continue
+			writeEntry(archive.open(index), outFilePath, sys.stdout.buffer)
+		return
+	
+	# Payloads have to be read in order, inflating and writing them is
+	# handed to the pool. zlib releases the GIL, so the workers run in
+	# parallel. Results are collected oldest first, which keeps the output
+	# order and error reporting deterministic and bounds what is in flight.
+	# An entry whose path is still being written waits for that write, so
+	# the last of the entries with the same name wins, as when run serially.
+	from concurrent.futures import ThreadPoolExecutor
+	from collections import deque
+	
+	inFlight = deque()
+	inFlightBytes = 0
+	inFlightPaths = {}
+	copyStored = canCopyInParallel(archive.file)
+	def finishOldest():
+		future, size, outFilePath = inFlight.popleft()
+		if inFlightPaths.get(outFilePath) is future:
+			del inFlightPaths[outFilePath]
+		data = future.result()
+		if data is not None:
+			sys.stdout.buffer.write(data)
+		return size
+	
+	with ThreadPoolExecutor(jobs) as executor:
+		for entry, outFilePath in zip(archive.toc, paths):
+			while inFlight and (len(inFlight) >= jobs * 2 or inFlightBytes + entry["size"] > maxInFlightBytes or outFilePath in inFlightPaths):
+				inFlightBytes -= finishOldest()
+			if debug and outFilePath:
+				debugPrint("Unpacking '{}' to '{}'".format(entry["name"].decode(errors="ignore"), outFilePath))
+			if outFilePath and copyStored and not entry["compressed"]:
+				future = executor.submit(copyEntry, archive.file, entry, outFilePath)
+				size = 0
+			elif entry["size"] > maxInFlightBytes:
+				# Too big to hold, streamed on this thread once the pool is idle
+				writeEntry(readChunks(archive.file, entry, archive.fileName), outFilePath, sys.stdout.buffer)
+				continue
+			else:
+				payload = b"".join(readRawChunks(archive.file, entry))
+				chunks = inflateChunks((payload,), entry, archive.fileName)
+				future = executor.submit(writeEntry, chunks, outFilePath)
+				size = len(payload)
+			inFlight.append((future, size, outFilePath))
+			if outFilePath:
+				inFlightPaths[outFilePath] = future
+			inFlightBytes += size
+		while inFlight:
+			finishOldest()
+
+def jobCount(arg):
+	import argparse
+	
+	jobs = int(arg)
+	if jobs < 0:
+		raise argparse.ArgumentTypeError("Number of jobs can't be negative")
+	return jobs
 
 def existingDir(arg):
+	import argparse
+	
 	if arg == "-" or os.path.isdir(arg):
 		return arg
 	else:
@@ -54,10 +381,13 @@ def strFileName(fileName):
 def debugPrint(*args, **kwargs):
 	print(*args, file=sys.stderr, **kwargs)
 
-if __name__ == "__main__":
-	import argparse, sys
+def main(argv=None, prog=None):
+	import argparse
 	
-	parser = argparse.ArgumentParser()
+	if argv == None:
+		argv = sys.argv[1:]
+	
+	parser = argparse.ArgumentParser(prog=prog)
 	parser.add_argument(
 		"file.drp",
 		help="Path to a compressed DRP file",
@@ -75,37 +405,58 @@ if __name__ == "__main__":
 		help="Set the extension for the output uncompressed files, default is 'bin'.",
 		default="bin"
 	)
+	parser.add_argument(
+		"-l", "--list",
+		help="List the entries in the archive without extracting them.",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--toc",
+		metavar="file.json",
+		help="Cache the table of contents in a file, so later runs can skip reading the entry headers."
+	)
+	parser.add_argument(
+		"-j", "--jobs",
+		metavar="1",
+		help="Inflate and write this many entries in parallel, 0 uses every core.",
+		type=jobCount,
+		default=1
+	)
 	parser.add_argument(
 		"-v", "--debug",
 		help="Print verbose debug information.",
 		action="store_true"
 	)
-	if len(sys.argv) == 1:
+	phases.addArguments(parser)
+	if len(argv) == 0:
 		parser.print_help()
 	else:
-		args = parser.parse_args()
+		args = parser.parse_args(argv)
 		inputFile = getattr(args, "file.drp")
+		archive = DrpArchive(inputFile, args.toc)
+		if args.list:
+			for index, entry in enumerate(archive.toc):
+				print("{}\t{}\t{}\t{}".format(
+					index,
+					entry["size"],
+					"zlib" if entry["compressed"] else "stored",
+					entry["name"].decode(errors="ignore")
+				))
+			return
 		path = args.o
-		drpContents = extractFile(inputFile)
 		if not path:
 			path = os.path.splitext(inputFile.name)[0]
 			if not os.path.isdir(path):
 				os.makedirs(path)
-		unk = 0
+		jobs = args.jobs or os.cpu_count() or 1
 		if args.debug and path != "-":
 			debugPrint("Extracting '{}' to '{}'".format(os.path.split(inputFile.name)[1], path))
-		for outFile in extractFile(inputFile):
-			if path == "-":
-				sys.stdout.buffer.write(outFile["data"])
-			else:
-				name = outFile["name"].decode(errors="ignore")
-				outFileName = strFileName(name).strip("/")
-				if not outFileName:
-					unk += 1
-					outFileName = "unknown{}".format(unk)
-				outFilePath = os.path.join(path, "{}{}".format(outFileName, "." + args.ext if args.ext else ""))
-				outFilePath = "/".join([x for x in outFilePath.split("/") if x != ".." and x != ""])
-				if args.debug:
-					debugPrint("Unpacking '{}' to '{}'".format(name, outFilePath))
-				with open(outFilePath, "wb+") as out:
-					out.write(outFile["data"])
+		phases.start(args)
+		try:
+			with phases.profileFile(inputFile.name):
+				extractAll(archive, path, args.ext, jobs, args.debug)
+		finally:
+			phases.finish(args)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import struct
+
+# Entries larger than this are stored zlib-compressed, drpextract inflates
+# any entry whose first size field is above it
+compressThreshold = 0x50
+
+def packEntry(name, source, level=9):
+	import zlib
+
+	if type(source) is str:
+		with open(source, "rb") as file:
+			data = file.read()
+	else:
+		data = source
+	if type(name) is str:
+		name = name.encode("utf-8")
+	name = name[:0x40]
+
+	size = len(data)
+	if size > compressThreshold:
+		data = zlib.compress(data, level)
+	# Name, 0x10 unknown bytes, then the five size fields: the extractor
+	# reads the first as the uncompressed size and the second as the
+	# payload size plus 4
+	return b"".join((
+		name,
+		bytes(0x40 - len(name) + 0x10),
+		struct.pack(">5I", size, len(data) + 4, len(data) + 4, 0, size),
+		data
+	))
+
+def packFiles(outputFile, entries, level=9, jobs=1, processes=False, maxInFlightBytes=0x4000000):
+	# Entries are (name, data) pairs, where data can also be a path to read
+	# the entry from. Entries are compressed in a pool and written in order
+	# as they finish, so only a bounded number are in memory at once.
+	from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+	from collections import deque
+
+	if type(outputFile) is str:
+		file = open(outputFile, "wb+")
+	else:
+		file = outputFile
+
+	start = file.tell()
+	header = bytearray(0x60)
+	if hasattr(entries, "__len__"):
+		struct.pack_into(">H", header, 0x16, len(entries))
+	file.write(header)
+
+	count = 0
+	inFlight = deque()
+	inFlightBytes = 0
+	def finishOldest():
+		future, size = inFlight.popleft()
+		file.write(future.result())
+		return size
+
+	Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+	with Executor(jobs) as executor:
+		for name, source in entries:
+			size = os.path.getsize(source) if type(source) is str else len(source)
+			while inFlight and (len(inFlight) >= jobs * 2 or inFlightBytes + size > maxInFlightBytes):
+				inFlightBytes -= finishOldest()
+			inFlight.append((executor.submit(packEntry, name, source, level), size))
+			inFlightBytes += size
+			count += 1
+		while inFlight:
+			finishOldest()
+
+	if count > 0xffff:
+		raise ValueError("Too many entries for a DRP archive: {}".format(count))
+	if not hasattr(entries, "__len__"):
+		# The entry count is only known now, patch it into the header
+		end = file.tell()
+		file.seek(start + 0x16)
+		file.write(struct.pack(">H", count))
+		file.seek(end)
+
+	if type(outputFile) is str:
+		file.close()
+	return count
+
+def entryName(filename, ext="bin"):
+	name = os.path.split(filename)[1]
+	if ext and name.endswith("." + ext):
+		name = name[:-len(ext) - 1]
+	return name
+
+def entryNames(filenames, ext="bin"):
+	# drpextract names blank entries unknown1, unknown2... in the order they
+	# come in, only names that follow that count are blanked again
+	names = []
+	unk = 0
+	for filename in filenames:
+		name = entryName(filename, ext)
+		if name == "unknown{}".format(unk + 1):
+			unk += 1
+			name = ""
+		names.append(name)
+	return names
+
+def existingFile(arg):
+	import argparse
+
+	if os.path.isfile(arg):
+		return arg
+	raise argparse.ArgumentTypeError("File not found: '{}'".format(arg))
+
+def main(argv=None, prog=None):
+	import argparse
+
+	if argv == None:
+		argv = sys.argv[1:]
+
+	parser = argparse.ArgumentParser(prog=prog)
+	parser.add_argument(
+		"file.bin",
+		nargs="+",
+		type=existingFile,
+		help="Files to add to the archive, in order"
+	)
+	parser.add_argument(
+		"-o",
+		metavar="file.drp",
+		help="Set the filename of the output DRP file.",
+		required=True
+	)
+	parser.add_argument(
+		"--ext",
+		metavar="bin",
+		help="Extension to remove from the input filenames to get the entry names, default is 'bin'.",
+		default="bin"
+	)
+	parser.add_argument(
+		"--keep-names",
+		help="Keep names like unknown1 as they are, instead of blanking the ones drpextract gave to entries without a name.",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--level",
+		metavar="9",
+		help="zlib compression level, from 0 to 9.",
+		type=int,
+		choices=range(10),
+		default=9
+	)
+	parser.add_argument(
+		"-j", "--jobs",
+		metavar="1",
+		help="Compress this many entries in parallel, 0 uses every core.",
+		type=int,
+		default=1
+	)
+	parser.add_argument(
+		"--processes",
+		help="Compress in worker processes instead of threads.",
+		action="store_true"
+	)
+	if len(argv) == 0:
+		parser.print_help()
+	else:
+		args = parser.parse_args(argv)
+		inputFiles = getattr(args, "file.bin")
+		if args.keep_names:
+			names = [entryName(filename, args.ext) for filename in inputFiles]
+		else:
+			names = entryNames(inputFiles, args.ext)
+		entries = list(zip(names, inputFiles))
+		jobs = max(args.jobs, 0) or os.cpu_count() or 1
+		packFiles(args.o, entries, args.level, jobs, args.processes)
+
+if __name__ == "__main__":
+	main()
@@ -1,104 +1,234 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+
+if not __package__:
+	# Run as a script from a checkout rather than the installed package
+	sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fumentools.binreader import BinReader
+from fumentools import phases
+from fumentools import verify
+from fumentools import journal
 
 lyrics2vtt_version = "v1.1"
 
 def readDrp(inputFile):
-	import drpextract
-	import xml.etree.ElementTree as ET
+	try:
+		from . import drpextract
+	except ImportError:
+		import drpextract
 	
-	for outFile in drpextract.extractFile(inputFile):
-		xmlContent = outFile["data"]
+	# Only the first entry is needed, the rest of the archive is never read
+	for entry in drpextract.iterEntries(inputFile):
+		for lyric in parseXml(entry["chunks"]):
+			yield lyric
 		break
-	tree = ET.ElementTree(ET.fromstring(xmlContent))
-	
-	lyrics = []
-	root = tree.getroot()
-	if root.tag == "DB_DATA":
-		for dataset in root:
-			if dataset.tag == "DATA_SET":
-				time = None
-				text = None
-				for data in dataset:
-					if data.tag == "words":
-						if data.text == None:
-							text = b""
-						else:
-							text = data.text.encode("utf-8", "ignore")
-					elif data.tag == "wordsTime":
-						try:
-							time = float(data.text)
-						except ValueError:
-							pass
-				if time != None and text != None:
-					lyrics.append({
-						"time": time,
-						"text": text
-					})
-	return lyrics
 
-def readBin(inputFile):
-	import struct
+def parseXml(chunks):
+	import xml.etree.ElementTree as ET
+	
+	# The XML is parsed as it is inflated, each DATA_SET is dropped from the
+	# tree once it has been read so only one is held in memory at a time
+	parser = ET.XMLPullParser(("start", "end"))
+	depth = 0
+	root = None
+	def readEvents():
+		nonlocal depth, root
+		for event, element in parser.read_events():
+			if event == "start":
+				depth += 1
+				if depth == 1:
+					root = element
+				continue
+			depth -= 1
+			if depth != 1:
+				continue
+			if root.tag == "DB_DATA" and element.tag == "DATA_SET":
+				lyric = readDataSet(element)
+				if lyric:
+					phases.count("xml.parse", records=1)
+					yield lyric
+			root.remove(element)
 	
+	for chunk in chunks:
+		with phases.phase("xml.parse", len(chunk)):
+			parser.feed(chunk)
+		for lyric in readEvents():
+			yield lyric
+	parser.close()
+	for lyric in readEvents():
+		yield lyric
+
+def readDataSet(dataset):
+	time = None
+	text = None
+	for data in dataset:
+		if data.tag == "words":
+			if data.text == None:
+				text = b""
+			else:
+				text = data.text.encode("utf-8", "ignore")
+		elif data.tag == "wordsTime":
+			try:
+				time = float(data.text)
+			except ValueError:
+				pass
+	if time != None and text != None:
+		return {
+			"time": time,
+			"text": text
+		}
+
+headerSize = 0x100
+
+def readLyrics(inputFile):
 	if type(inputFile) is str:
 		file = open(inputFile, "rb")
 	else:
 		file = inputFile
-	size = os.fstat(file.fileno()).st_size
-	
-	order = ""
+	header = file.read(headerSize)
+	format = sniffFormat(header, os.fstat(file.fileno()).st_size)
+	if format == None:
+		# Unrecognised, go by the extension like older versions did
+		format = "drp" if os.path.splitext(file.name)[1] == ".drp" else "bin"
+	if format == "drp":
+		return readDrp(file)
+	else:
+		return readBin(file, header)
+
+def sniffFormat(header, size):
+	# Classifies a file from its first headerSize bytes, returns "drp",
+	# "lzss10", "lzss11", "bin-big", "bin-little" or None
+	import struct
 	
-	def readStruct(format, seek=None):
-		if seek != None:
-			file.seek(seek)
-		return struct.unpack(order + format, file.read(struct.calcsize(order + format)))
+	if len(header) < 0x10:
+		return None
+	if len(header) >= 0xc4:
+		# DRP: entry count at 0x16, then the first entry's name and sizes
+		fileCount = struct.unpack_from(">H", header, 0x16)[0]
+		name = header[0x60:0xa0]
+		nameEnd = name.find(0x0)
+		fsize = struct.unpack_from(">5I", header, 0xb0)
+		if fileCount != 0 and nameEnd != -1 and all(0x20 <= x < 0x7f for x in name[:nameEnd]) \
+			and not any(name[nameEnd:]) and 4 <= fsize[1] <= size - 0xc0:
+			return "drp"
+	if any(header[0x4:0x10]):
+		if header[0] == 0x10 or header[0] == 0x11:
+			return "lzss10" if header[0] == 0x10 else "lzss11"
+		return None
+	lengthBig, = struct.unpack_from(">I", header, 0x0)
+	lengthLittle, = struct.unpack_from("<I", header, 0x0)
+	if min(lengthBig, lengthLittle) > (size - 0x10) // 0x90 + 1:
+		return None
+	return "bin-big" if lengthBig < lengthLittle else "bin-little"
+
+@phases.timed("lyrics.decode")
+def readBin(inputFile, header=None):
+	# Files are read in one go, a header that has already been read for
+	# sniffing the format is reused rather than read again. Data that is
+	# already in memory is parsed in place.
+	if type(inputFile) is str or hasattr(inputFile, "read"):
+		with phases.phase("lyrics.io") as phase:
+			if type(inputFile) is str:
+				file = open(inputFile, "rb")
+			else:
+				file = inputFile
+			if header == None:
+				data = file.read()
+			else:
+				data = bytearray(header)
+				data += file.read()
+			file.close()
+			phase.add(bytes=len(data))
+	else:
+		data = inputFile
+	reader = BinReader(data)
 	
-	blank = readStruct(">III", 0x4)
-	if sum(blank) != 0:
-		import lzss3
+	if any(reader.unpackFrom("III", 0x4)):
+		try:
+			from . import lzss3
+		except ImportError:
+			import lzss3
 		
-		file.seek(0x0)
-		contents = lzss3.decompress_file(file)
-		file.close()
-		file = FileObj(contents)
-		size = len(file.array)
-	
-	lengthBig = readStruct(">I", 0x0)[0]
-	lengthLittle = readStruct("<I", 0x0)[0]
+		reader = BinReader(lzss3.decompress_bytes(data))
+	size = reader.size
+	
+	lengthBig = reader.unpackFrom(">I", 0x0)[0]
+	lengthLittle = reader.unpackFrom("<I", 0x0)[0]
 	if lengthBig < lengthLittle:
-		order = ">"
+		reader.order = ">"
 		length = lengthBig
 	else:
-		order = "<"
+		reader.order = "<"
 		length = lengthLittle
 	
-	file.seek(0xc, os.SEEK_CUR)
-	
-	lyrics = []
-	for lineNumber in range(length):
-		time = readStruct("f")[0]
-		file.seek(0xc, os.SEEK_CUR)
-		text = file.read(0x80)
-		index = text.find(0x0)
-		if index != -1:
-			text = text[:index]
-		text = text.decode("shift-jis", "ignore").encode("utf-8", "ignore")
+	# Lines are fixed 0x90 byte records: time 4, dummy 0xc, text 0x80
+	records = min(length, (size - 0x10) // 0x90)
+	end = 0x10 + records * 0x90
+	lyrics = [{
+		"time": time,
+		"text": text
+	} for time, text in zip(readTimes(reader, 0x10, records), readTexts(reader, 0x10, end))]
+	
+	if records < length and (records == 0 or end < size):
+		# The last line is cut short by the end of the file
+		time = reader.unpackFrom("f", end)[0]
 		lyrics.append({
 			"time": time,
-			"text": text
+			"text": readTexts(reader, end, end + 0x90)[0]
 		})
-		if file.tell() >= size:
-			break
 	
-	file.close()
+	phases.count("lyrics.decode", size, len(lyrics))
 	return lyrics
 
+def readTimes(reader, start, records):
+	return [time for time, in reader.iterUnpack("f140x", records, start)]
+
+def readTexts(reader, start, end):
+	texts = []
+	for textStart in range(start + 0x4 + 0xc, end, 0x90):
+		textEnd = reader.find(b"\0", textStart, textStart + 0x80)
+		if textEnd == -1:
+			textEnd = textStart + 0x80
+		texts.append(reader.view[textStart:textEnd])
+	return decodeTexts(texts)
+
+def decodeTexts(texts):
+	# Decoding every line in one call is much faster than line by line. The
+	# lines were cut at the first null byte, so a null can separate them, and
+	# Shift-JIS never uses it as the second byte of a character.
+	decoded = b"\0".join(texts).decode("shift-jis", "ignore").encode("utf-8", "ignore").split(b"\0")
+	if len(decoded) != len(texts):
+		decoded = [bytes(text).decode("shift-jis", "ignore").encode("utf-8", "ignore") for text in texts]
+	return decoded
+
 def writeVtt(lyrics, outputFile=None, inputFile=None):
+	return writeFormats(lyrics, ["vtt"], {"vtt": outputFile}, inputFile)["vtt"]
+
+def writeSrt(lyrics, outputFile=None, inputFile=None):
+	return writeFormats(lyrics, ["srt"], {"srt": outputFile}, inputFile)["srt"]
+
+def writeLrc(lyrics, outputFile=None, inputFile=None):
+	return writeFormats(lyrics, ["lrc"], {"lrc": outputFile}, inputFile)["lrc"]
+
+def writeJson(lyrics, outputFile=None, inputFile=None):
+	return writeFormats(lyrics, ["json"], {"json": outputFile}, inputFile)["json"]
+
+@phases.timed("lyrics.write")
+def writeFormats(lyrics, formats, outputFiles=None, inputFile=None):
+	# Writes every requested format in a single pass over the lyrics, each
+	# streamed to its own file. Formats without an output file are returned
+	# as bytes, written ones as True, or False for all if there are no lyrics.
 	import io
 	
-	if not lyrics or len(lyrics) == 0:
-		return False
+	outputFiles = outputFiles or {}
+	# lyrics can be a generator, it is only read once
+	lyrics = iter(lyrics or ())
+	first = next(lyrics, None)
+	if first == None:
+		return {format: False for format in formats}
 	
 	if inputFile:
 		if type(inputFile) is str:
@@ -106,100 +236,280 @@ def writeVtt(lyrics, outputFile=None, inputFile=None):
 		else:
 			filename = inputFile.name
 		filenameNoExt = os.path.splitext(filename)[0]
-		outputFile = outputFile or "{0}.vtt".format(filenameNoExt)
-	
-	vtt = []
-	vtt.append(b"WEBVTT Offset: 0")
-	vtt.append(b"")
-	length = len(lyrics)
-	for i in range(length):
-		if not lyrics[i]["text"]:
+	
+	outputs = []
+	for format in formats:
+		emitter = emitters[format]()
+		outputFile = outputFiles.get(format)
+		if inputFile:
+			outputFile = outputFile or "{0}.{1}".format(filenameNoExt, format)
+		if not outputFile:
+			buffer = io.BytesIO()
+			outputs.append((format, emitter, buffer.write, buffer))
 			continue
-		start = lyrics[i]["time"]
-		if i != length - 1:
-			end = lyrics[i + 1]["time"]
-		elif i != 0:
-			end = start * 2 - lyrics[i - 1]["time"]
+		if outputFile is sys.stdout.buffer or type(outputFile) is io.TextIOWrapper:
+			# stdout is written to but left open for whatever prints next
+			outputs.append((format, emitter, sys.stdout.buffer.write, sys.stdout.buffer))
+		elif type(outputFile) is str:
+			file = journal.AtomicFile(outputFile)
+			outputs.append((format, emitter, file.write, file))
 		else:
-			end = start + 5
-		vtt.append(timeSeconds(start) + b" --> " + timeSeconds(end))
-		vtt.append(lyrics[i]["text"])
-		vtt.append(b"")
-	vttContents = b"\n".join(vtt)
-	
-	if outputFile:
-		if type(outputFile) is str:
-			file = open(outputFile, "bw+")
+			outputs.append((format, emitter, outputFile.write, outputFile))
+	
+	try:
+		for format, emitter, write, file in outputs:
+			write(emitter.header())
+		cues = 0
+		for start, end, text in iterCues(first, lyrics):
+			cues += 1
+			for format, emitter, write, file in outputs:
+				write(emitter.cue(start, end, text))
+	except BaseException:
+		# Files that were being written are left as they were
+		for format, emitter, write, file in outputs:
+			if type(file) is journal.AtomicFile:
+				file.discard()
+		raise
+	phases.count("lyrics.write", records=cues)
+	
+	results = {}
+	for format, emitter, write, file in outputs:
+		write(emitter.footer())
+		if type(file) is io.BytesIO:
+			results[format] = file.getvalue()
 		else:
-			file = outputFile
-		if type(outputFile) is io.TextIOWrapper:
-			sys.stdout.buffer.write(vttContents)
+			if file is sys.stdout.buffer:
+				file.flush()
+			else:
+				file.close()
+			results[format] = True
+	return results
+
+class VttEmitter:
+	def header(self):
+		return b"WEBVTT Offset: 0\n"
+	
+	def cue(self, start, end, text):
+		return b"\n" + timeSeconds(start) + b" --> " + timeSeconds(end) + b"\n" + text + b"\n"
+	
+	def footer(self):
+		return b""
+
+class SrtEmitter:
+	def __init__(self):
+		self.count = 0
+	
+	def header(self):
+		return b""
+	
+	def cue(self, start, end, text):
+		self.count += 1
+		return b"".join((
+			b"\n" if self.count > 1 else b"",
+			str(self.count).encode(),
+			b"\n",
+			timeSeconds(start, hours=True, separator=","),
+			b" --> ",
+			timeSeconds(end, hours=True, separator=","),
+			b"\n",
+			text,
+			b"\n"
+		))
+	
+	def footer(self):
+		return b""
+
+class LrcEmitter:
+	# LRC only has start times, a blank line clears the text whenever a cue
+	# ends before the next one starts
+	def __init__(self):
+		self.end = None
+	
+	def header(self):
+		return b""
+	
+	def cue(self, start, end, text):
+		clear = self.clear() if self.end != None and self.end != start else b""
+		self.end = end
+		return clear + self.time(start) + text + b"\n"
+	
+	def footer(self):
+		return self.clear() if self.end != None else b""
+	
+	def clear(self):
+		return self.time(self.end) + b"\n"
+	
+	def time(self, seconds):
+		return b"[" + timeSeconds(seconds, hours=False, digits=2) + b"]"
+
+class JsonEmitter:
+	def __init__(self):
+		self.count = 0
+	
+	def header(self):
+		return b"["
+	
+	def cue(self, start, end, text):
+		import json
+		
+		self.count += 1
+		return (b"," if self.count > 1 else b"") + b"\n\t" + json.dumps({
+			"start": round(start, 3),
+			"end": round(end, 3),
+			"text": text.decode("utf-8", "ignore")
+		}, ensure_ascii=False).encode("utf-8")
+	
+	def footer(self):
+		return b"\n]\n"
+
+emitters = {
+	"vtt": VttEmitter,
+	"srt": SrtEmitter,
+	"lrc": LrcEmitter,
+	"json": JsonEmitter
+}
+
+def iterCues(first, lyrics):
+	# Each cue ends when the next line starts, the last one is given the
+	# same length as the line before it
+	prev = None
+	current = first
+	for lyric in lyrics:
+		if current["text"]:
+			yield current["time"], lyric["time"], current["text"]
+		prev = current
+		current = lyric
+	if current["text"]:
+		start = current["time"]
+		if prev != None:
+			end = start * 2 - prev["time"]
 		else:
-			file.write(vttContents)
-			file.close()
-		return True
-	else:
-		return vttContents
+			end = start + 5
+		yield start, end, current["text"]
 
-def timeSeconds(seconds):
+def timeSeconds(seconds, hours=None, separator=".", digits=3):
+	# hours can be True to always include them, or False to count minutes
+	# past an hour instead
 	m, s = divmod(seconds, 60)
 	h, m = divmod(m, 60)
-	if h == 0:
-		time = "{:02.0f}:{:06.3f}".format(m, s)
+	if hours == False:
+		m += h * 60
+		h = 0
+	s = "{:0{}.{}f}".format(s, digits + 3, digits).replace(".", separator)
+	if h == 0 and not hours:
+		time = "{:02.0f}:{}".format(m, s)
 	else:
-		time = "{:02.0f}:{:02.0f}:{:06.3f}".format(h, m, s)
+		time = "{:02.0f}:{:02.0f}:{}".format(h, m, s)
 	return time.encode()
 
-class FileObj:
-	def __init__(self, array):
-		self.array = array
-		self.pos = 0
-	def seek(self, target, whence = 0):
-		if whence == os.SEEK_CUR:
-			self.pos += target
-		elif whence == os.SEEK_END:
-			self.pos = len(self.array) - target
-		else:
-			self.pos = target
-	def read(self, size = -1):
-		pos = self.pos
-		if size == -1:
-			self.pos = len(self.array)
-			return self.array[pos:]
-		else:
-			self.pos = pos + size
-			return self.array[pos:pos + size]
-	def tell(self):
-		return self.pos
-	def close(self):
-		del self.array
+def formatList(arg):
+	import argparse
+	
+	formats = [x.strip().lower() for x in arg.split(",") if x.strip()]
+	for format in formats:
+		if format not in emitters:
+			raise argparse.ArgumentTypeError("Unknown format: '{}', choose from {}".format(format, ", ".join(emitters)))
+	if not formats:
+		raise argparse.ArgumentTypeError("No format given")
+	return list(dict.fromkeys(formats))
 
-if __name__=="__main__":
-	import argparse, sys
+def detectFormats(path):
+	if os.path.isdir(path):
+		for dirPath, dirNames, fileNames in os.walk(path):
+			dirNames.sort()
+			for fileName in sorted(fileNames):
+				filename = os.path.join(dirPath, fileName)
+				yield filename, detectFormat(filename)
+	else:
+		yield path, detectFormat(path)
+
+def detectFormat(inputFile):
+	try:
+		with open(inputFile, "rb") as file:
+			return sniffFormat(file.read(headerSize), os.fstat(file.fileno()).st_size)
+	except OSError:
+		return None
+
+def main(argv=None, prog=None):
+	import argparse
+	
+	if argv == None:
+		argv = sys.argv[1:]
 	
 	parser = argparse.ArgumentParser(
+		prog=prog,
 		description="lyrics2vtt {0}".format(lyrics2vtt_version)
 	)
 	parser.add_argument(
 		"file.drp",
-		help="Path to a Taiko no Tatsujin lyrics file, which can be .drp, .bin, or .cbin",
-		type=argparse.FileType("rb")
+		nargs="+",
+		help="Path to a Taiko no Tatsujin lyrics file, which can be .drp, .bin, or .cbin"
 	)
 	parser.add_argument(
 		"-o",
 		metavar="file.vtt",
-		help="Set the filename of the output subtitle file.",
-		type=argparse.FileType("bw+")
+		help="Set the filename of the output subtitle file, or set to '-' to print the output to stdout."
+	)
+	parser.add_argument(
+		"--format",
+		metavar="vtt,srt,lrc,json",
+		help="Comma separated list of subtitle formats to write, default is 'vtt'. With more than one, -o sets the filename without the extension.",
+		type=formatList,
+		default=["vtt"]
+	)
+	parser.add_argument(
+		"--detect",
+		help="Print the detected format of each file instead of converting, directories are searched recursively.",
+		action="store_true"
 	)
-	if len(sys.argv) == 1:
+	phases.addArguments(parser)
+	verify.addArguments(parser)
+	if len(argv) == 0:
 		parser.print_help()
 	else:
-		args = parser.parse_args()
-		inputFile = getattr(args, "file.drp")
-		filename = inputFile.name
-		fileExt = os.path.splitext(filename)[1]
-		if fileExt == ".drp":
-			lyrics = readDrp(inputFile)
+		args = parser.parse_args(argv)
+		inputFiles = getattr(args, "file.drp")
+		if args.detect:
+			for path in inputFiles:
+				for filename, format in detectFormats(path):
+					print("{}\t{}".format(format or "unknown", filename))
+		elif len(inputFiles) != 1:
+			parser.error("only one file can be converted at a time")
 		else:
-			lyrics = readBin(inputFile)
-		writeVtt(lyrics, args.o, inputFile)
+			inputFile = inputFiles[0]
+			try:
+				file = open(inputFile, "rb")
+			except OSError as e:
+				parser.error(e)
+			outputFiles = {}
+			if args.o == "-":
+				if len(args.format) != 1:
+					parser.error("only one format can be printed to stdout")
+				outputFiles[args.format[0]] = sys.stdout.buffer
+			elif args.o and len(args.format) == 1:
+				outputFiles[args.format[0]] = args.o
+			elif args.o:
+				for format in args.format:
+					outputFiles[format] = "{0}.{1}".format(os.path.splitext(args.o)[0], format)
+			manifest = verify.start(args)
+			if manifest and args.o == "-":
+				parser.error("--verify and --record can't be used with '-o -'")
+			phases.start(args)
+			try:
+				with phases.profileFile(inputFile):
+					lyrics = readLyrics(file)
+					if manifest:
+						# Converted in memory, only the digests are kept
+						results = writeFormats(lyrics, args.format)
+						for format, output in results.items():
+							if output:
+								manifest.add(outputFiles.get(format) or "{0}.{1}".format(os.path.splitext(inputFile)[0], format), output)
+					else:
+						writeFormats(lyrics, args.format, outputFiles, inputFile)
+			finally:
+				phases.finish(args)
+			if manifest and not manifest.finish():
+				return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
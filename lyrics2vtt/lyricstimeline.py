@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+	from . import lyrics2vtt
+except ImportError:
+	import lyrics2vtt
+
+# File layout, little endian: magic 4, count 4, text size 4, dummy 4,
+# then starts and ends as doubles, count + 1 text offsets and the UTF-8 text
+magic = b"LTL1"
+headerStruct = struct.Struct("<4sIII")
+
+class Timeline:
+	# Cues sorted by start time, with end times following the same rule as
+	# writeVtt. Lookups are bisections over the start and end arrays.
+	def __init__(self, starts, ends, offsets, text):
+		self.starts = starts
+		self.ends = ends
+		self.offsets = offsets
+		self.textData = text
+		self.mmap = None
+
+	@classmethod
+	def fromLyrics(cls, lyrics):
+		# Lines are sorted before the cue times are worked out, so that each
+		# cue ends at the next line in time and the ends are as sorted as
+		# the starts, which between() and at() bisect on
+		cues = []
+		lines = sorted(lyrics or (), key=lambda lyric: lyric["time"])
+		if lines:
+			cues = list(lyrics2vtt.iterCues(lines[0], iter(lines[1:])))
+		offsets = array("I", [0])
+		text = bytearray()
+		for start, end, cueText in cues:
+			text += cueText
+			offsets.append(len(text))
+		return cls(
+			array("d", [cue[0] for cue in cues]),
+			array("d", [cue[1] for cue in cues]),
+			offsets,
+			bytes(text)
+		)
+
+	@classmethod
+	def load(cls, path):
+		import mmap
+
+		with open(path, "rb") as file:
+			size = os.fstat(file.fileno()).st_size
+			if size < headerStruct.size:
+				raise ValueError("Not a lyrics timeline file: '{}'".format(path))
+			buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		fileMagic, count, textSize, dummy = headerStruct.unpack_from(buffer)
+		if fileMagic != magic or size < headerStruct.size + count * 20 + 4 + textSize:
+			buffer.close()
+			raise ValueError("Not a lyrics timeline file: '{}'".format(path))
+
+		view = memoryview(buffer)
+		pos = headerStruct.size
+		starts = view[pos:pos + count * 8]
+		pos += count * 8
+		ends = view[pos:pos + count * 8]
+		pos += count * 8
+		offsets = view[pos:pos + (count + 1) * 4]
+		pos += (count + 1) * 4
+		text = view[pos:pos + textSize]
+		if sys.byteorder == "little":
+			# Used straight from the mapped file without parsing
+			timeline = cls(starts.cast("d"), ends.cast("d"), offsets.cast("I"), text)
+		else:
+			timeline = cls(
+				array("d", struct.unpack("<{}d".format(count), starts)),
+				array("d", struct.unpack("<{}d".format(count), ends)),
+				struct.unpack("<{}I".format(count + 1), offsets),
+				bytes(text)
+			)
+		timeline.mmap = buffer
+		return timeline
+
+	def save(self, path):
+		with open(path, "wb+") as file:
+			file.write(headerStruct.pack(magic, len(self), len(self.textData), 0))
+			for values, format in ((self.starts, "d"), (self.ends, "d"), (self.offsets, "I")):
+				file.write(struct.pack("<{}{}".format(len(values), format), *values))
+			file.write(self.textData)
+
+	def close(self):
+		if self.mmap:
+			for name in ("starts", "ends", "offsets", "textData"):
+				value = getattr(self, name)
+				if type(value) is memoryview:
+					value.release()
+			self.mmap.close()
+			self.mmap = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return len(self.starts)
+
+	def text(self, index):
+		return bytes(self.textData[self.offsets[index]:self.offsets[index + 1]])
+
+	def cue(self, index):
+		return self.starts[index], self.ends[index], self.text(index)
+
+	def at(self, time):
+		# Index of the cue showing at the given time, or None
+		index = bisect_right(self.starts, time) - 1
+		if index >= 0 and time < self.ends[index]:
+			return index
+		return None
+
+	def between(self, start, end):
+		# Indexes of the cues showing at any point from start to end
+		first = bisect_right(self.ends, start)
+		last = bisect_left(self.starts, end)
+		return [index for index in range(first, last) if self.starts[index] < end and self.ends[index] > start]
+
+def main(argv=None, prog=None):
+	import argparse
+
+	if argv == None:
+		argv = sys.argv[1:]
+
+	parser = argparse.ArgumentParser(
+		prog=prog,
+		description="Builds and queries compiled lyrics timelines"
+	)
+	parser.add_argument(
+		"file.drp",
+		help="Path to a lyrics file (.drp, .bin, .cbin) or a compiled timeline"
+	)
+	parser.add_argument(
+		"-o",
+		metavar="file.ltl",
+		help="Save the timeline to a file."
+	)
+	parser.add_argument(
+		"--at",
+		metavar="seconds",
+		help="Print the line showing at a time.",
+		type=float
+	)
+	if len(argv) == 0:
+		parser.print_help()
+	else:
+		args = parser.parse_args(argv)
+		inputFile = getattr(args, "file.drp")
+		with open(inputFile, "rb") as file:
+			isTimeline = file.read(len(magic)) == magic
+		if isTimeline:
+			timeline = Timeline.load(inputFile)
+		else:
+			timeline = Timeline.fromLyrics(lyrics2vtt.readLyrics(inputFile))
+		if args.o:
+			timeline.save(args.o)
+		if args.at != None:
+			index = timeline.at(args.at)
+			if index != None:
+				start, end, text = timeline.cue(index)
+				sys.stdout.buffer.write(lyrics2vtt.timeSeconds(start) + b" --> " + lyrics2vtt.timeSeconds(end) + b"\n" + text + b"\n")
+		timeline.close()
+
+if __name__ == "__main__":
+	main()
@@ -6,8 +6,25 @@ from os import SEEK_SET, SEEK_CUR, SEEK_END
 from errno import EPIPE
 from struct import pack, unpack
 
+try:
+    from fumentools.phases import phase
+except ImportError:
+    # Standalone, profiling is not available
+    class _NullPhase(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+    _null_phase = _NullPhase()
+
+    def phase(name, bytes=0, records=0):
+        return _null_phase
+
 __all__ = ('decompress', 'decompress_file', 'decompress_bytes',
-           'decompress_overlay', 'DecompressionError')
+           'decompress_overlay', 'decompress_into', 'decompressobj',
+           'LZSSDecompressor', 'DecompressionError')
 
 class DecompressionError(ValueError):
     pass
@@ -129,8 +146,332 @@ def decompress_raw_lzss11(indata, decompressed_size):
 
     return data
 
+# the largest displacement either format can encode
+WINDOW_SIZE = 0x1000
+
+class LZSSDecompressor(object):
+    """Incremental LZSS decompressor, modelled on zlib.decompressobj().
+
+    Feed compressed chunks to decompress() and it returns whatever output
+    they complete. Only the last WINDOW_SIZE bytes of output are kept
+    between calls, so memory stays bounded no matter how large the stream
+    is. Once the expected size has been produced, eof becomes True and any
+    trailing input is kept in unused_data.
+    """
+
+    def __init__(self):
+        self.eof = False
+        self.unused_data = b''
+        self.decompressed_size = None
+        self._pending = bytearray()
+        self._window = bytearray()
+        self._total = 0
+        self._flags = 0
+        self._flag_bit = 8
+        self._token = None
+
+    def decompress(self, data):
+        """Decompress data, returning the bytes it completes."""
+        if self.eof:
+            self.unused_data += bytes(data)
+            return b''
+
+        pending = self._pending
+        pending += data
+
+        if self.decompressed_size is None:
+            if len(pending) < 4:
+                return b''
+            if pending[0] == 0x10:
+                self._token = self._token_lzss10
+            elif pending[0] == 0x11:
+                self._token = self._token_lzss11
+            else:
+                raise DecompressionError("not as lzss-compressed file")
+            self.decompressed_size, = unpack("<L", pending[1:4] + b'\x00')
+            del pending[:4]
+
+        window = self._window
+        start = len(window)
+        pos = 0
+        remaining = self.decompressed_size - self._total
+        produced = 0
+        while produced < remaining:
+            if self._flag_bit == 8:
+                if pos >= len(pending):
+                    break
+                self._flags = pending[pos]
+                self._flag_bit = 0
+                pos += 1
+            if self._flags & (0x80 >> self._flag_bit):
+                used = self._token(pending, pos, window)
+                if not used:
+                    # the rest of this token is in the next chunk
+                    break
+                pos += used
+            else:
+                if pos >= len(pending):
+                    break
+                window.append(pending[pos])
+                pos += 1
+            self._flag_bit += 1
+            produced = len(window) - start
+
+        del pending[:pos]
+        self._total += produced
+        if self._total >= self.decompressed_size:
+            if self._total != self.decompressed_size:
+                raise DecompressionError("decompressed size does not match the expected size")
+            self.eof = True
+            self.unused_data = bytes(pending)
+            del pending[:]
+
+        out = bytes(window[start:])
+        if len(window) > WINDOW_SIZE:
+            del window[:-WINDOW_SIZE]
+        return out
+
+    def flush(self):
+        """Finish the stream.
+
+        All output is returned eagerly by decompress(), so this only checks
+        that the stream was complete."""
+        if not self.eof:
+            raise DecompressionError("compressed data ended before the expected size")
+        return b''
+
+    @staticmethod
+    def _copy(window, count, disp):
+        if disp > len(window):
+            raise DecompressionError("displacement points before the start of the data")
+        if disp >= count:
+            window += window[-disp:len(window) - disp + count]
+        else:
+            # overlapping copy, the last disp bytes repeat
+            window += (window[-disp:] * (count // disp + 1))[:count]
+
+    def _token_lzss10(self, pending, pos, window):
+        if pos + 2 > len(pending):
+            return 0
+        sh = (pending[pos] << 8) | pending[pos + 1]
+        self._copy(window, (sh >> 0xc) + 3, (sh & 0xfff) + 1)
+        return 2
+
+    def _token_lzss11(self, pending, pos, window):
+        if pos >= len(pending):
+            return 0
+        indicator = pending[pos] >> 4
+        if indicator == 0:
+            size = 3
+        elif indicator == 1:
+            size = 4
+        else:
+            size = 2
+        if pos + size > len(pending):
+            return 0
+
+        b = pending[pos]
+        if indicator == 0:
+            # 8 bit count, 12 bit disp
+            b2 = pending[pos + 1]
+            count = (b << 4) + (b2 >> 4) + 0x11
+            disp = ((b2 & 0xf) << 8) + pending[pos + 2] + 1
+        elif indicator == 1:
+            # 16 bit count, 12 bit disp
+            b3 = pending[pos + 2]
+            count = ((b & 0xf) << 12) + (pending[pos + 1] << 4) + (b3 >> 4) + 0x111
+            disp = ((b3 & 0xf) << 8) + pending[pos + 3] + 1
+        else:
+            # indicator is count (4 bits), 12 bit disp
+            count = indicator + 1
+            disp = ((b & 0xf) << 8) + pending[pos + 1] + 1
+        self._copy(window, count, disp)
+        return size
+
+def decompressobj():
+    """Return an LZSSDecompressor for decompressing a stream in chunks."""
+    return LZSSDecompressor()
+
+
+def _copy_into(dst, op, count, disp):
+    """Copy a back-reference inside a memoryview. Returns the new position."""
+    if disp > op:
+        raise DecompressionError("displacement points before the start of the data")
+    start = op - disp
+    while count > 0:
+        # the copied region repeats every disp bytes, so it can be copied
+        # from its own start in chunks that double each time
+        n = min(op - start, count)
+        dst[op:op + n] = dst[start:start + n]
+        op += n
+        count -= n
+    return op
+
+def _decode_lzss10_into(src, dst, decompressed_size):
+    ip = 4
+    op = 0
+    while op < decompressed_size:
+        flags = src[ip]
+        ip += 1
+        for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+            if flags & bit:
+                sh = (src[ip] << 8) | src[ip + 1]
+                ip += 2
+                count = (sh >> 0xc) + 3
+                if op + count > decompressed_size:
+                    raise DecompressionError("decompressed size does not match the expected size")
+                op = _copy_into(dst, op, count, (sh & 0xfff) + 1)
+            else:
+                dst[op] = src[ip]
+                ip += 1
+                op += 1
+
+            if decompressed_size <= op:
+                break
+    return op
+
+def _decode_lzss11_into(src, dst, decompressed_size):
+    ip = 4
+    op = 0
+    while op < decompressed_size:
+        flags = src[ip]
+        ip += 1
+        for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+            if flags & bit:
+                b = src[ip]
+                indicator = b >> 4
+                if indicator == 0:
+                    # 8 bit count, 12 bit disp
+                    b2 = src[ip + 1]
+                    count = (b << 4) + (b2 >> 4) + 0x11
+                    disp = ((b2 & 0xf) << 8) + src[ip + 2] + 1
+                    ip += 3
+                elif indicator == 1:
+                    # 16 bit count, 12 bit disp
+                    b3 = src[ip + 2]
+                    count = ((b & 0xf) << 12) + (src[ip + 1] << 4) + (b3 >> 4) + 0x111
+                    disp = ((b3 & 0xf) << 8) + src[ip + 3] + 1
+                    ip += 4
+                else:
+                    # indicator is count (4 bits), 12 bit disp
+                    count = indicator + 1
+                    disp = ((b & 0xf) << 8) + src[ip + 1] + 1
+                    ip += 2
+                if op + count > decompressed_size:
+                    raise DecompressionError("decompressed size does not match the expected size")
+                op = _copy_into(dst, op, count, disp)
+            else:
+                dst[op] = src[ip]
+                ip += 1
+                op += 1
+
+            if decompressed_size <= op:
+                break
+    return op
+
+def _min_compressed_size(header_byte, decompressed_size):
+    """The least input that could possibly decode to decompressed_size.
+
+    The first byte is always a literal, every other byte could come from
+    the longest back-reference, and what is left over from the shortest
+    reference or from literals. Every 8 tokens need a flag byte."""
+    if decompressed_size == 0:
+        return 4
+    rest = decompressed_size - 1
+    if header_byte == 0x10:
+        longest, token_size = 0x12, 2
+        # a reference of any length takes 2 bytes
+        costs = ((0x12, 2),)
+    else:
+        longest, token_size = 0x10110, 4
+        costs = ((0x10, 2), (0x110, 3), (0x10110, 4))
+    references, left = divmod(rest, longest)
+    size = references * token_size
+    if left:
+        references += 1
+        size += min(left, min(cost for count, cost in costs if count >= left))
+    tokens = 1 + references
+    return 4 + 1 + size + -(-tokens // 8)
+
+def read_header(data, max_output=None):
+    """Check the 4 byte header of LZSS-compressed data.
+
+    Returns the decompressed size. Raises DecompressionError if the data is
+    not LZSS-compressed, decompresses to more than max_output bytes, or is
+    too short to possibly hold the advertised size."""
+    if len(data) < 4:
+        raise DecompressionError("compressed data is truncated")
+    if data[0] != 0x10 and data[0] != 0x11:
+        raise DecompressionError("not as lzss-compressed file")
+
+    decompressed_size = data[1] | (data[2] << 8) | (data[3] << 16)
+    if max_output is not None and decompressed_size > max_output:
+        raise DecompressionError("decompressed size {0} exceeds the limit of {1} bytes".format(
+            decompressed_size, max_output))
+    if len(data) < _min_compressed_size(data[0], decompressed_size):
+        raise DecompressionError("compressed data is truncated")
+    return decompressed_size
+
+def decompress_raw_lzss10_overlay(buf, compressed_size, src=None):
+    """Decompress an overlay in place, walking backwards.
+
+    buf must be a bytearray the size of the decompressed data, holding the
+    compressed data in its first compressed_size bytes (or pass the
+    compressed data separately as src). Input is read from the end of the
+    compressed data and output is written from the end of buf towards the
+    start, which is how the overlay loader itself decodes."""
+    decompressed_size = len(buf)
+    in_place = src is None
+    if in_place:
+        src = buf
+
+    # ip is the next compressed byte to read, op the next byte to write
+    ip = compressed_size - 1
+    op = decompressed_size - 1
+
+    while op >= 0:
+        if in_place and op - 8 * 18 < ip:
+            # one more flag byte could overwrite input we haven't read yet,
+            # so read the rest of the input from a copy
+            src = bytes(memoryview(buf)[:ip + 1])
+            in_place = False
+        if ip < 0:
+            raise DecompressionError("compressed data ended before the expected size")
+        flags = src[ip]
+        ip -= 1
+        for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+            if flags & bit:
+                if ip < 1:
+                    raise DecompressionError("compressed data ended before the expected size")
+                sh = (src[ip] << 8) | src[ip - 1]
+                ip -= 2
+                count = (sh >> 0xc) + 3
+                disp = (sh & 0xfff) + 3
+
+                if op + disp >= decompressed_size:
+                    raise DecompressionError("displacement points past the end of the data")
+                if count > op + 1:
+                    raise DecompressionError("decompressed size does not match the expected size")
+                if disp >= count:
+                    buf[op - count + 1:op + 1] = buf[op - count + 1 + disp:op + 1 + disp]
+                    op -= count
+                else:
+                    for _ in range(count):
+                        buf[op] = buf[op + disp]
+                        op -= 1
+            else:
+                if ip < 0:
+                    raise DecompressionError("compressed data ended before the expected size")
+                buf[op] = src[ip]
+                ip -= 1
+                op -= 1
+
+            if op < 0:
+                break
+
+    return buf
 
-def decompress_overlay(f, out):
+def decompress_overlay(f, out, chunk_size=0x10000):
     # the compression header is at the end of the file
     f.seek(-8, SEEK_END)
     header = f.read(8)
@@ -147,25 +488,33 @@ def decompress_overlay(f, out):
     padding = end_delta >> 0x18
     end_delta &= 0xFFFFFF
     decompressed_size = start_delta + end_delta
+    compressed_size = end_delta - padding
 
+    # the compressed data is decoded in place at the start of the output
+    # buffer, like the overlay loader does in memory
+    uncompressed_data = bytearray(decompressed_size)
     f.seek(-end_delta, SEEK_END)
-
-    data = bytearray()
-    data.extend(f.read(end_delta - padding))
-    data.reverse()
-
-    #stdout.write(data.tostring())
-
-    uncompressed_data = decompress_raw_lzss10(data, decompressed_size,
-                                              _overlay=True)
-    uncompressed_data.reverse()
+    if compressed_size <= decompressed_size:
+        if f.readinto(memoryview(uncompressed_data)[:compressed_size]) != compressed_size:
+            raise DecompressionError("compressed data ended before the expected size")
+        with phase("lzss.decompress", compressed_size):
+            decompress_raw_lzss10_overlay(uncompressed_data, compressed_size)
+    else:
+        # can't be decoded in place, only the start of the input gets used
+        data = f.read(compressed_size)
+        with phase("lzss.decompress", len(data)):
+            decompress_raw_lzss10_overlay(uncompressed_data, len(data), data)
 
     # first we write up to the portion of the file which was "overwritten" by
     # the decompressed data, then the decompressed data itself.
-    # i wonder if it's possible for decompression to overtake the compressed
-    # data, so that the decompression code is reading its own output...
     f.seek(0, SEEK_SET)
-    out.write(f.read(filelen - end_delta))
+    remaining = filelen - end_delta
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        out.write(chunk)
+        remaining -= len(chunk)
     out.write(uncompressed_data)
 
 def decompress(obj):
@@ -180,51 +529,82 @@ def decompress(obj):
     else:
         return decompress_bytes(obj)
 
-def decompress_bytes(data):
+def decompress_bytes(data, max_output=None):
     """Decompress LZSS-compressed bytes. Returns a bytearray."""
-    header = data[:4]
-    if header[0] == 0x10:
-        decompress_raw = decompress_raw_lzss10
-    elif header[0] == 0x11:
-        decompress_raw = decompress_raw_lzss11
-    else:
-        raise DecompressionError("not as lzss-compressed file")
-
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
+    decompressed_size = read_header(data, max_output)
+    out = bytearray(decompressed_size)
+    decompress_into(data, out)
+    return out
 
-    data = data[4:]
-    return decompress_raw(data, decompressed_size)
-
-def decompress_file(f):
+def decompress_file(f, max_output=None):
     """Decompress an LZSS-compressed file. Returns a bytearray.
 
     This isn't any more efficient than decompress_bytes, as it reads
     the entire file into memory. It is offered as a convenience.
     """
-    header = f.read(4)
-    if header[0] == 0x10:
-        decompress_raw = decompress_raw_lzss10
-    elif header[0] == 0x11:
-        decompress_raw = decompress_raw_lzss11
+    return decompress_bytes(f.read(), max_output)
+
+def decompress_into(src, dst_buffer, max_output=None):
+    """Decompress LZSS-compressed bytes into a preallocated buffer.
+
+    src is a bytes-like object or a file-like object, dst_buffer any
+    writable buffer at least as large as the decompressed data, so it can
+    be reused between calls. The header is validated against max_output
+    and the size of dst_buffer before anything is decoded.
+
+    Returns the number of bytes written to dst_buffer."""
+    if hasattr(src, 'read'):
+        src = src.read()
+    src = memoryview(src).cast('B')
+    dst = memoryview(dst_buffer).cast('B')
+    if dst.readonly:
+        raise TypeError("dst_buffer must be writable")
+
+    decompressed_size = read_header(src, max_output)
+    if decompressed_size > len(dst):
+        raise DecompressionError("decompressed size {0} does not fit in a {1} byte buffer".format(
+            decompressed_size, len(dst)))
+
+    if src[0] == 0x10:
+        decode = _decode_lzss10_into
     else:
-        raise DecompressionError("not as lzss-compressed file")
-
-    decompressed_size, = unpack("<L", header[1:] + b'\x00')
-
-    data = f.read()
-    return decompress_raw(data, decompressed_size)
-
-def main(args=None):
-    if args is None:
-        args = sys.argv[1:]
-
-    if '--overlay' in args:
-        args.remove('--overlay')
-        overlay = True
-    else:
-        overlay = False
-
-    if len(args) < 1 or args[0] == '-':
+        decode = _decode_lzss11_into
+    try:
+        with phase("lzss.decompress", len(src)):
+            decode(src, dst, decompressed_size)
+    except IndexError:
+        raise DecompressionError("compressed data ended before the expected size")
+    return decompressed_size
+
+def decompress_stream(f, out, chunk_size=0x10000):
+    """Decompress an LZSS-compressed file into another file object.
+
+    Reads and writes in chunks, so only the sliding window and one chunk of
+    output are held in memory at a time."""
+    d = decompressobj()
+    while not d.eof:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        with phase("lzss.decompress", len(chunk)):
+            data = d.decompress(chunk)
+        out.write(data)
+    d.flush()
+
+def main(args=None, prog=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Decompresses LZSS10 and LZSS11 files to stdout")
+    parser.add_argument("file", nargs="?", default="-",
+                        help="Compressed file, or '-' for stdin (the default).")
+    parser.add_argument("--overlay", action="store_true",
+                        help="Decompress an overlay, compressed backwards from its end.")
+    args = parser.parse_args(args)
+    overlay = args.overlay
+
+    if args.file == '-':
         if overlay:
             print("Can't decompress overlays from stdin", file=stderr)
             return 2
@@ -235,7 +615,7 @@ def main(args=None):
             f = stdin
     else:
         try:
-            f = open(args[0], "rb")
+            f = open(args.file, "rb")
         except IOError as e:
             print(e, file=stderr)
             return 2
@@ -249,7 +629,7 @@ def main(args=None):
         if overlay:
             decompress_overlay(f, stdout)
         else:
-            stdout.write(decompress_file(f))
+            decompress_stream(f, stdout)
     except IOError as e:
         if e.errno == EPIPE:
             # don't complain about a broken pipe
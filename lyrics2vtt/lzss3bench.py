@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""Benchmark and correctness checks for lzss3.
+
+Every fixture is generated here from a list of tokens, so no game data is
+needed. Each stream is checked against a plain reference decoder before it
+is timed, and results can be written out as JSON to compare runs over time.
+"""
+
+import sys
+import io
+import json
+import time
+import random
+import platform
+from struct import pack, unpack
+
+try:
+    from . import lzss3
+except ImportError:
+    import lzss3
+
+def encode_lzss10(tokens, overlay=False):
+    """Encode a list of tokens as an LZSS10 stream (without the header).
+
+    A token is either ('lit', byte) or ('ref', count, disp)."""
+    disp_extra = 3 if overlay else 1
+    out = bytearray()
+    for i in range(0, len(tokens), 8):
+        flags_pos = len(out)
+        out.append(0)
+        flags = 0
+        for bit, token in enumerate(tokens[i:i + 8]):
+            if token[0] == 'lit':
+                out.append(token[1])
+            else:
+                _, count, disp = token
+                flags |= 0x80 >> bit
+                sh = ((count - 3) << 12) | (disp - disp_extra)
+                out += pack(">H", sh)
+        out[flags_pos] = flags
+    return out
+
+def encode_lzss11(tokens):
+    """Encode a list of tokens as an LZSS11 stream (without the header)."""
+    out = bytearray()
+    for i in range(0, len(tokens), 8):
+        flags_pos = len(out)
+        out.append(0)
+        flags = 0
+        for bit, token in enumerate(tokens[i:i + 8]):
+            if token[0] == 'lit':
+                out.append(token[1])
+                continue
+            _, count, disp = token
+            flags |= 0x80 >> bit
+            disp -= 1
+            if count <= 0x10:
+                out += bytes(((count - 1) << 4 | disp >> 8, disp & 0xff))
+            elif count <= 0x110:
+                count -= 0x11
+                out += bytes((count >> 4, (count & 0xf) << 4 | disp >> 8, disp & 0xff))
+            else:
+                count -= 0x111
+                out += bytes((0x10 | count >> 12, (count >> 4) & 0xff,
+                              (count & 0xf) << 4 | disp >> 8, disp & 0xff))
+        out[flags_pos] = flags
+    return out
+
+def expand(tokens):
+    """Apply a list of tokens, giving the data they decode to."""
+    data = bytearray()
+    for token in tokens:
+        if token[0] == 'lit':
+            data.append(token[1])
+        else:
+            _, count, disp = token
+            for _ in range(count):
+                data.append(data[-disp])
+    return bytes(data)
+
+def header(kind, size):
+    return bytes((kind,)) + pack("<L", size)[:3]
+
+def overlay_file(prefix, tokens, padding=8):
+    """Build an overlay: prefix, then the compressed data stored backwards,
+    then the 8 byte footer."""
+    compressed = encode_lzss10(tokens, overlay=True)
+    compressed.reverse()
+    decompressed = expand(tokens)
+    end_delta = len(compressed) + padding
+    start_delta = len(decompressed) - end_delta
+    if start_delta < 0:
+        raise ValueError("overlay fixtures must compress")
+    footer = pack("<LL", end_delta | (padding << 0x18), start_delta)
+    return (prefix + bytes(compressed) + bytes(padding - 8) + footer,
+            prefix + decompressed[::-1])
+
+def reference_decompress(data):
+    """Decode an LZSS10/LZSS11 stream one byte at a time."""
+    kind = data[0]
+    size = data[1] | data[2] << 8 | data[3] << 16
+    pos = 4
+    out = bytearray()
+    while len(out) < size:
+        flags = data[pos]
+        pos += 1
+        for bit in range(8):
+            if len(out) >= size:
+                break
+            if not flags & (0x80 >> bit):
+                out.append(data[pos])
+                pos += 1
+                continue
+            if kind == 0x10:
+                sh = data[pos] << 8 | data[pos + 1]
+                pos += 2
+                count = (sh >> 12) + 3
+                disp = (sh & 0xfff) + 1
+            else:
+                b = data[pos]
+                if b >> 4 == 0:
+                    count = (b << 4 | data[pos + 1] >> 4) + 0x11
+                    disp = ((data[pos + 1] & 0xf) << 8 | data[pos + 2]) + 1
+                    pos += 3
+                elif b >> 4 == 1:
+                    count = ((b & 0xf) << 12 | data[pos + 1] << 4 | data[pos + 2] >> 4) + 0x111
+                    disp = ((data[pos + 2] & 0xf) << 8 | data[pos + 3]) + 1
+                    pos += 4
+                else:
+                    count = (b >> 4) + 1
+                    disp = ((b & 0xf) << 8 | data[pos + 1]) + 1
+                    pos += 2
+            for _ in range(count):
+                out.append(out[-disp])
+    return bytes(out)
+
+def reference_decompress_overlay(data):
+    """Decode an overlay one byte at a time, reading the reversed stream
+    forwards instead of decoding it backwards in place."""
+    end_delta, start_delta = unpack("<LL", data[-8:])
+    padding = end_delta >> 0x18
+    end_delta &= 0xffffff
+    prefix = data[:len(data) - end_delta]
+    compressed = data[len(data) - end_delta:len(data) - padding][::-1]
+    size = start_delta + end_delta
+    pos = 0
+    out = bytearray()
+    while len(out) < size:
+        flags = compressed[pos]
+        pos += 1
+        for bit in range(8):
+            if len(out) >= size:
+                break
+            if not flags & (0x80 >> bit):
+                out.append(compressed[pos])
+                pos += 1
+                continue
+            sh = compressed[pos] << 8 | compressed[pos + 1]
+            pos += 2
+            count = (sh >> 12) + 3
+            disp = (sh & 0xfff) + 3
+            for _ in range(count):
+                out.append(out[-disp])
+    return prefix + bytes(out[size - 1::-1])
+
+def literal_heavy(rng, size, longest):
+    """Mostly incompressible bytes with the odd short match."""
+    tokens = []
+    total = 0
+    while total < size:
+        if total > 16 and rng.random() < 0.1:
+            count = rng.randint(3, min(longest, 8))
+            tokens.append(('ref', count, rng.randint(3, min(total, 0x1000))))
+            total += count
+        else:
+            tokens.append(('lit', rng.randrange(256)))
+            total += 1
+    return tokens
+
+def long_match(rng, size, longest):
+    """A short random seed followed by long copies from across the window."""
+    tokens = [('lit', rng.randrange(256)) for _ in range(64)]
+    total = 64
+    while total < size:
+        count = rng.randint(max(3, longest // 2), longest)
+        tokens.append(('ref', count, rng.randint(3, min(total, 0x1000))))
+        total += count
+    return tokens
+
+def max_overlap(rng, size, longest, disp=1):
+    """Runs of a single byte, every copy overlapping itself (disp=1)."""
+    tokens = [('lit', rng.randrange(256)) for _ in range(disp)]
+    total = disp
+    while total < size:
+        tokens.append(('lit', rng.randrange(256)))
+        total += 1
+        count = longest
+        tokens.append(('ref', count, disp))
+        total += count
+    return tokens
+
+def fixtures(size, seed=0):
+    """Generate every fixture. Returns (name, function, stream, expected)."""
+    rng = random.Random(seed)
+    for name, tokens_for, longest in (
+        ("lzss10-literal-heavy", literal_heavy, 0x12),
+        ("lzss10-long-match", long_match, 0x12),
+        ("lzss10-max-overlap", max_overlap, 0x12),
+        ("lzss11-literal-heavy", literal_heavy, 0x10),
+        ("lzss11-long-match", long_match, 0x110),
+        ("lzss11-max-overlap", max_overlap, 0x110),
+        ("lzss11-count16", long_match, 0x2000),
+    ):
+        tokens = tokens_for(rng, size, longest)
+        expected = expand(tokens)
+        if name.startswith("lzss10"):
+            stream = header(0x10, len(expected)) + encode_lzss10(tokens)
+        else:
+            stream = header(0x11, len(expected)) + encode_lzss11(tokens)
+        stream = bytes(stream)
+        yield name, "decompress_bytes", stream, expected
+        yield name, "decompress_file", stream, expected
+        yield name, "decompress_into", stream, expected
+        yield name, "decompressobj", stream, expected
+
+    # overlays can only refer back three bytes or more
+    prefix = bytes(rng.randrange(256) for _ in range(0x800))
+    for name, tokens in (
+        ("overlay-literal-heavy", literal_heavy(rng, size, 0x12)),
+        ("overlay-long-match", long_match(rng, size, 0x12)),
+        ("overlay-max-overlap", max_overlap(rng, size, 0x12, disp=3)),
+    ):
+        try:
+            stream, expected = overlay_file(prefix, tokens)
+        except ValueError:
+            continue
+        yield name, "decompress_overlay", stream, expected
+
+def run(function, stream):
+    if function == "decompress_bytes":
+        return lzss3.decompress_bytes(stream)
+    elif function == "decompress_file":
+        return lzss3.decompress_file(io.BytesIO(stream))
+    elif function == "decompress_into":
+        out = bytearray(lzss3.read_header(stream))
+        lzss3.decompress_into(stream, out)
+        return out
+    elif function == "decompressobj":
+        d = lzss3.decompressobj()
+        out = [d.decompress(stream[i:i + 0x10000]) for i in range(0, len(stream), 0x10000)]
+        d.flush()
+        return b''.join(out)
+    elif function == "decompress_overlay":
+        out = io.BytesIO()
+        lzss3.decompress_overlay(io.BytesIO(stream), out)
+        return out.getvalue()
+    raise ValueError(function)
+
+def check(name, function, stream, expected):
+    if function == "decompress_overlay":
+        reference = reference_decompress_overlay(stream)
+    else:
+        reference = reference_decompress(stream)
+    if reference != expected:
+        raise AssertionError("{0}: the reference decoder disagrees with the fixture".format(name))
+    if run(function, stream) != reference:
+        raise AssertionError("{0}: {1} returned the wrong data".format(name, function))
+
+def benchmark(size=0x100000, repeat=3, seed=0, verify=True):
+    results = []
+    for name, function, stream, expected in fixtures(size, seed):
+        if verify:
+            check(name, function, stream, expected)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(function, stream)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append({
+            "fixture": name,
+            "function": function,
+            "compressed": len(stream),
+            "decompressed": len(expected),
+            "seconds": best,
+            "mb_per_s": len(expected) / best / 1e6 if best else None
+        })
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "size": size,
+        "repeat": repeat,
+        "seed": seed,
+        "results": results
+    }
+
+def main(args=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the lzss3 decompressors.")
+    parser.add_argument("-o", metavar="results.json",
+                        help="Write the results as JSON to a file, or '-' for stdout.")
+    parser.add_argument("--size", type=int, default=0x100000,
+                        help="Decompressed size of each fixture in bytes.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Time each decompressor this many times and keep the best.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for generating the fixtures.")
+    parser.add_argument("--no-verify", dest="verify", action="store_false",
+                        help="Skip the correctness checks.")
+    args = parser.parse_args(args)
+
+    report = benchmark(args.size, args.repeat, args.seed, args.verify)
+    for result in report["results"]:
+        print("{0:<24}{1:<20}{2:>10.2f} MB/s".format(
+            result["fixture"], result["function"], result["mb_per_s"] or 0), file=sys.stderr)
+    if args.o == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.o:
+        with open(args.o, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
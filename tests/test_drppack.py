@@ -0,0 +1,84 @@
+import io
+import os
+import sys
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lyrics2vtt import drppack
+from lyrics2vtt import drpextract
+
+def sampleEntries(seed=0):
+	rng = random.Random(seed)
+	return [
+		("stored.bin", b"short entry"),
+		("empty", b""),
+		("zlib.xml", b"<DB_DATA>" + b"<DATA_SET><words>la</words></DATA_SET>" * 200 + b"</DB_DATA>"),
+		("", bytes(rng.randrange(256) for i in range(0x51))),
+		("unknown1", bytes(rng.randrange(4) for i in range(0x30000))),
+		("threshold", bytes(drppack.compressThreshold))
+	]
+
+class RoundTripTest(unittest.TestCase):
+	def assertRoundTrip(self, archive, entries):
+		toc = drpextract.readToc(archive)
+		self.assertEqual([entry["name"] for entry in toc], [name.encode() for name, data in entries])
+		self.assertEqual([entry["compressed"] for entry in toc], [len(data) > drppack.compressThreshold for name, data in entries])
+		self.assertEqual([entry["data"] for entry in drpextract.extractFile(archive)], [data for name, data in entries])
+		self.assertEqual([b"".join(entry["chunks"]) for entry in drpextract.iterEntries(archive)], [data for name, data in entries])
+	
+	def testBuffer(self):
+		entries = sampleEntries()
+		file = io.BytesIO()
+		self.assertEqual(drppack.packFiles(file, entries), len(entries))
+		self.assertRoundTrip(file, entries)
+		self.assertRoundTrip(file.getvalue(), entries)
+	
+	def testFile(self):
+		entries = sampleEntries(1)
+		with tempfile.TemporaryDirectory() as tempDir:
+			path = os.path.join(tempDir, "test.drp")
+			drppack.packFiles(path, entries, jobs=4)
+			self.assertRoundTrip(path, entries)
+			with drpextract.DrpArchive(path) as archive:
+				for index, (name, data) in enumerate(entries):
+					self.assertEqual(archive.read(index), data)
+	
+	def testProcesses(self):
+		entries = sampleEntries(2)
+		file = io.BytesIO()
+		drppack.packFiles(file, entries, jobs=2, processes=True)
+		self.assertRoundTrip(file, entries)
+	
+	def testUnsizedEntries(self):
+		# The entry count of a generator is patched into the header at the end
+		entries = sampleEntries(3)
+		file = io.BytesIO()
+		drppack.packFiles(file, iter(entries), maxInFlightBytes=0x100)
+		self.assertRoundTrip(file, entries)
+	
+	def testExtractedFiles(self):
+		# Files written by drpextract pack back into the same archive
+		entries = [("", b"first blank"), ("unknown3", b"named"), ("", b"second blank" * 20), ("song.xml", b"<DB_DATA/>")]
+		cwd = os.getcwd()
+		with tempfile.TemporaryDirectory() as tempDir:
+			# outputPaths drops the leading slash of absolute paths
+			os.chdir(tempDir)
+			try:
+				drppack.packFiles("test.drp", entries)
+				outputPaths = list(drpextract.outputPaths(drpextract.readToc("test.drp"), "out"))
+				os.mkdir("out")
+				with drpextract.DrpArchive("test.drp") as archive:
+					drpextract.extractAll(archive, "out")
+				names = drppack.entryNames(outputPaths)
+				self.assertEqual(names, [name for name, data in entries])
+				drppack.packFiles("repacked.drp", list(zip(names, outputPaths)))
+				with open("test.drp", "rb") as file, open("repacked.drp", "rb") as repackedFile:
+					self.assertEqual(file.read(), repackedFile.read())
+			finally:
+				os.chdir(cwd)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,54 @@
+import io
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lyrics2vtt import lzss3
+from fumentools import bench
+
+# Short streams that are mostly one back-reference after the first literal
+repetitive = [
+	(bytes.fromhex("10130000 4041F000"), b"A" * 19),
+	(bytes.fromhex("11050000 40413000"), b"A" * 5),
+	(bytes.fromhex("11120000 40410000 00"), b"A" * 18),
+	(bytes.fromhex("11150100 40411000 3000"), b"A" * 0x115),
+	(bytes.fromhex("10000000"), b"")
+]
+
+class RepetitiveTest(unittest.TestCase):
+	def test_bytes(self):
+		for data, expected in repetitive:
+			self.assertEqual(lzss3.decompress_bytes(data), expected)
+	
+	def test_file(self):
+		for data, expected in repetitive:
+			self.assertEqual(bytes(lzss3.decompress_file(io.BytesIO(data))), expected)
+	
+	def test_stream(self):
+		for data, expected in repetitive:
+			decompressor = lzss3.decompressobj()
+			output = b"".join(decompressor.decompress(data[i:i + 1]) for i in range(len(data)))
+			self.assertEqual(output, expected)
+			self.assertTrue(decompressor.eof)
+	
+	def test_truncated(self):
+		for data, expected in repetitive:
+			if expected:
+				with self.assertRaises(lzss3.DecompressionError):
+					lzss3.decompress_bytes(data[:-1])
+
+class MinimumSizeTest(unittest.TestCase):
+	def test_lzss10(self):
+		# No stream the compressor writes is shorter than the bound
+		rng = random.Random(0)
+		for i in range(200):
+			data = bytes(rng.randrange(rng.choice((1, 2, 4, 256))) for j in range(rng.randrange(1, 600)))
+			compressed = bench.lzss10(data)
+			self.assertGreaterEqual(len(compressed), lzss3._min_compressed_size(0x10, len(data)))
+			self.assertEqual(lzss3.decompress_bytes(compressed), data)
+
+if __name__ == "__main__":
+	unittest.main()